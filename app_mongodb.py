@@ -1,19 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, current_app
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, abort, current_app, Response, stream_with_context
 from flask_pymongo import PyMongo
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 from bson.objectid import ObjectId
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+import io
 import json
 import os
-import qrcode
-from io import BytesIO
-import base64
-import csv
-import secrets
-import string
-from functools import wraps
 import time
+from functools import wraps
+import click
+from queue_engine import QueueEngine, ACTIVE_STATUSES
+from otp_allocator import OtpAllocator
+from wait_estimator import ServiceTimeEstimator
+from status_board import StatusBoard
+from history_archiver import HistoryArchiver
+from ttl_cache import TTLCache
+from message_bus import create_bus, BusManager, ClusterSync
+from company_stats import StatsAccumulator, delay_moment, stats_summary
+from qr_codes import QRCodeCache, QR_FORMATS, base_url
+from realtime import register_room_handlers, customer_room, company_room, room_stats
+from metrics import AppMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from queue_store import MongoQueueStore, OtpInUse
+from transitions import QueueTransitions
+from retention import RetentionPolicy
+from routing import DEFAULT_POLICY, ROUTING_POLICIES
+from service_profiles import PROFILE_DAYS, ServiceProfile, compute_profiles, expand_groups
+from provisioning import BATCH_SIZE, CODE_ATTEMPTS, FORMATS, detect_format, generate_company_code, provision
+from history_export import EXPORT_FIELDS, EXPORT_FORMATS, FETCH_ROWS, export_chunks, export_filename, parse_range
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -33,81 +49,427 @@ app.config['MONGO_CONNECT'] = False  # Defer connection until first use
 app.config['PYMONGO_CONNECT'] = False  # Same but for PyMongo
 
 # Initialize extensions
+# Prometheus metrics, served from /metrics; command monitoring has to be
+# registered before the client is created
+app_metrics = AppMetrics()
+app_metrics.init_app(app)
+app_metrics.watch_pymongo()
+
 mongo = PyMongo(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
+# Multi-worker mode: emits and invalidations travel over MESSAGE_BUS_URL
+bus = create_bus(os.getenv('MESSAGE_BUS_URL'))
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent',
+                    client_manager=BusManager(bus) if bus else None)
+cluster = ClusterSync(bus)
+# Expected service times for the shortest-expected-completion routing policy;
+# the engine fetches them outside its lock and keeps them between fetches
+queue_engine = QueueEngine(service_time=lambda cashier_id: calculate_wait_time(cashier_id))
+wait_estimator = ServiceTimeEstimator()
+status_board = StatusBoard()
+otp_allocator = OtpAllocator()
+qr_cache = QRCodeCache(cache_dir=os.getenv('QR_CACHE_DIR', os.path.join(app.instance_path, 'qr_cache')),
+                       max_files=int(os.getenv('QR_CACHE_MAX_FILES', '10000')))
+# Base URL the QR codes point at, e.g. https://queue.example.com/
+public_url = os.getenv('PUBLIC_URL')
+register_room_handlers(socketio)
 
 # Initialize database collections (equivalent to models)
 db = mongo.db
 
-# Simple in-memory cache for frequently accessed data
-cache = {
-    'company_code': {},  # company_code -> company data
-    'cashier_stats': {},  # cashier_id -> queue length
-    'wait_times': {},    # cashier_id -> average wait time
-    'cache_time': {}     # key -> timestamp
-}
-
-# Cache expiry in seconds
-CACHE_EXPIRY = {
-    'company_code': 300,  # 5 minutes
-    'cashier_stats': 10,  # 10 seconds
-    'wait_times': 60     # 1 minute
-}
-
-# Helper function to get cached data or fetch from DB
-def get_cached_or_fetch(cache_key, fetch_func, expiry_category, *args, **kwargs):
-    current_time = time.time()
-    if cache_key in cache[expiry_category] and current_time - cache['cache_time'].get(cache_key, 0) < CACHE_EXPIRY[expiry_category]:
-        return cache[expiry_category][cache_key]
-    
-    # Fetch new data
-    data = fetch_func(*args, **kwargs)
-    cache[expiry_category][cache_key] = data
-    cache['cache_time'][cache_key] = current_time
-    return data
-
-# Ensure indexes for queries
-with app.app_context():
+# Bounded lookup cache; entries are tagged with the company, cashier or
+# admin they were read from so writes can drop them
+lookup_cache = TTLCache()
+lookup_cache.on_invalidate = lambda name, key, tag: cluster.publish(
+    'cache_invalidated', name=name, key=key, tag=tag
+)
+lookup_cache.namespace('company_code', ttl=300, max_entries=2048, negative_ttl=30)  # company_code -> company document
+lookup_cache.namespace('cashier', ttl=300, max_entries=4096)         # cashier_id -> company and cashier numbers
+lookup_cache.namespace('admin_cashiers', ttl=300, max_entries=1024)  # admin_id -> ids of the cashiers they manage
+lookup_cache.namespace('service_profile', ttl=900, max_entries=4096, negative_ttl=900)  # cashier_id -> ServiceProfile
+app_metrics.watch_socketio(socketio)
+app_metrics.watch_cache(lookup_cache)
+
+# Ensure indexes for queries. Index builds wait on server selection, so by
+# default they run in a background greenlet once the app has loaded;
+# MONGO_INDEXES=startup builds them before the app serves, and
+# MONGO_INDEXES=skip leaves them to `flask --app app_mongodb create-indexes`
+def ensure_indexes():
+    started = time.perf_counter()
     # Create unique index for username in admins collection
     db.admins.create_index('username', unique=True)
     # Create unique index for company_code in companies collection
     db.companies.create_index('company_code', unique=True)
-    # Create index for otp in customers collection
-    db.customers.create_index('otp', unique=True)
+    # OTPs are unique among customers still in a queue (flagged 'active'),
+    # so finished customers' codes can be recycled
+    if db.customers.index_information().get('otp_1', {}).get('unique'):
+        db.customers.drop_index('otp_1')
+    db.customers.update_many(
+        {'status': {'$in': list(ACTIVE_STATUSES)}, 'active': {'$exists': False}},
+        {'$set': {'active': True}}
+    )
+    db.customers.create_index('otp')
+    db.customers.create_index([('otp', 1), ('active', 1)], unique=True,
+                              partialFilterExpression={'active': True})
     # Add performance indexes
     db.cashiers.create_index([('company_id', 1), ('is_active', 1)])
     db.customers.create_index([('cashier_id', 1), ('status', 1)])
-    db.customers.create_index([('cashier_id', 1), ('status', 1), ('position', 1)])
-    print("MongoDB indexes created")
+    # Customers queued before tickets existed keep their join order
+    untagged = db.customers.find(
+        {'status': {'$in': list(ACTIVE_STATUSES)}, 'ticket': {'$exists': False}},
+        {'_id': 1}
+    ).sort([('position', 1), ('_id', 1)])
+    backfill = [UpdateOne({'_id': c['_id']}, {'$set': {'ticket': i}}) for i, c in enumerate(untagged, 1)]
+    if backfill:
+        db.customers.bulk_write(backfill, ordered=False)
+    # Backs the rank count that derives live positions from tickets
+    db.customers.create_index([('cashier_id', 1), ('status', 1), ('ticket', 1)])
+    # At most one customer at each counter; rejects racing promotions
+    try:
+        db.customers.create_index('cashier_id', unique=True, name='one_serving_per_cashier',
+                                  partialFilterExpression={'status': 'serving'})
+    except Exception as e:
+        print(f"Could not create index one_serving_per_cashier: {str(e)}")
+    db.company_hourly_stats.create_index([('company_id', 1), ('hour', 1)], unique=True)
+    # Date-range exports, in join order
+    db.queue_history.create_index([('company_id', 1), ('join_time', 1), ('_id', 1)])
+    apply_retention()
+    print(f"MongoDB indexes created in {(time.perf_counter() - started) * 1000:.0f} ms")
 
-# Helper Functions
-def generate_company_code():
-    letters = string.ascii_uppercase
-    return ''.join(secrets.choice(letters) for _ in range(6))
+def ensure_indexes_in_background():
+    try:
+        ensure_indexes()
+    except Exception as e:
+        print(f"Could not create MongoDB indexes: {str(e)}")
 
-def generate_otp():
-    digits = string.digits
-    return ''.join(secrets.choice(digits) for _ in range(6))
+# Helper Functions
+def service_profile(cashier_id):
+    # The cashier's time-of-day profile, or None before it has one
+    def fetch():
+        profile = db.service_profiles.find_one({'_id': cashier_id}, {'quantiles': 1})
+        return ServiceProfile(profile['quantiles']) if profile else None
+    # Tagged so a recompute can drop every cashier's profile at once
+    return lookup_cache.get_or_fetch('service_profile', cashier_id, fetch, tags=('service_profiles',))
 
 def calculate_wait_time(cashier_id):
-    # Use cached wait time if available
-    cache_key = f"wait_time_{cashier_id}"
+    # The median service time for this weekday and hour from the cashier's
+    # profile when it has enough records for it
+    profile = service_profile(cashier_id)
+    seconds = profile.quantile(datetime.utcnow()) if profile else None
+    if seconds is not None:
+        return seconds
     
-    def fetch_wait_time():
+    # Otherwise an O(1) read of the rolling average; seeded from this cashier's history on first use
+    if not wait_estimator.is_loaded(cashier_id):
         # Get only the required fields for performance
-        served_customers = list(db.queue_history.find(
-            {'cashier_id': cashier_id, 'wait_time_seconds': {'$exists': True}},
+        recent = list(db.queue_history.find(
+            {'cashier_id': cashier_id, 'wait_time_seconds': {'$ne': None}},
             {'wait_time_seconds': 1}
-        ).sort('_id', -1).limit(5))
-        
-        if len(served_customers) > 0:
-            avg_serving_time = sum(c.get('wait_time_seconds', 0) for c in served_customers) / len(served_customers)
+        ).sort('_id', -1).limit(wait_estimator.window))
+        wait_estimator.seed(cashier_id, [c.get('wait_time_seconds') for c in reversed(recent)])
+    
+    return wait_estimator.estimate(cashier_id)
+
+def load_company_queues(company_id):
+    # Warm the queue engine for a company: one query for cashiers, one for customers
+    if queue_engine.is_loaded(company_id):
+        return
+    
+    cashiers = list(db.cashiers.find(
+        {'company_id': company_id},
+        {'cashier_number': 1, 'is_active': 1}
+    ))
+    
+    customers = db.customers.find(
+        {
+            'cashier_id': {'$in': [str(c['_id']) for c in cashiers]},
+            'status': {'$in': list(ACTIVE_STATUSES)}
+        },
+        {'cashier_id': 1, 'otp': 1, 'status': 1}
+    ).sort([('ticket', 1), ('_id', 1)])
+    
+    # Counters created before any ticket was issued through them start from
+    # the highest ticket already in use
+    queue_store.seed_tickets([str(c['_id']) for c in cashiers])
+    
+    company = db.companies.find_one({'_id': ObjectId(company_id)}, {'routing_policy': 1}) or {}
+    queue_engine.load(
+        company_id,
+        [(str(c['_id']), c['cashier_number'], c['is_active']) for c in cashiers],
+        [(c['cashier_id'], c['otp'], c['status']) for c in customers],
+        company.get('routing_policy', DEFAULT_POLICY)
+    )
+
+def queue_positions(customers):
+    # Live positions for one cashier's customers ordered by ticket
+    position = 0
+    for customer in customers:
+        if customer['status'] in ACTIVE_STATUSES:
+            position += 1
+            yield customer, position
         else:
-            avg_serving_time = 180  # 3 minutes default
-        
-        return avg_serving_time
+            yield customer, customer['position']
+
+def customer_queue_data(customer, position, avg_serving_time):
+    # Admin-facing view of one queue entry
+    return {
+        'id': str(customer['_id']),
+        'otp': customer['otp'],
+        'position': position,
+        'status': customer['status'],
+        'delays': customer.get('delays', 0),
+        'join_time': customer['join_time'].strftime('%H:%M:%S'),
+        'estimated_wait_time': int(position * avg_serving_time),
+        'serving_start_time': customer.get('serving_start_time', '').strftime('%H:%M:%S') if customer.get('serving_start_time') else None
+    }
+
+# Customer-facing queue operations go through the store, shared in shape
+# with the SQL and in-memory stores
+queue_store = MongoQueueStore(db)
+
+# History records are written behind the request, in batches, and expire
+# through TTL indexes (see apply_retention)
+# HISTORY_DEAD_LETTER: NDJSON file for history records that cannot be written
+history_archiver = HistoryArchiver(queue_store.record_history, dead_letter=os.getenv('HISTORY_DEAD_LETTER'),
+                                   logger=app.logger)
+retention = RetentionPolicy(float(os.getenv('HISTORY_RETENTION_DAYS', 90)),
+                            float(os.getenv('CUSTOMER_RETENTION_HOURS', 24)))
+
+def rebuild_company_stats(company_id=None, from_history=False):
+    # Recompute the materialized stats, streaming the documents: hours still
+    # fully held in queue_history from the raw records, older hours (whose
+    # records may have expired) from the per-cashier rollups, which are kept.
+    # from_history=True rebuilds everything from queue_history, rollups
+    # included; only right while no history has expired.
+    accumulator = StatsAccumulator()
+    complete_from = None if from_history else retention.complete_from(datetime.utcnow())
+    query = {}
+    if company_id is not None:
+        query = {'company_id': company_id}
+        accumulator.totals[company_id]  # Keep a zero document for companies without history
+    history_query = dict(query)
+    cashier_query = dict(query)
+    if complete_from is not None:
+        history_query['recorded_at'] = {'$gte': complete_from}
+        cashier_query['hour'] = {'$gte': complete_from}
+        for rollup in db.cashier_hourly_stats.find(dict(query, hour={'$lt': complete_from})).batch_size(5000):
+            accumulator.add_rollup(rollup['company_id'], rollup['hour'], rollup)
+    
+    history = db.queue_history.find(
+        history_query,
+        {'company_id': 1, 'cashier_number': 1, 'status': 1, 'delays': 1, 'wait_time_seconds': 1,
+         'recorded_at': 1, 'served_time': 1, 'join_time': 1}
+    ).batch_size(5000)
+    for entry in history:
+        accumulator.add(entry['company_id'], entry.get('cashier_number'), entry['status'], entry.get('delays'),
+                        entry.get('wait_time_seconds'),
+                        entry.get('recorded_at') or entry.get('served_time') or entry['join_time'])
+    # Customers still in a queue have no history record yet, but their
+    # delays were counted as they happened
+    cashiers = {str(cashier['_id']): cashier
+                for cashier in db.cashiers.find(query, {'company_id': 1, 'cashier_number': 1})}
+    delayed = db.customers.find(
+        {'cashier_id': {'$in': list(cashiers)}, 'active': True, 'delays': {'$gt': 0}},
+        {'cashier_id': 1, 'join_time': 1}
+    ).batch_size(5000)
+    for customer in delayed:
+        cashier = cashiers[customer['cashier_id']]
+        accumulator.add_delay(cashier['company_id'], cashier['cashier_number'],
+                              delay_moment(customer['join_time'], complete_from))
+    
+    db.company_stats.delete_many({'_id': company_id} if company_id is not None else {})
+    db.company_hourly_stats.delete_many(query)
+    db.cashier_hourly_stats.delete_many(cashier_query)
+    queue_store.apply_stats(accumulator)
+    return len(accumulator.totals)
+
+def compute_service_profiles(days=PROFILE_DAYS):
+    # Batch job: every cashier's profile from the served records of the last
+    # days, computed with NumPy. The server groups the service times by
+    # cashier, weekday and hour, so they arrive as arrays rather than one
+    # document per record. Returns (cashiers, records).
+    since = datetime.utcnow() - timedelta(days=days)
+    groups = db.queue_history.aggregate([
+        {'$match': {'status': 'served', 'wait_time_seconds': {'$ne': None}, 'recorded_at': {'$gte': since}}},
+        {'$group': {
+            '_id': {'cashier_id': '$cashier_id', 'weekday': {'$dayOfWeek': '$recorded_at'},
+                    'hour': {'$hour': '$recorded_at'}},
+            'seconds': {'$push': '$wait_time_seconds'}
+        }}
+    ], allowDiskUse=True)
+    group_keys, group_slots, group_seconds = [], [], []
+    for group in groups:
+        group_keys.append(group['_id']['cashier_id'])
+        # $dayOfWeek counts from Sunday (1); slots start on Monday
+        group_slots.append((group['_id']['weekday'] + 5) % 7 * 24 + group['_id']['hour'])
+        group_seconds.append(group['seconds'])
+    keys, slots, seconds = expand_groups(group_keys, group_slots, group_seconds)
+    profiles = compute_profiles(keys, slots, seconds)
+    
+    now = datetime.utcnow()
+    if profiles:
+        db.service_profiles.bulk_write([
+            ReplaceOne({'_id': cashier_id}, {'records': records, 'quantiles': packed, 'computed_at': now}, upsert=True)
+            for cashier_id, (records, packed) in profiles.items()
+        ], ordered=False)
+    db.service_profiles.delete_many({'_id': {'$nin': list(profiles)}})
+    # Workers would otherwise keep the old profiles for up to 15 minutes;
+    # the invalidation reaches them over the message bus
+    lookup_cache.invalidate_tag('service_profiles')
+    return len(profiles), len(seconds)
+
+def ensure_ttl_index(collection, field, seconds):
+    # Create, retune or drop the TTL index on a date field; seconds=None drops it
+    name = f"{field}_1"
+    current = collection.index_information().get(name)
+    if current is not None and current.get('expireAfterSeconds') == seconds:
+        return
+    if current is not None and seconds is not None and 'expireAfterSeconds' in current:
+        db.command({'collMod': collection.name, 'index': {'name': name, 'expireAfterSeconds': seconds}})
+        return
+    if current is not None:
+        collection.drop_index(name)
+    if seconds is not None:
+        collection.create_index(field, expireAfterSeconds=seconds)
+
+def apply_retention():
+    # Part of ensure_indexes. Records written before retention existed get the
+    # date fields the TTL indexes read, and are rolled up before any expire.
+    db.queue_history.update_many(
+        {'recorded_at': {'$exists': False}},
+        [{'$set': {'recorded_at': {'$ifNull': ['$served_time', '$join_time']}}}]
+    )
+    db.customers.update_many(
+        {'status': {'$in': ['served', 'removed']}, 'finished_at': {'$exists': False}},
+        [{'$set': {'finished_at': {'$ifNull': ['$served_time', '$join_time']}}}]
+    )
+    if 'cashier_hourly_stats' not in db.list_collection_names() and db.queue_history.find_one({}, {'_id': 1}):
+        print(f"Rolled up the queue history of {rebuild_company_stats(from_history=True)} companies")
+    db.cashier_hourly_stats.create_index([('company_id', 1), ('cashier_number', 1), ('hour', 1)], unique=True)
+    history_ttl, customer_ttl = retention.ttl_seconds()
+    ensure_ttl_index(db.queue_history, 'recorded_at', history_ttl)
+    ensure_ttl_index(db.customers, 'finished_at', customer_ttl)
+
+index_mode = os.getenv('MONGO_INDEXES', 'background').lower()
+if index_mode == 'startup':
+    ensure_indexes()
+elif index_mode != 'skip':
+    socketio.start_background_task(ensure_indexes_in_background)
+
+def set_routing_policy(company_id, policy):
+    db.companies.update_one({'_id': ObjectId(company_id)}, {'$set': {'routing_policy': policy}})
+    queue_engine.set_policy(company_id, policy)
+    # Other workers reload the company's queues, and with them the policy
+    queue_changed(company_id)
+
+def queue_changed(company_id, cashier_id=None):
+    # Call after a queue write: bumps the admin snapshot version and, when a
+    # cashier's waiting customers are affected, wakes their status long-polls
+    queue_engine.bump(company_id)
+    if cashier_id is not None:
+        status_board.bump(cashier_id)
+    cluster.publish('queue_changed', company_id=company_id, cashier_id=cashier_id)
+
+# Changes made by other workers
+def apply_queue_change(company_id, cashier_id=None):
+    # Their writes never reached this worker's engine, so reload it on next use
+    queue_engine.invalidate(company_id)
+    queue_engine.bump(company_id)
+    if cashier_id is not None:
+        status_board.bump(cashier_id)
+
+def apply_cache_invalidation(name=None, key=None, tag=None):
+    if tag is not None:
+        lookup_cache.invalidate_tag(tag, propagate=False)
+    else:
+        lookup_cache.invalidate(name, key, propagate=False)
+
+def record_service_time(cashier_key, seconds, company_id=None):
+    # A customer's time at the counter moves the cashier's rolling estimate,
+    # and with it the company's shortest-expected-completion ranks
+    wait_estimator.record(cashier_key, seconds)
+    if company_id is not None:
+        queue_engine.refresh_estimates(company_id, [cashier_key])
+
+cluster.on('queue_changed', apply_queue_change)
+cluster.on('cache_invalidated', apply_cache_invalidation)
+cluster.on('service_time', record_service_time)
+cluster.start(socketio, app)
+
+def company_by_code(company_code):
+    return lookup_cache.get_or_fetch(
+        'company_code', company_code,
+        lambda: db.companies.find_one({'company_code': company_code}),
+        tags=lambda company: [f"company:{company['_id']}"] if company else []
+    )
+
+def cashier_details(cashier_id):
+    def fetch():
+        cashier = db.cashiers.find_one({'_id': ObjectId(cashier_id)}, {'company_id': 1, 'cashier_number': 1})
+        company = db.companies.find_one({'_id': ObjectId(cashier['company_id'])}, {'company_code': 1, 'name': 1})
+        return {
+            'company_id': cashier['company_id'],
+            'cashier_number': cashier['cashier_number'],
+            'company_code': company['company_code'],
+            'name': company['name']
+        }
+    return lookup_cache.get_or_fetch(
+        'cashier', cashier_id, fetch,
+        tags=lambda details: [f"cashier:{cashier_id}", f"company:{details['company_id']}"]
+    )
+
+def admin_cashier_ids(admin_id):
+    def fetch():
+        company_ids = [str(c['_id']) for c in db.companies.find({'admin_id': admin_id}, {'_id': 1})]
+        return [str(c['_id']) for c in db.cashiers.find({'company_id': {'$in': company_ids}}, {'_id': 1})]
+    return lookup_cache.get_or_fetch('admin_cashiers', admin_id, fetch, tags=[f"admin:{admin_id}"])
+
+def taken_company_codes(codes):
+    return [company['company_code'] for company in db.companies.find(
+        {'company_code': {'$in': codes}}, {'company_code': 1}
+    )]
+
+def create_companies(companies, admin_id):
+    # Bulk insert companies (name, service_type, cashiers, company_code), then
+    # their cashiers and stats with one insert_many each. Returns the company
+    # ids in order; the ordered insert stops at a company code that is taken,
+    # and that company and the ones after it come back as None for the caller
+    # to retry with fresh codes (see provisioning.provision).
+    now = datetime.utcnow()
+    documents = [{
+        'name': company['name'],
+        'service_type': company['service_type'],
+        'admin_id': admin_id,
+        'company_code': company['company_code'],
+        'created_at': now
+    } for company in companies]
+    try:
+        db.companies.insert_many(documents, ordered=True)
+        inserted = len(documents)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+        inserted = e.details['nInserted']
     
-    return get_cached_or_fetch(cache_key, fetch_wait_time, 'wait_times')
+    # insert_many sets each document's _id
+    company_ids = [str(document['_id']) for document in documents[:inserted]]
+    if company_ids:
+        db.cashiers.insert_many([
+            {'company_id': company_id, 'cashier_number': number, 'is_active': True}
+            for company_id, company in zip(company_ids, companies)
+            for number in range(1, company['cashiers'] + 1)
+        ], ordered=False)
+        db.company_stats.insert_many([
+            {'_id': company_id, 'total_served': 0, 'total_delayed': 0, 'total_wait_seconds': 0}
+            for company_id in company_ids
+        ], ordered=False)
+        lookup_cache.invalidate_tag(f"admin:{admin_id}")
+        for company in companies[:inserted]:
+            # The new code may have been looked up (and cached as missing) before
+            lookup_cache.invalidate('company_code', company['company_code'])
+    return company_ids + [None] * (len(companies) - inserted)
+
+transitions = QueueTransitions(queue_store, queue_engine, history_archiver, otp_allocator, socketio,
+                               cashier_details, queue_changed)
 
 def login_required(f):
     @wraps(f)
@@ -129,6 +491,22 @@ def index():
 def health():
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/socket_stats')
+def socket_stats():
+    return jsonify(room_stats(socketio)), 200
+
+@app.route('/history_stats')
+def history_stats():
+    return jsonify({**history_archiver.stats(), 'retention': retention.describe()}), 200
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(lookup_cache.stats()), 200
+
+@app.route('/metrics')
+def metrics():
+    return app_metrics.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -195,34 +573,49 @@ def create_company():
         service_type = request.form.get('service_type')
         num_cashiers = int(request.form.get('num_cashiers'))
         
-        # Generate unique company code
-        while True:
-            company_code = generate_company_code()
-            if not db.companies.find_one({'company_code': company_code}):
+        # The unique index on company codes rejects a code already in use,
+        # so a collision just means trying another one
+        for attempt in range(CODE_ATTEMPTS):
+            company_id = create_companies([{
+                'name': name,
+                'service_type': service_type,
+                'cashiers': num_cashiers,
+                'company_code': generate_company_code()
+            }], session.get('admin_id'))[0]
+            if company_id is not None:
                 break
-        
-        # Create company
-        company_id = db.companies.insert_one({
-            'name': name,
-            'service_type': service_type,
-            'admin_id': session.get('admin_id'),
-            'company_code': company_code,
-            'created_at': datetime.utcnow()
-        }).inserted_id
-        
-        # Create cashiers
-        for i in range(1, num_cashiers + 1):
-            db.cashiers.insert_one({
-                'company_id': str(company_id),
-                'cashier_number': i,
-                'is_active': True
-            })
+        else:
+            flash('Could not allocate a company code, please try again.', 'danger')
+            return render_template('create_company.html')
         
         flash('Company created successfully.', 'success')
-        return redirect(url_for('manage_company', company_id=str(company_id)))
+        return redirect(url_for('manage_company', company_id=company_id))
     
     return render_template('create_company.html')
 
+@app.route('/api/provision_companies', methods=['POST'])
+@login_required
+def provision_companies():
+    # Bulk create companies for the logged-in admin from a CSV or NDJSON
+    # upload (form field 'file') or request body. The body is read and the
+    # results streamed back (NDJSON, one line per row) batch by batch.
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        fmt = detect_format(upload.filename, upload.content_type)
+    else:
+        stream = io.BufferedReader(request.stream)
+        fmt = detect_format(content_type=request.content_type)
+    fmt = request.args.get('format', fmt)
+    if fmt not in FORMATS:
+        return jsonify({'error': f"Send CSV or NDJSON, or pass ?format= ({', '.join(FORMATS)})"}), 400
+    
+    admin_id = session.get('admin_id')
+    results = provision(io.TextIOWrapper(stream, encoding='utf-8', newline=''), fmt, taken_company_codes,
+                        lambda companies: create_companies(companies, admin_id))
+    return Response(stream_with_context(json.dumps(result) + '\n' for result in results),
+                    mimetype='application/x-ndjson')
+
 @app.route('/manage_company/<company_id>')
 @login_required
 def manage_company(company_id):
@@ -235,34 +628,59 @@ def manage_company(company_id):
     
     cashiers = list(db.cashiers.find({'company_id': company_id}).sort('cashier_number', 1))
     
-    # Get queue stats
-    stats = {
-        'total_served': db.queue_history.count_documents({'company_id': company_id, 'status': 'served'}),
-        'total_delayed': db.queue_history.count_documents({'company_id': company_id, 'delays': {'$gt': 0}}),
-        'avg_wait_time': 0
-    }
+    # The template addresses documents by id, like the SQL models
+    company['id'] = company_id
+    for cashier in cashiers:
+        cashier['id'] = str(cashier['_id'])
     
-    served_customers = list(db.queue_history.find({'company_id': company_id, 'status': 'served'}))
-    if served_customers:
-        total_wait_time = sum(c.get('wait_time_seconds', 0) for c in served_customers)
-        stats['avg_wait_time'] = total_wait_time / len(served_customers) if len(served_customers) > 0 else 0
-    
-    # Generate QR code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(f"{request.host_url}join/{company['company_code']}")
-    qr.make(fit=True)
+    # Get queue stats from the materialized totals
+    totals = queue_store.company_stats(company_id)
+    if totals is None:
+        rebuild_company_stats(company_id)
+        totals = queue_store.company_stats(company_id)
+    stats = stats_summary(totals)
     
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffered = BytesIO()
-    img.save(buffered)
-    qr_code = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    return render_template('manage_company.html', company=company, cashiers=cashiers, stats=stats,
+                           routing_policies=list(ROUTING_POLICIES))
+
+@app.route('/api/export/<company_id>')
+@login_required
+def export_history(company_id):
+    # Stream the company's queue history as CSV (default) or NDJSON, oldest
+    # first, optionally limited to ?from=&to= on the join time
+    company = db.companies.find_one({'_id': ObjectId(company_id)}, {'admin_id': 1, 'company_code': 1})
+    if not company:
+        return jsonify({'error': 'Company not found'}), 404
+    if company['admin_id'] != session.get('admin_id'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        start, end = parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({'error': f"Invalid date range: {str(e)}"}), 400
+    
+    def history_rows():
+        # Runs once the response has started; the cursor fetches FETCH_ROWS
+        # documents per batch
+        query = {'company_id': company_id}
+        if start or end:
+            query['join_time'] = {}
+            if start:
+                query['join_time']['$gte'] = start
+            if end:
+                query['join_time']['$lt'] = end
+        history = db.queue_history.find(query, {field: 1 for field in EXPORT_FIELDS}).sort(
+            [('join_time', 1), ('_id', 1)]
+        ).batch_size(FETCH_ROWS)
+        for entry in history:
+            yield [entry.get(field) for field in EXPORT_FIELDS]
     
-    return render_template('manage_company.html', company=company, cashiers=cashiers, stats=stats, qr_code=qr_code)
+    filename = export_filename(company['company_code'], fmt, start, end)
+    return Response(stream_with_context(export_chunks(history_rows(), fmt)), mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 @app.route('/api/get_cashier_queue/<cashier_id>')
 @login_required
@@ -276,24 +694,11 @@ def get_cashier_queue(cashier_id):
     if company['admin_id'] != session.get('admin_id'):
         return jsonify({'error': 'Unauthorized access'}), 403
     
-    customers = list(db.customers.find({'cashier_id': cashier_id}).sort('position', 1))
+    customers = list(db.customers.find({'cashier_id': cashier_id}).sort([('ticket', 1), ('_id', 1)]))
     
-    queue_data = []
-    for customer in customers:
-        # Calculate estimated wait time
-        position = customer['position']
-        estimated_wait_time = int(position * calculate_wait_time(cashier_id))
-        
-        queue_data.append({
-            'id': str(customer['_id']),
-            'otp': customer['otp'],
-            'position': position,
-            'status': customer['status'],
-            'delays': customer.get('delays', 0),
-            'join_time': customer['join_time'].strftime('%H:%M:%S'),
-            'estimated_wait_time': estimated_wait_time,
-            'serving_start_time': customer.get('serving_start_time', '').strftime('%H:%M:%S') if customer.get('serving_start_time') else None
-        })
+    avg_serving_time = calculate_wait_time(cashier_id)
+    queue_data = [customer_queue_data(customer, position, avg_serving_time)
+                  for customer, position in queue_positions(customers)]
     
     return jsonify({
         'cashier_number': cashier['cashier_number'],
@@ -301,7 +706,51 @@ def get_cashier_queue(cashier_id):
         'queue': queue_data
     })
 
-# Add the rest of your routes with MongoDB implementation...
+@app.route('/api/company_queue/<company_id>')
+@login_required
+def company_queue(company_id):
+    company = db.companies.find_one({'_id': ObjectId(company_id)}, {'admin_id': 1})
+    if not company:
+        return jsonify({'error': 'Company not found'}), 404
+    
+    # Check if admin owns this company
+    if company['admin_id'] != session.get('admin_id'):
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    # Let the page skip the queue queries when nothing has changed
+    version = queue_engine.version(company_id)
+    if request.args.get('version') == version:
+        return jsonify({'version': version, 'changed': False})
+    
+    cashiers = list(db.cashiers.find({'company_id': company_id}).sort('cashier_number', 1))
+    
+    # One grouped query for every cashier's active customers
+    queues = {str(cashier['_id']): [] for cashier in cashiers}
+    customers = db.customers.find({
+        'cashier_id': {'$in': list(queues)},
+        'status': {'$nin': ['served', 'removed']}
+    }).sort([('cashier_id', 1), ('ticket', 1), ('_id', 1)])
+    for customer in customers:
+        queues[customer['cashier_id']].append(customer)
+    
+    cashier_data = []
+    for cashier in cashiers:
+        cashier_id = str(cashier['_id'])
+        avg_serving_time = calculate_wait_time(cashier_id)
+        cashier_data.append({
+            'id': cashier_id,
+            'cashier_number': cashier['cashier_number'],
+            'is_active': cashier['is_active'],
+            'queue': [customer_queue_data(c, position, avg_serving_time)
+                      for c, position in queue_positions(queues[cashier_id])]
+        })
+    
+    return jsonify({
+        'version': version,
+        'changed': True,
+        'cashiers': cashier_data
+    })
+
 
 @app.route('/api/toggle_cashier/<cashier_id>', methods=['POST'])
 @login_required
@@ -322,20 +771,70 @@ def toggle_cashier(cashier_id):
         {'$set': {'is_active': new_status}}
     )
     
-    # Clear related caches
-    cache_key = f"cashier_stats_{cashier['company_id']}"
-    if cache_key in cache['cashier_stats']:
-        del cache['cashier_stats'][cache_key]
+    # Keep the queue engine in step
+    queue_engine.set_active(cashier['company_id'], str(cashier_id), new_status)
+    queue_changed(cashier['company_id'])
     
-    # Emit socket event to notify all clients
+    # Emit socket event to the company's pages
     socketio.emit('cashier_status_change', {
         'cashier_id': str(cashier_id),
         'is_active': new_status,
         'company_code': company['company_code']
-    })
+    }, to=company_room(company['company_code']))
     
     return jsonify({'success': True, 'is_active': new_status})
 
+@app.route('/api/routing_policy/<company_id>', methods=['POST'])
+@login_required
+def update_routing_policy(company_id):
+    company = db.companies.find_one({'_id': ObjectId(company_id)}, {'admin_id': 1})
+    if not company:
+        return jsonify({'error': 'Company not found'}), 404
+    if company['admin_id'] != session.get('admin_id'):
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    policy = (request.get_json(silent=True) or request.form).get('policy')
+    if policy not in ROUTING_POLICIES:
+        return jsonify({'error': f"policy must be one of {', '.join(ROUTING_POLICIES)}"}), 400
+    
+    set_routing_policy(company_id, policy)
+    return jsonify({'success': True, 'routing_policy': policy})
+
+@app.route('/api/serve_customer/<customer_id>', methods=['POST'])
+@login_required
+def serve_customer(customer_id):
+    result = transitions.serve(customer_id, admin_cashier_ids(session.get('admin_id')))
+    if result is None:
+        return jsonify({'error': 'Customer is not being served'}), 404
+    
+    customer, next_otp = result
+    if customer['service_seconds'] is not None:
+        record_service_time(customer['cashier_id'], customer['service_seconds'], customer['company_id'])
+        cluster.publish('service_time', cashier_key=customer['cashier_id'], seconds=customer['service_seconds'],
+                        company_id=customer['company_id'])
+    return jsonify({'success': True, 'next_otp': next_otp})
+
+@app.route('/api/delay_customer/<customer_id>', methods=['POST'])
+@login_required
+def delay_customer(customer_id):
+    # The customer at the counter goes to the back of the line
+    result = transitions.delay(customer_id, admin_cashier_ids(session.get('admin_id')))
+    if result is None:
+        return jsonify({'error': 'Customer is not being served'}), 404
+    
+    customer, next_otp = result
+    return jsonify({'success': True, 'delays': customer['delays'], 'next_otp': next_otp})
+
+@app.route('/api/remove_customer/<customer_id>', methods=['POST'])
+@login_required
+def remove_customer(customer_id):
+    result = transitions.remove(customer_id, admin_cashier_ids(session.get('admin_id')))
+    if result is None:
+        return jsonify({'error': 'Customer is not in a queue'}), 404
+    
+    customer, next_otp = result
+    return jsonify({'success': True, 'next_otp': next_otp})
+
 @app.route('/queue_status/<otp>')
 def queue_status(otp):
     # Set cache headers for the browser
@@ -347,27 +846,23 @@ def queue_status(otp):
 
 def render_queue_status(otp):
     # Optimized function to render queue status
-    customer = db.customers.find_one({'otp': otp})
+    customer = queue_store.find_by_otp(otp)
     if not customer:
         return render_template('error.html', message='Queue number not found'), 404
     
-    # Get only required fields
-    cashier = db.cashiers.find_one(
-        {'_id': ObjectId(customer['cashier_id'])},
-        {'cashier_number': 1, 'company_id': 1}
-    )
-    
-    company = db.companies.find_one(
-        {'_id': ObjectId(cashier['company_id'])},
-        {'name': 1, 'company_code': 1}
-    )
+    # Cashier and company fields come from the cached cashier details
+    details = cashier_details(customer['cashier_id'])
+    cashier = {'cashier_number': details['cashier_number']}
+    company = {'name': details['name'], 'company_code': details['company_code']}
     
     # Calculate estimated wait time
-    estimated_wait_seconds = customer['position'] * calculate_wait_time(customer['cashier_id'])
+    position = queue_store.queue_position(customer)
+    estimated_wait_seconds = position * calculate_wait_time(customer['cashier_id'])
     
     return render_template(
         'queue_status.html',
         customer=customer,
+        position=position,
         cashier=cashier,
         company=company,
         estimated_wait_seconds=estimated_wait_seconds
@@ -375,14 +870,25 @@ def render_queue_status(otp):
 
 @app.route('/api/check_status/<otp>')
 def check_status(otp):
-    customer = db.customers.find_one({'otp': otp})
+    # Revalidation and long-polls (?wait=25) are answered from the status board
+    known = status_board.match(request.headers.get('If-None-Match'), otp)
+    if known:
+        cashier_key, version = known
+        if status_board.wait(cashier_key, version, request.args.get('wait', 0, type=int)) == version:
+            response = current_app.response_class(status=304)
+            response.set_etag(status_board.etag(otp, cashier_key))
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+    
+    customer = queue_store.find_by_otp(otp)
     if not customer:
         return jsonify({'error': 'Customer not found'}), 404
     
-    cashier = db.cashiers.find_one({'_id': ObjectId(customer['cashier_id'])}, {'cashier_number': 1})
+    cashier = cashier_details(customer['cashier_id'])
     
     # Calculate estimated wait time - use cached value
-    estimated_wait_seconds = customer['position'] * calculate_wait_time(customer['cashier_id'])
+    position = queue_store.queue_position(customer)
+    estimated_wait_seconds = position * calculate_wait_time(customer['cashier_id'])
     
     # Calculate time since serving started (if applicable)
     serving_time_passed = None
@@ -390,7 +896,7 @@ def check_status(otp):
         serving_time_passed = (datetime.utcnow() - customer['serving_start_time']).total_seconds()
     
     response = jsonify({
-        'position': customer['position'],
+        'position': position,
         'status': customer['status'],
         'cashier_number': cashier['cashier_number'],
         'estimated_wait_seconds': estimated_wait_seconds,
@@ -398,20 +904,108 @@ def check_status(otp):
         'delays': customer.get('delays', 0)
     })
     
-    # Set cache control headers
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    # Let clients revalidate with If-None-Match instead of refetching
+    response.set_etag(status_board.etag(otp, customer['cashier_id']))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    
+    return response
+
+@app.route('/qr/<company_code>.<fmt>')
+def qr_code(company_code, fmt):
+    if fmt not in QR_FORMATS:
+        abort(404)
+    
+    # Strong ETag from the content address; revalidation needs no rendering
+    host_url = base_url(public_url, request.host_url)
+    etag = qr_cache.key(host_url, company_code, fmt)
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        # Only render codes for companies that exist
+        if not qr_cache.contains(etag, fmt):
+            if not company_by_code(company_code):
+                abort(404)
+        response = current_app.response_class(qr_cache.get(host_url, company_code, fmt), mimetype=QR_FORMATS[fmt])
     
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
     return response
 
+@app.cli.command('prerender-qr')
+@click.option('--host-url', default=None, help='Public base URL, e.g. https://queue.example.com/ (defaults to PUBLIC_URL)')
+@click.option('--format', 'fmt', type=click.Choice(sorted(QR_FORMATS)), default='png')
+@click.option('--workers', type=int, default=None, help='Process pool size (defaults to CPU count)')
+def prerender_qr(host_url, fmt, workers):
+    """Render QR codes for every company into the QR cache directory."""
+    if not (host_url or public_url):
+        raise click.UsageError('Pass --host-url or set PUBLIC_URL')
+    host_url = base_url(host_url or public_url, None)
+    codes = (c['company_code'] for c in db.companies.find({}, {'company_code': 1}))
+    rendered = qr_cache.prerender(host_url, codes, fmt, workers)
+    print(f"Rendered {rendered} QR codes into {qr_cache.cache_dir}")
+
+@app.cli.command('create-indexes')
+def create_indexes():
+    """Create indexes and backfill fields the queries rely on."""
+    ensure_indexes()
+
+@app.cli.command('rebuild-stats')
+@click.option('--company-id', default=None, help='Only rebuild this company')
+def rebuild_stats(company_id):
+    """Recompute per-company statistics from the queue history and its rollups."""
+    rebuilt = rebuild_company_stats(company_id)
+    print(f"Rebuilt statistics for {rebuilt} companies")
+
+@app.cli.command('compute-service-profiles')
+@click.option('--days', type=int, default=PROFILE_DAYS, help='Days of history to profile')
+def compute_service_profiles_command(days):
+    """Recompute per-cashier time-of-day service-time profiles from the queue history."""
+    started = time.perf_counter()
+    cashiers, records = compute_service_profiles(days)
+    print(f"Profiled {cashiers} cashiers from {records} records in {time.perf_counter() - started:.2f} s")
+
+@app.cli.command('set-routing-policy')
+@click.argument('company_code')
+@click.argument('policy', type=click.Choice(list(ROUTING_POLICIES)))
+def set_routing_policy_command(company_code, policy):
+    """Choose how a company's joining customers are assigned to cashiers."""
+    company = db.companies.find_one({'company_code': company_code}, {'name': 1})
+    if company is None:
+        raise click.UsageError(f"No company with code {company_code}")
+    set_routing_policy(str(company['_id']), policy)
+    print(f"{company['name']} now routes customers by {policy}")
+
+@app.cli.command('prune-history')
+def prune_history_command():
+    """Delete expired queue history and finished customers without waiting for the TTL monitor."""
+    now = datetime.utcnow()
+    history_cutoff, customer_cutoff = retention.history_cutoff(now), retention.customer_cutoff(now)
+    history = queue_store.prune_history(history_cutoff, retention.batch_size) if history_cutoff else 0
+    customers = queue_store.prune_customers(customer_cutoff, retention.batch_size) if customer_cutoff else 0
+    print(f"Pruned {history} history records and {customers} finished customers")
+
+@app.cli.command('provision-companies')
+@click.argument('source', type=click.File('r', encoding='utf-8'), metavar='FILE')
+@click.option('--admin', 'username', required=True, help='Username of the admin who will own the companies')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None, help='Defaults to the file extension')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Companies per bulk insert')
+def provision_companies_command(source, username, fmt, batch_size):
+    """Create companies and their cashiers from a CSV or NDJSON file."""
+    admin = db.admins.find_one({'username': username}, {'_id': 1})
+    if admin is None:
+        raise click.ClickException(f"No admin named {username}")
+    fmt = fmt or detect_format(source.name)
+    if fmt is None:
+        raise click.UsageError('Cannot tell the format from the file name; pass --format')
+    # One JSON line per input row, then a summary line
+    for result in provision(source, fmt, taken_company_codes,
+                            lambda companies: create_companies(companies, str(admin['_id'])), batch_size):
+        print(json.dumps(result))
+
 @app.route('/join/<company_code>')
 def join_queue_page(company_code):
-    # Cache company data for frequently accessed companies
-    def fetch_company():
-        return db.companies.find_one({'company_code': company_code})
-    
-    company = get_cached_or_fetch(company_code, fetch_company, 'company_code')
+    # Company documents are served from the lookup cache
+    company = company_by_code(company_code)
     
     if not company:
         return render_template('error.html', message='Company not found'), 404
@@ -429,100 +1023,98 @@ def join_queue_page(company_code):
     response.headers['Expires'] = '0'
     return response
 
+def return_spare_tickets(spare_tickets):
+    # Unused tickets of rejected OTPs go back to their counters where no later
+    # join has taken the next one; otherwise they stay as gaps
+    for cashier_id, ticket in spare_tickets.items():
+        if ticket is not None:
+            queue_store.return_ticket(cashier_id, ticket)
+    spare_tickets.clear()
+
 @app.route('/api/join_queue/<company_code>', methods=['POST'])
 def join_queue(company_code):
     # Get company from cache if available
-    def fetch_company():
-        return db.companies.find_one({'company_code': company_code})
-    
-    company = get_cached_or_fetch(company_code, fetch_company, 'company_code')
+    company = company_by_code(company_code)
     
     if not company:
         return jsonify({'error': 'Company not found'}), 404
     
-    # Find the cashier with the shortest queue - optimize by caching queue lengths
-    cache_key = f"cashier_stats_{company['_id']}"
+    # Assign the cashier with the shortest queue from the in-memory engine
+    company_id = str(company['_id'])
+    load_company_queues(company_id)
     
-    def fetch_cashier_stats():
-        cashiers = list(db.cashiers.find({'company_id': str(company['_id']), 'is_active': True}))
-        
-        if not cashiers:
-            return None
-        
-        stats = {}
-        for cashier in cashiers:
-            cashier_id = str(cashier['_id'])
-            # Count only waiting customers for better performance
-            queue_length = db.customers.count_documents({
-                'cashier_id': cashier_id, 
-                'status': 'waiting'
-            })
-            stats[cashier_id] = {
-                'cashier': cashier,
-                'queue_length': queue_length
+    # The active-OTP unique index rejects a code that is still in use,
+    # so a collision just means trying the next code
+    spare_tickets = {}  # cashier_id -> ticket issued for a rejected OTP, reused on retry
+    try:
+        for attempt in range(5):
+            otp = otp_allocator.allocate()
+            assigned = queue_engine.join(company_id, otp)
+            
+            if not assigned:
+                return jsonify({'error': 'No active cashiers available'}), 400
+            
+            shortest_queue_cashier, position = assigned
+            cashier_id = shortest_queue_cashier.cashier_id
+            
+            # Create customer in queue with optimized data structure. The ticket
+            # is an atomic $inc on the cashier's counter, so simultaneous joins
+            # (on any worker) get distinct tickets
+            customer = {
+                'cashier_id': cashier_id,
+                'otp': otp,
+                'position': position,
+                'join_time': datetime.utcnow(),
+                'status': 'waiting',
+                'delays': 0
             }
-        return stats
-    
-    cashier_stats = get_cached_or_fetch(cache_key, fetch_cashier_stats, 'cashier_stats')
-    
-    if not cashier_stats:
-        return jsonify({'error': 'No active cashiers available'}), 400
-    
-    # Find shortest queue
-    shortest_queue_cashier = None
-    min_queue_length = float('inf')
-    
-    for cashier_id, stats in cashier_stats.items():
-        if stats['queue_length'] < min_queue_length:
-            min_queue_length = stats['queue_length']
-            shortest_queue_cashier = stats['cashier']
-    
-    # Generate OTP
-    while True:
-        otp = generate_otp()
-        if not db.customers.find_one({'otp': otp}):
-            break
-    
-    # Calculate position
-    position = min_queue_length + 1
-    
-    # Create customer in queue with optimized data structure
-    customer = {
-        'cashier_id': str(shortest_queue_cashier['_id']),
-        'otp': otp,
-        'position': position,
-        'join_time': datetime.utcnow(),
-        'status': 'waiting',
-        'delays': 0
-    }
+            
+            # Write through to the database
+            try:
+                customer['ticket'] = spare_tickets.pop(cashier_id, None) or queue_store.issue_ticket(cashier_id)
+                queue_store.add_customer(customer)
+                break
+            except OtpInUse as e:
+                spare_tickets[cashier_id] = e.ticket
+                queue_engine.remove(company_id, cashier_id, otp)
+            except Exception:
+                queue_engine.invalidate(company_id)
+                raise
+        else:
+            return jsonify({'error': 'Could not allocate a queue number, please try again'}), 503
+    finally:
+        # Tickets of rejected OTPs that no retry used (it went to another
+        # cashier, or ran out) go back to their counters
+        return_spare_tickets(spare_tickets)
     
-    # If this is the first customer for this cashier, mark as serving
+    # Everyone joins as waiting; the first in line is called through
+    # promote_next, and the unique index on serving customers lets only one
+    # of several simultaneous first joins reach the counter
+    next_otp = None
     if position == 1:
-        customer['status'] = 'serving'
-        customer['serving_start_time'] = datetime.utcnow()
-    
-    customer_id = db.customers.insert_one(customer).inserted_id
-    
-    # Invalidate cache
-    if cache_key in cache['cashier_stats']:
-        del cache['cashier_stats'][cache_key]
+        next_otp = queue_store.promote_next(cashier_id, datetime.utcnow())
+        if next_otp != otp:
+            # Another worker changed this queue; reload it and report the live position
+            queue_engine.invalidate(company_id)
+            position = queue_store.queue_position(queue_store.find_by_otp(otp))
+    queue_changed(company_id, cashier_id)
     
     # Calculate estimated wait time
-    estimated_wait_seconds = position * calculate_wait_time(str(shortest_queue_cashier['_id']))
+    estimated_wait_seconds = position * calculate_wait_time(cashier_id)
     
-    # Emit socket event if this is the first customer
-    if position == 1:
+    # Emit socket event when the join called someone to the counter
+    if next_otp is not None:
         socketio.emit('customer_turn', {
-            'otp': otp,
-            'cashier_number': shortest_queue_cashier['cashier_number'],
+            'otp': next_otp,
+            'cashier_number': shortest_queue_cashier.cashier_number,
             'company_code': company['company_code']
-        })
+        }, to=[customer_room(next_otp), company_room(company['company_code'])])
     
     response = jsonify({
         'success': True,
         'otp': otp,
         'position': position,
-        'cashier_number': shortest_queue_cashier['cashier_number'],
+        'cashier_number': shortest_queue_cashier.cashier_number,
         'estimated_wait_seconds': estimated_wait_seconds
     })
     
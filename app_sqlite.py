@@ -1,31 +1,78 @@
 # app_sqlite.py - Fallback SQLite version
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, abort
 from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-import json
 import os
-import qrcode
-from io import BytesIO
-import base64
-import csv
+import threading
+import time
 import secrets
 import string
 from functools import wraps
+import click
+from queue_engine import QueueEngine, ACTIVE_STATUSES
+from otp_allocator import OtpAllocator
+from wait_estimator import ServiceTimeEstimator
+from status_board import StatusBoard
+from history_archiver import HistoryArchiver
+from ttl_cache import TTLCache
+from sqlite_profile import apply_sqlite_profile
+from message_bus import create_bus, BusManager, ClusterSync
+from qr_codes import QRCodeCache, QR_FORMATS, base_url
+from realtime import register_room_handlers, customer_room, company_room, room_stats
+from metrics import AppMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from queue_store import SQLQueueStore, OtpInUse
+from transitions import QueueTransitions
+from retention import RetentionPolicy, HistoryPruner
+from sql_schema import upgrade_schema
+from routing import DEFAULT_POLICY, ROUTING_POLICIES
+from service_profiles import PROFILE_DAYS, ServiceProfile
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your_secret_key_here')
 
 # Configure SQLite database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///queue_system.db'
+# SQLALCHEMY_DATABASE_URI points it at another database file, e.g. for benchmarks
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///queue_system.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Initialize extensions
 db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
+# Multi-worker mode: emits and invalidations travel over MESSAGE_BUS_URL
+bus = create_bus(os.getenv('MESSAGE_BUS_URL'))
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent',
+                    client_manager=BusManager(bus) if bus else None)
+cluster = ClusterSync(bus)
+# Expected service times for the shortest-expected-completion routing policy;
+# the engine fetches them outside its lock and keeps them between fetches
+queue_engine = QueueEngine(service_time=lambda cashier_id: calculate_wait_time(cashier_id))
+wait_estimator = ServiceTimeEstimator()
+status_board = StatusBoard()
+otp_allocator = OtpAllocator()
+qr_cache = QRCodeCache(cache_dir=os.getenv('QR_CACHE_DIR', os.path.join(app.instance_path, 'qr_cache')),
+                       max_files=int(os.getenv('QR_CACHE_MAX_FILES', '10000')))
+# Base URL the QR codes point at, e.g. https://queue.example.com/
+public_url = os.getenv('PUBLIC_URL')
+register_room_handlers(socketio)
+
+# Bounded lookup cache; entries are tagged with the company or cashier they
+# were read from so writes can drop them
+lookup_cache = TTLCache()
+lookup_cache.on_invalidate = lambda name, key, tag: cluster.publish(
+    'cache_invalidated', name=name, key=key, tag=tag
+)
+lookup_cache.namespace('company_code', ttl=300, max_entries=2048, negative_ttl=30)  # company_code -> id and code
+lookup_cache.namespace('cashier', ttl=300, max_entries=4096)  # cashier_id -> company and cashier numbers
+lookup_cache.namespace('service_profile', ttl=900, max_entries=4096, negative_ttl=900)  # cashier_id -> ServiceProfile
+
+# Prometheus metrics, served from /metrics
+app_metrics = AppMetrics()
+app_metrics.init_app(app)
+app_metrics.watch_socketio(socketio)
+app_metrics.watch_cache(lookup_cache)
 
 # Models
 class Admin(db.Model):
@@ -46,6 +93,7 @@ class Company(db.Model):
     service_type = db.Column(db.String(100), nullable=False)
     admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'), nullable=False)
     company_code = db.Column(db.String(20), unique=True, nullable=False)
+    routing_policy = db.Column(db.String(40), nullable=False, default=DEFAULT_POLICY, server_default=DEFAULT_POLICY)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     cashiers = db.relationship('Cashier', backref='company', lazy=True, cascade="all, delete-orphan")
 
@@ -54,7 +102,12 @@ class Cashier(db.Model):
     company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=False)
     cashier_number = db.Column(db.Integer, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
+    last_ticket = db.Column(db.Integer, nullable=False, default=0)  # Ticket counter, see QueueStore.issue_ticket
     customers = db.relationship('Customer', backref='cashier', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_cashier_company_active', company_id, is_active),
+    )
 
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -64,8 +117,21 @@ class Customer(db.Model):
     served_time = db.Column(db.DateTime)
     status = db.Column(db.String(20), default='waiting')  # waiting, serving, served, delayed, removed
     delays = db.Column(db.Integer, default=0)
-    position = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False)  # Position at join time
+    ticket = db.Column(db.Integer)  # Per-cashier order key, increases with every join
     serving_start_time = db.Column(db.DateTime)
+    
+    # OTPs are unique among customers still in a queue, so finished
+    # customers' codes can be recycled
+    __table_args__ = (
+        db.Index('ix_customer_active_otp', otp, unique=True,
+                 sqlite_where=status.in_(ACTIVE_STATUSES),
+                 postgresql_where=status.in_(ACTIVE_STATUSES)),
+        # Backs the rank count that derives live positions from tickets
+        db.Index('ix_customer_cashier_status_ticket', cashier_id, status, ticket),
+        # check_status / queue_status look customers up by OTP
+        db.Index('ix_customer_otp', otp),
+    )
 
 class QueueHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -77,10 +143,86 @@ class QueueHistory(db.Model):
     wait_time_seconds = db.Column(db.Integer)
     status = db.Column(db.String(20), nullable=False)
     delays = db.Column(db.Integer, default=0)
+    recorded_at = db.Column(db.DateTime)  # served_time, or join_time when not served
+    
+    __table_args__ = (
+        db.Index('ix_queue_history_company_status', company_id, status),
+        # Seeds the per-cashier wait estimate from the latest records
+        db.Index('ix_queue_history_company_cashier', company_id, cashier_number),
+        # Retention deletes the oldest records in batches
+        db.Index('ix_queue_history_recorded_at', recorded_at),
+    )
+
+class CompanyStats(db.Model):
+    # Running totals, kept in step with QueueHistory inserts
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), primary_key=True)
+    total_served = db.Column(db.Integer, nullable=False, default=0)
+    total_delayed = db.Column(db.Integer, nullable=False, default=0)
+    total_wait_seconds = db.Column(db.BigInteger, nullable=False, default=0)
+
+class CompanyHourlyStats(db.Model):
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    total_served = db.Column(db.Integer, nullable=False, default=0)
+    total_delayed = db.Column(db.Integer, nullable=False, default=0)
+    total_wait_seconds = db.Column(db.BigInteger, nullable=False, default=0)
+
+class CashierHourlyStats(db.Model):
+    # Rollups of QueueHistory that outlive the raw records
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), primary_key=True)
+    cashier_number = db.Column(db.Integer, primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    total_served = db.Column(db.Integer, nullable=False, default=0)
+    total_delayed = db.Column(db.Integer, nullable=False, default=0)
+    total_wait_seconds = db.Column(db.BigInteger, nullable=False, default=0)
+
+class CashierProfile(db.Model):
+    # Time-of-day service-time quantiles, written by compute-service-profiles
+    cashier_id = db.Column(db.Integer, db.ForeignKey('cashier.id'), primary_key=True)
+    records = db.Column(db.Integer, nullable=False)  # Served records the profile was computed from
+    quantiles = db.Column(db.LargeBinary, nullable=False)  # float32 table, see service_profiles.py
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+# Customer-facing queue operations go through the store, shared in shape
+# with the MongoDB and in-memory stores
+queue_store = SQLQueueStore(db, Cashier, Customer, QueueHistory, CompanyStats, CompanyHourlyStats,
+                            CashierHourlyStats, CashierProfile)
+
+def write_history(entries):
+    # Batch writer for the history archiver, which runs outside any request
+    with app.app_context():
+        queue_store.record_history(entries)
+    history_pruner.start()
+
+def prune_history():
+    # Expire raw history past HISTORY_RETENTION_DAYS (its rollups stay) and
+    # customers who left the queue more than CUSTOMER_RETENTION_HOURS ago.
+    # History waits until any backfill of the rollups from it has finished.
+    with app.app_context():
+        return queue_store.prune_expired(retention, datetime.utcnow(), keep_history=stats_backfill_pending.is_set())
+
+# History records are written behind the request, in batches
+# HISTORY_DEAD_LETTER: NDJSON file for history records that cannot be written
+history_archiver = HistoryArchiver(write_history, dead_letter=os.getenv('HISTORY_DEAD_LETTER'), logger=app.logger)
+# ...and pruned on a schedule once the first ones have been written
+retention = RetentionPolicy(float(os.getenv('HISTORY_RETENTION_DAYS', 90)),
+                            float(os.getenv('CUSTOMER_RETENTION_HOURS', 24)))
+history_pruner = HistoryPruner(prune_history, interval=int(os.getenv('PRUNE_INTERVAL_SECONDS', 3600)),
+                               logger=app.logger)
+stats_backfill_pending = threading.Event()
 
 # Create database tables
 with app.app_context():
-    db.create_all()
+    # SQLITE_PROFILE=production: WAL and tuned pragmas on every connection
+    if apply_sqlite_profile(db.engine, os.getenv('SQLITE_PROFILE')):
+        print(f"SQLite profile: {os.getenv('SQLITE_PROFILE')}")
+    # Statement counts for /metrics
+    app_metrics.watch_sqlalchemy(db.engine)
+    # Columns and indexes added after a database was first created, too
+    backfill_tables = upgrade_schema(db)
+    if backfill_tables:
+        stats_backfill_pending.set()
+        backfill_last_id = queue_store.last_history_id()
     print("Database tables created")
 
 # Helper Functions
@@ -88,22 +230,165 @@ def generate_company_code():
     letters = string.ascii_uppercase
     return ''.join(secrets.choice(letters) for _ in range(6))
 
-def generate_otp():
-    digits = string.digits
-    return ''.join(secrets.choice(digits) for _ in range(6))
+def service_profile(cashier_id):
+    # The cashier's time-of-day profile, or None before it has one
+    def fetch():
+        packed = db.session.execute(
+            db.select(CashierProfile.quantiles).where(CashierProfile.cashier_id == cashier_id)
+        ).scalar()
+        return ServiceProfile(packed) if packed else None
+    # Tagged so a recompute can drop every cashier's profile at once
+    return lookup_cache.get_or_fetch('service_profile', cashier_id, fetch, tags=('service_profiles',))
 
 def calculate_wait_time(cashier_id):
-    customers = Customer.query.filter_by(cashier_id=cashier_id, status='waiting').order_by(Customer.position).all()
-    history = QueueHistory.query.filter_by(cashier_number=Cashier.query.get(cashier_id).cashier_number)
+    # The median service time for this weekday and hour from the cashier's
+    # profile when it has enough records for it
+    profile = service_profile(cashier_id)
+    seconds = profile.quantile(datetime.utcnow()) if profile else None
+    if seconds is not None:
+        return seconds
     
-    # Calculate average serving time (default to 3 minutes if not enough data)
-    served_customers = history.filter(QueueHistory.wait_time_seconds.isnot(None)).all()
-    if len(served_customers) > 5:
-        avg_serving_time = sum(c.wait_time_seconds for c in served_customers[-5:]) / 5  # Last 5 customers
-    else:
-        avg_serving_time = 180  # 3 minutes default
+    # Otherwise an O(1) read of the rolling average; seeded from this cashier's history on first use
+    if not wait_estimator.is_loaded(cashier_id):
+        cashier = Cashier.query.get(cashier_id)
+        recent = QueueHistory.query.with_entities(QueueHistory.wait_time_seconds).filter(
+            QueueHistory.company_id == cashier.company_id,
+            QueueHistory.cashier_number == cashier.cashier_number,
+            QueueHistory.wait_time_seconds.isnot(None)
+        ).order_by(QueueHistory.id.desc()).limit(wait_estimator.window).all()
+        wait_estimator.seed(cashier_id, [row.wait_time_seconds for row in reversed(recent)])
+    
+    return wait_estimator.estimate(cashier_id)
+
+def load_company_queues(company_id):
+    # Warm the queue engine for a company: one query for cashiers, one for customers
+    if queue_engine.is_loaded(company_id):
+        return
+    
+    # The company's routing policy comes along with its cashiers
+    cashiers = Cashier.query.with_entities(
+        Cashier.id, Cashier.cashier_number, Cashier.is_active, Company.routing_policy
+    ).join(Company).filter(Cashier.company_id == company_id).all()
+    
+    cashier_ids = [c.id for c in cashiers]
+    customers = Customer.query.with_entities(
+        Customer.cashier_id, Customer.otp, Customer.status
+    ).filter(
+        Customer.cashier_id.in_(cashier_ids),
+        Customer.status.in_(ACTIVE_STATUSES)
+    ).order_by(Customer.ticket, Customer.id).all()
     
-    return avg_serving_time
+    queue_engine.load(
+        company_id,
+        [(c.id, c.cashier_number, c.is_active) for c in cashiers],
+        customers,
+        cashiers[0].routing_policy if cashiers else DEFAULT_POLICY
+    )
+
+def rebuild_company_stats(company_id=None, from_history=False):
+    # Hours whose raw history may have expired come from the rollups, unless
+    # from_history, which is only right while no history has been pruned
+    complete_from = None if from_history else retention.complete_from(datetime.utcnow())
+    return queue_store.rebuild_stats(company_id, complete_from)
+
+def compute_service_profiles(days=PROFILE_DAYS):
+    # Batch job behind compute-service-profiles; returns (cashiers, records)
+    profiled = queue_store.compute_service_profiles(datetime.utcnow() - timedelta(days=days))
+    # Workers would otherwise keep the old profiles for up to 15 minutes;
+    # the invalidation reaches them over the message bus
+    lookup_cache.invalidate_tag('service_profiles')
+    return profiled
+
+def backfill_stats():
+    # Databases created before some statistics tables existed get them from
+    # the history already written, in the background so startup stays quick.
+    # Should it fail, `flask rebuild-stats --from-history` does the same.
+    try:
+        with app.app_context():
+            started = time.perf_counter()
+            records = queue_store.backfill_stats(backfill_tables, backfill_last_id)
+        app.logger.info('Backfilled %s from %d history records in %.2f s', ', '.join(backfill_tables), records,
+                        time.perf_counter() - started)
+        stats_backfill_pending.clear()
+    except Exception:
+        app.logger.exception('Could not backfill %s; run rebuild-stats --from-history', ', '.join(backfill_tables))
+
+if backfill_tables:
+    socketio.start_background_task(backfill_stats)
+
+def set_routing_policy(company, policy):
+    company.routing_policy = policy
+    db.session.commit()
+    queue_engine.set_policy(company.id, policy)
+    # Other workers reload the company's queues, and with them the policy
+    queue_changed(company.id)
+
+def queue_changed(company_id, cashier_id=None):
+    # Call after a queue write: bumps the admin snapshot version and, when a
+    # cashier's waiting customers are affected, wakes their status long-polls
+    queue_engine.bump(company_id)
+    if cashier_id is not None:
+        status_board.bump(cashier_id)
+    cluster.publish('queue_changed', company_id=company_id, cashier_id=cashier_id)
+
+# Changes made by other workers
+def apply_queue_change(company_id, cashier_id=None):
+    # Their writes never reached this worker's engine, so reload it on next use
+    queue_engine.invalidate(company_id)
+    queue_engine.bump(company_id)
+    if cashier_id is not None:
+        status_board.bump(cashier_id)
+
+def apply_cache_invalidation(name=None, key=None, tag=None):
+    if tag is not None:
+        lookup_cache.invalidate_tag(tag, propagate=False)
+    else:
+        lookup_cache.invalidate(name, key, propagate=False)
+
+def record_service_time(cashier_key, seconds, company_id=None):
+    # A customer's time at the counter moves the cashier's rolling estimate,
+    # and with it the company's shortest-expected-completion ranks
+    wait_estimator.record(cashier_key, seconds)
+    if company_id is not None:
+        queue_engine.refresh_estimates(company_id, [cashier_key])
+
+cluster.on('queue_changed', apply_queue_change)
+cluster.on('cache_invalidated', apply_cache_invalidation)
+cluster.on('service_time', record_service_time)
+cluster.start(socketio, app)
+
+def company_by_code(company_code):
+    def fetch():
+        company = Company.query.with_entities(Company.id, Company.company_code).filter_by(
+            company_code=company_code
+        ).first()
+        return dict(company._mapping) if company else None
+    return lookup_cache.get_or_fetch(
+        'company_code', company_code, fetch,
+        tags=lambda company: [f"company:{company['id']}"] if company else []
+    )
+
+def cashier_details(cashier_id):
+    def fetch():
+        cashier = db.session.execute(
+            db.select(Cashier.company_id, Cashier.cashier_number, Company.company_code, Company.name)
+            .join(Company, Company.id == Cashier.company_id)
+            .where(Cashier.id == cashier_id)
+        ).first()
+        return dict(cashier._mapping)
+    return lookup_cache.get_or_fetch(
+        'cashier', cashier_id, fetch,
+        tags=lambda details: [f"cashier:{cashier_id}", f"company:{details['company_id']}"]
+    )
+
+def owned_cashiers():
+    # The logged-in admin's cashiers, as a subquery for the transitions' ownership check
+    return db.select(Cashier.id).join(Company, Company.id == Cashier.company_id).where(
+        Company.admin_id == int(session.get('admin_id'))
+    )
+
+transitions = QueueTransitions(queue_store, queue_engine, history_archiver, otp_allocator, socketio,
+                               cashier_details, queue_changed)
 
 def login_required(f):
     @wraps(f)
@@ -125,6 +410,23 @@ def index():
 def health():
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/socket_stats')
+def socket_stats():
+    return jsonify(room_stats(socketio)), 200
+
+@app.route('/history_stats')
+def history_stats():
+    return jsonify({**history_archiver.stats(),
+                    'retention': {**retention.describe(), **history_pruner.stats()}}), 200
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(lookup_cache.stats()), 200
+
+@app.route('/metrics')
+def metrics():
+    return app_metrics.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -181,18 +483,58 @@ def dashboard():
     companies = Company.query.filter_by(admin_id=admin_id).all()
     return render_template('dashboard.html', companies=companies)
 
+@app.route('/api/serve_customer/<int:customer_id>', methods=['POST'])
+@login_required
+def serve_customer(customer_id):
+    result = transitions.serve(customer_id, owned_cashiers())
+    if result is None:
+        return jsonify({'error': 'Customer is not being served'}), 404
+    
+    customer, next_otp = result
+    if customer['service_seconds'] is not None:
+        record_service_time(customer['cashier_id'], customer['service_seconds'], customer['company_id'])
+        cluster.publish('service_time', cashier_key=customer['cashier_id'], seconds=customer['service_seconds'],
+                        company_id=customer['company_id'])
+    return jsonify({'success': True, 'next_otp': next_otp})
+
+@app.route('/api/delay_customer/<int:customer_id>', methods=['POST'])
+@login_required
+def delay_customer(customer_id):
+    # The customer at the counter goes to the back of the line
+    result = transitions.delay(customer_id, owned_cashiers())
+    if result is None:
+        return jsonify({'error': 'Customer is not being served'}), 404
+    
+    customer, next_otp = result
+    return jsonify({'success': True, 'delays': customer['delays'], 'next_otp': next_otp})
+
+@app.route('/api/remove_customer/<int:customer_id>', methods=['POST'])
+@login_required
+def remove_customer(customer_id):
+    result = transitions.remove(customer_id, owned_cashiers())
+    if result is None:
+        return jsonify({'error': 'Customer is not in a queue'}), 404
+    
+    customer, next_otp = result
+    return jsonify({'success': True, 'next_otp': next_otp})
+
 @app.route('/queue_status/<otp>')
 def queue_status(otp):
-    customer = Customer.query.filter_by(otp=otp).first_or_404()
-    cashier = Cashier.query.get(customer.cashier_id)
-    company = Company.query.get(cashier.company_id)
+    customer = queue_store.find_by_otp(otp)
+    if customer is None:
+        abort(404)
+    details = cashier_details(customer['cashier_id'])
+    cashier = {'cashier_number': details['cashier_number']}
+    company = {'name': details['name'], 'company_code': details['company_code']}
+    position = queue_store.queue_position(customer)
     
     # Calculate estimated wait time
-    estimated_wait_seconds = customer.position * calculate_wait_time(cashier.id)
+    estimated_wait_seconds = position * calculate_wait_time(customer['cashier_id'])
     
     return render_template(
         'queue_status.html',
         customer=customer,
+        position=position,
         cashier=cashier,
         company=company,
         estimated_wait_seconds=estimated_wait_seconds
@@ -200,25 +542,109 @@ def queue_status(otp):
 
 @app.route('/api/check_status/<otp>')
 def check_status(otp):
-    customer = Customer.query.filter_by(otp=otp).first_or_404()
-    cashier = Cashier.query.get(customer.cashier_id)
+    # Revalidation and long-polls (?wait=25) are answered from the status board
+    known = status_board.match(request.headers.get('If-None-Match'), otp)
+    if known:
+        cashier_key, version = known
+        if status_board.wait(cashier_key, version, request.args.get('wait', 0, type=int)) == version:
+            response = app.response_class(status=304)
+            response.set_etag(status_board.etag(otp, cashier_key))
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+    
+    customer = queue_store.find_by_otp(otp)
+    if customer is None:
+        abort(404)
+    position = queue_store.queue_position(customer)
     
     # Calculate estimated wait time
-    estimated_wait_seconds = customer.position * calculate_wait_time(cashier.id)
+    estimated_wait_seconds = position * calculate_wait_time(customer['cashier_id'])
     
     # Calculate time since serving started (if applicable)
     serving_time_passed = None
-    if customer.serving_start_time:
-        serving_time_passed = (datetime.utcnow() - customer.serving_start_time).total_seconds()
+    if customer['serving_start_time']:
+        serving_time_passed = (datetime.utcnow() - customer['serving_start_time']).total_seconds()
     
-    return jsonify({
-        'position': customer.position,
-        'status': customer.status,
-        'cashier_number': cashier.cashier_number,
+    response = jsonify({
+        'position': position,
+        'status': customer['status'],
+        'cashier_number': cashier_details(customer['cashier_id'])['cashier_number'],
         'estimated_wait_seconds': estimated_wait_seconds,
         'serving_time_passed': serving_time_passed,
-        'delays': customer.delays
+        'delays': customer['delays']
     })
+    
+    # Let clients revalidate with If-None-Match instead of refetching
+    response.set_etag(status_board.etag(otp, customer['cashier_id']))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    
+    return response
+
+@app.route('/qr/<company_code>.<fmt>')
+def qr_code(company_code, fmt):
+    if fmt not in QR_FORMATS:
+        abort(404)
+    
+    # Strong ETag from the content address; revalidation needs no rendering
+    host_url = base_url(public_url, request.host_url)
+    etag = qr_cache.key(host_url, company_code, fmt)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        # Only render codes for companies that exist
+        if not qr_cache.contains(etag, fmt):
+            Company.query.filter_by(company_code=company_code).first_or_404()
+        response = app.response_class(qr_cache.get(host_url, company_code, fmt), mimetype=QR_FORMATS[fmt])
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.cli.command('prerender-qr')
+@click.option('--host-url', default=None, help='Public base URL, e.g. https://queue.example.com/ (defaults to PUBLIC_URL)')
+@click.option('--format', 'fmt', type=click.Choice(sorted(QR_FORMATS)), default='png')
+@click.option('--workers', type=int, default=None, help='Process pool size (defaults to CPU count)')
+def prerender_qr(host_url, fmt, workers):
+    """Render QR codes for every company into the QR cache directory."""
+    if not (host_url or public_url):
+        raise click.UsageError('Pass --host-url or set PUBLIC_URL')
+    host_url = base_url(host_url or public_url, None)
+    codes = (row.company_code for row in Company.query.with_entities(Company.company_code).yield_per(1000))
+    rendered = qr_cache.prerender(host_url, codes, fmt, workers)
+    print(f"Rendered {rendered} QR codes into {qr_cache.cache_dir}")
+
+@app.cli.command('rebuild-stats')
+@click.option('--company-id', type=int, default=None, help='Only rebuild this company')
+@click.option('--from-history', is_flag=True, help='Rebuild the rollups too, from the full history')
+def rebuild_stats(company_id, from_history):
+    """Recompute per-company statistics from the queue history and its rollups."""
+    rebuilt = rebuild_company_stats(company_id, from_history)
+    print(f"Rebuilt statistics for {rebuilt} companies")
+
+@app.cli.command('compute-service-profiles')
+@click.option('--days', type=int, default=PROFILE_DAYS, help='Days of history to profile')
+def compute_service_profiles_command(days):
+    """Recompute per-cashier time-of-day service-time profiles from the queue history."""
+    started = time.perf_counter()
+    cashiers, records = compute_service_profiles(days)
+    print(f"Profiled {cashiers} cashiers from {records} records in {time.perf_counter() - started:.2f} s")
+
+@app.cli.command('set-routing-policy')
+@click.argument('company_code')
+@click.argument('policy', type=click.Choice(list(ROUTING_POLICIES)))
+def set_routing_policy_command(company_code, policy):
+    """Choose how a company's joining customers are assigned to cashiers."""
+    company = Company.query.filter_by(company_code=company_code).first()
+    if company is None:
+        raise click.UsageError(f"No company with code {company_code}")
+    set_routing_policy(company, policy)
+    print(f"{company.name} now routes customers by {policy}")
+
+@app.cli.command('prune-history')
+def prune_history_command():
+    """Delete queue history and finished customers past their retention window."""
+    pruned = history_pruner.run_once()
+    print(f"Pruned {pruned['history']} history records and {pruned['customers']} finished customers")
 
 @app.route('/join/<company_code>')
 def join_queue_page(company_code):
@@ -229,61 +655,66 @@ def join_queue_page(company_code):
 
 @app.route('/api/join_queue/<company_code>', methods=['POST'])
 def join_queue(company_code):
-    company = Company.query.filter_by(company_code=company_code).first_or_404()
+    company = company_by_code(company_code)
+    if company is None:
+        abort(404)
     
-    # Find the cashier with the shortest queue
-    cashiers = Cashier.query.filter_by(company_id=company.id, is_active=True).all()
-    
-    if not cashiers:
-        return jsonify({'error': 'No active cashiers available'}), 400
-    
-    shortest_queue_cashier = None
-    min_queue_length = float('inf')
+    # Assign the cashier with the shortest queue from the in-memory engine
+    load_company_queues(company['id'])
     
-    for cashier in cashiers:
-        queue_length = Customer.query.filter_by(
-            cashier_id=cashier.id, 
-            status='waiting'
-        ).count()
+    # The active-OTP unique index rejects a code that is still in use,
+    # so a collision just means trying the next code
+    for attempt in range(5):
+        otp = otp_allocator.allocate()
+        assigned = queue_engine.join(company['id'], otp)
         
-        if queue_length < min_queue_length:
-            min_queue_length = queue_length
-            shortest_queue_cashier = cashier
-    
-    # Generate OTP
-    while True:
-        otp = generate_otp()
-        if not Customer.query.filter_by(otp=otp).first():
+        if not assigned:
+            return jsonify({'error': 'No active cashiers available'}), 400
+        
+        shortest_queue_cashier, position = assigned
+        
+        # Write through to the database. The ticket comes from the cashier's
+        # counter in the same transaction as the insert, so simultaneous joins
+        # (on any worker) get distinct, gap-free tickets
+        try:
+            ticket = queue_store.issue_ticket(shortest_queue_cashier.cashier_id)
+            queue_store.add_customer({
+                'cashier_id': shortest_queue_cashier.cashier_id,
+                'otp': otp,
+                'position': position,
+                'ticket': ticket
+            })
             break
+        except OtpInUse:
+            queue_engine.remove(company['id'], shortest_queue_cashier.cashier_id, otp)
+        except Exception:
+            queue_engine.invalidate(company['id'])
+            raise
+    else:
+        return jsonify({'error': 'Could not allocate a queue number, please try again'}), 503
     
-    # Calculate position
-    position = min_queue_length + 1
-    
-    # Create customer in queue
-    customer = Customer(
-        cashier_id=shortest_queue_cashier.id,
-        otp=otp,
-        position=position
-    )
-    
-    db.session.add(customer)
-    db.session.commit()
+    # Everyone joins as waiting; the first in line is called through
+    # promote_next, whose free-counter check lets only one of several
+    # simultaneous first joins reach the counter
+    next_otp = None
+    if position == 1:
+        next_otp = queue_store.promote_next(shortest_queue_cashier.cashier_id, datetime.utcnow())
+        if next_otp != otp:
+            # Another worker changed this queue; reload it and report the live position
+            queue_engine.invalidate(company['id'])
+            position = queue_store.queue_position(queue_store.find_by_otp(otp))
+    queue_changed(company['id'], shortest_queue_cashier.cashier_id)
     
     # Calculate estimated wait time
-    estimated_wait_seconds = position * calculate_wait_time(shortest_queue_cashier.id)
+    estimated_wait_seconds = position * calculate_wait_time(shortest_queue_cashier.cashier_id)
     
-    # If this is the first customer for this cashier, mark as serving
-    if position == 1:
-        customer.status = 'serving'
-        customer.serving_start_time = datetime.utcnow()
-        db.session.commit()
-        
+    if next_otp is not None:
         # Emit socket event to notify the customer
         socketio.emit('customer_turn', {
-            'otp': customer.otp,
+            'otp': next_otp,
             'cashier_number': shortest_queue_cashier.cashier_number,
-            'company_code': company.company_code
-        })
+            'company_code': company['company_code']
+        }, to=[customer_room(next_otp), company_room(company['company_code'])])
     
     return jsonify({
         'success': True,
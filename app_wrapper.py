@@ -1,44 +1,91 @@
 # app_wrapper.py - Smart wrapper that tries MongoDB first, falls back to SQLite
 # This file allows Render to find the app using optimized settings
+#
+# Startup is bounded: MongoDB is probed with a short timeout
+# (STARTUP_PROBE_TIMEOUT_MS, default 1000) before app_mongodb is imported, and
+# app_mongodb builds its indexes in the background, so the port is bound
+# quickly either way. The timings are printed and served from /startup_stats.
 
 # Pre-configure gevent for better performance
 import gevent.monkey
 gevent.monkey.patch_all()
 
+import json
 import os
 import sys
+import time
+
+startup_began = time.perf_counter()
+startup_report = {}
+
+def elapsed_ms(since):
+    return round((time.perf_counter() - since) * 1000, 1)
+
+def mongo_reachable(timeout_ms):
+    # One ping with a short server selection timeout, instead of waiting out
+    # pymongo's 30 second default inside app_mongodb's first query
+    started = time.perf_counter()
+    try:
+        import pymongo
+        uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/virtual_queue')
+        if not (uri.startswith('mongodb://') or uri.startswith('mongodb+srv://')):
+            uri = 'mongodb://' + uri
+        client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms)
+        try:
+            client.admin.command('ping')
+        finally:
+            client.close()
+        return True
+    except Exception as e:
+        print(f"MongoDB probe failed: {str(e)}")
+        return False
+    finally:
+        startup_report['mongo_probe_ms'] = elapsed_ms(started)
 
 # Try to import the MongoDB version, fall back to SQLite if it fails
-try:
-    print("Attempting to use MongoDB version...")
-    # Configure pymongo optimizations
-    import pymongo
-    pymongo.MongoClient = pymongo.MongoClient
-    
-    # Import the MongoDB app with optimized settings
-    from app_mongodb import app, socketio
-    print("Successfully loaded MongoDB version")
-except Exception as e:
-    print(f"MongoDB version failed to load with error: {str(e)}")
+variant = None
+if mongo_reachable(int(os.getenv('STARTUP_PROBE_TIMEOUT_MS', 1000))):
+    try:
+        print("Attempting to use MongoDB version...")
+        started = time.perf_counter()
+        import app_mongodb as variant
+        startup_report['import_ms'] = elapsed_ms(started)
+        startup_report['variant'] = 'app_mongodb'
+        print("Successfully loaded MongoDB version")
+    except Exception as e:
+        print(f"MongoDB version failed to load with error: {str(e)}")
+
+if variant is None:
     print("Falling back to SQLite version...")
     try:
         # Import the SQLite fallback
-        from app_sqlite import app, socketio
+        started = time.perf_counter()
+        import app_sqlite as variant
+        startup_report['import_ms'] = elapsed_ms(started)
+        startup_report['variant'] = 'app_sqlite'
         print("Successfully loaded SQLite fallback version")
     except Exception as e2:
         print(f"SQLite version also failed with error: {str(e2)}")
         sys.exit(1)
+app, socketio = variant.app, variant.socketio
+
+startup_report['total_ms'] = elapsed_ms(startup_began)
+print(f"Startup report: {json.dumps(startup_report)}")
+
+@app.route('/startup_stats')
+def startup_stats():
+    return app.json.response(startup_report), 200
 
 # This makes the app importable by gunicorn
 if __name__ == '__main__':
     # Use optimized settings
     port = int(os.getenv('PORT', 5000))
     print(f"Starting server on port {port}")
-    socketio.run(app, 
+    socketio.run(app,
                  host='0.0.0.0',
                  port=port,
                  async_mode='gevent',
                  cors_allowed_origins="*",
                  websocket=True,
                  ping_timeout=10,
-                 ping_interval=25) 
\ No newline at end of file
+                 ping_interval=25)
@@ -0,0 +1,357 @@
+# benchmark.py - HTTP load test for the three app variants
+# Starts each variant in its own gevent server process against a throwaway
+# database (mongomock for app_mongodb unless --mongo-uri is given), drives it
+# with realistic traffic and prints throughput and latency percentiles as JSON:
+#
+#   python benchmark.py                           # every variant, default mix
+#   python benchmark.py --apps app --output bench.json
+#
+# Phases, run in order against each variant:
+#   flash_crowd  - a burst of concurrent POST /api/join_queue
+#   steady_mix   - customers polling GET /api/check_status while admins
+#                  refresh GET /api/get_cashier_queue, for a fixed duration
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+APPS = ('app', 'app_sqlite', 'app_mongodb')
+READY_MARKER = 'BENCH_READY '
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench-password'
+BENCH_COMPANY_CODE = 'BENCHQ'
+
+
+# Server side: one variant behind a gevent WSGI server
+
+def serve(app_name, port, cashiers, mongo_uri=None, seed=True):
+    if app_name == 'app_mongodb':
+        # Imported before patching: with trio installed, dnspython's optional
+        # trio support fails to import once select has been patched
+        importlib.import_module('pymongo')
+        if not mongo_uri:
+            import mongomock
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    if app_name == 'app_mongodb' and not mongo_uri:
+        # Local stand-in for mongod
+        import flask_pymongo
+        client = mongomock.MongoClient()
+
+        class MockPyMongo:
+            def __init__(self, app=None, **kwargs):
+                self.cx = client
+                self.db = client['virtual_queue_bench']
+
+        flask_pymongo.PyMongo = MockPyMongo
+    elif mongo_uri:
+        os.environ['MONGODB_URI'] = mongo_uri
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    module = __import__(app_name)
+    if os.getenv('BENCH_OTP_KEY'):
+        # join_stress.py --collide: every worker draws the same OTP sequence
+        module.otp_allocator._key = bytes.fromhex(os.environ['BENCH_OTP_KEY'])
+    # Further workers on an already seeded database skip seeding (join_stress.py)
+    setup = {}
+    if seed:
+        setup = seed_mongo(module, cashiers) if app_name == 'app_mongodb' else seed_sql(module, cashiers)
+
+    from gevent.pywsgi import WSGIServer
+    server = WSGIServer(('127.0.0.1', port), module.app, log=None)
+    server.start()
+    print(READY_MARKER + json.dumps(setup), flush=True)
+    server.serve_forever()
+
+
+def seed_sql(module, cashiers):
+    with module.app.app_context():
+        admin = module.Admin(username=BENCH_USER)
+        admin.set_password(BENCH_PASSWORD)
+        module.db.session.add(admin)
+        module.db.session.flush()
+        company = module.Company(name='Benchmark', service_type='Benchmark',
+                                 admin_id=admin.id, company_code=BENCH_COMPANY_CODE)
+        module.db.session.add(company)
+        module.db.session.flush()
+        rows = [module.Cashier(company_id=company.id, cashier_number=i, is_active=True)
+                for i in range(1, cashiers + 1)]
+        module.db.session.add_all(rows)
+        module.db.session.add(module.CompanyStats(company_id=company.id))
+        module.db.session.commit()
+        return {'company_id': company.id, 'cashier_ids': [row.id for row in rows]}
+
+
+def seed_mongo(module, cashiers):
+    from werkzeug.security import generate_password_hash
+    db = module.db
+    db.admins.delete_many({'username': BENCH_USER})
+    admin_id = db.admins.insert_one({
+        'username': BENCH_USER,
+        'password_hash': generate_password_hash(BENCH_PASSWORD),
+        'created_at': datetime.utcnow()
+    }).inserted_id
+    db.companies.delete_many({'company_code': BENCH_COMPANY_CODE})
+    company_id = str(db.companies.insert_one({
+        'name': 'Benchmark',
+        'service_type': 'Benchmark',
+        'admin_id': str(admin_id),
+        'company_code': BENCH_COMPANY_CODE,
+        'created_at': datetime.utcnow()
+    }).inserted_id)
+    cashier_ids = [
+        str(db.cashiers.insert_one({'company_id': company_id, 'cashier_number': i, 'is_active': True}).inserted_id)
+        for i in range(1, cashiers + 1)
+    ]
+    return {'company_id': company_id, 'cashier_ids': cashier_ids}
+
+
+# Client side: gevent greenlets with keep-alive connections
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # route -> [seconds]
+        self.errors = {}     # route -> count
+
+    def add(self, route, seconds, ok):
+        self.latencies.setdefault(route, []).append(seconds)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, duration):
+        routes = {route: summarize(samples, self.errors.get(route, 0), duration)
+                  for route, samples in sorted(self.latencies.items())}
+        everything = [s for samples in self.latencies.values() for s in samples]
+        return {
+            'duration_s': round(duration, 3),
+            'total': summarize(everything, sum(self.errors.values()), duration),
+            'routes': routes
+        }
+
+
+def percentile(ordered, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    rank = max(1, int(round(fraction * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(samples, errors, duration):
+    ordered = sorted(samples)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / duration, 2) if duration else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(ordered, 0.50) * 1000, 2),
+            'p95': round(percentile(ordered, 0.95) * 1000, 2),
+            'p99': round(percentile(ordered, 0.99) * 1000, 2),
+            'max': round(ordered[-1] * 1000, 2) if ordered else 0.0
+        }
+    }
+
+
+class Client:
+    def __init__(self, port, recorder, cookie=None):
+        import http.client
+        self._connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.recorder = recorder
+        self.cookie = cookie
+
+    def request(self, method, path, route, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        started = time.perf_counter()
+        try:
+            self._connection.request(method, path, body=body, headers=headers)
+            response = self._connection.getresponse()
+            payload = response.read()
+            ok = response.status < 400
+        except Exception:
+            self._connection.close()
+            response, payload, ok = None, b'', False
+        self.recorder.add(route, time.perf_counter() - started, ok)
+        return response, payload
+
+    def close(self):
+        self._connection.close()
+
+
+def login(port):
+    from urllib.parse import urlencode
+    client = Client(port, Recorder())
+    response, _ = client.request(
+        'POST', '/login', 'login',
+        body=urlencode({'username': BENCH_USER, 'password': BENCH_PASSWORD}),
+        headers={'Content-Type': 'application/x-www-form-urlencoded'}
+    )
+    client.close()
+    cookie = response.getheader('Set-Cookie') if response is not None else None
+    return cookie.split(';', 1)[0] if cookie else None
+
+
+def flash_crowd(port, joins, concurrency):
+    import gevent
+    recorder = Recorder()
+    otps = []
+    remaining = [joins]
+
+    def customer():
+        client = Client(port, recorder)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            response, payload = client.request('POST', f"/api/join_queue/{BENCH_COMPANY_CODE}", 'join_queue')
+            if response is not None and response.status == 200:
+                otps.append(json.loads(payload)['otp'])
+        client.close()
+
+    started = time.perf_counter()
+    gevent.joinall([gevent.spawn(customer) for _ in range(concurrency)])
+    return recorder.summary(time.perf_counter() - started), otps
+
+
+def steady_mix(port, otps, cashier_ids, duration, pollers, admins, admin_cookie, poll_interval, admin_interval):
+    import gevent
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    def poller(index):
+        client = Client(port, recorder)
+        otp = otps[index % len(otps)]
+        while time.perf_counter() < deadline:
+            client.request('GET', f"/api/check_status/{otp}", 'check_status')
+            gevent.sleep(poll_interval)
+        client.close()
+
+    def admin(index):
+        client = Client(port, recorder, cookie=admin_cookie)
+        cashier_id = cashier_ids[index % len(cashier_ids)]
+        while time.perf_counter() < deadline:
+            client.request('GET', f"/api/get_cashier_queue/{cashier_id}", 'get_cashier_queue')
+            gevent.sleep(admin_interval)
+        client.close()
+
+    workers = [gevent.spawn(poller, i) for i in range(pollers if otps else 0)]
+    workers += [gevent.spawn(admin, i) for i in range(admins if admin_cookie else 0)]
+    started = time.perf_counter()
+    gevent.joinall(workers)
+    return recorder.summary(time.perf_counter() - started)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_app(app_name, args):
+    import gevent
+    workdir = tempfile.mkdtemp(prefix=f"bench-{app_name}-")
+    port = free_port()
+    env = dict(os.environ)
+    env['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    env['QR_CACHE_DIR'] = os.path.join(workdir, 'qr_cache')
+    env.pop('MESSAGE_BUS_URL', None)
+    command = [sys.executable, os.path.abspath(__file__), '--serve', app_name,
+               '--port', str(port), '--cashiers', str(args.cashiers)]
+    if args.mongo_uri:
+        command += ['--mongo-uri', args.mongo_uri]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              env=env, cwd=workdir, text=True)
+    try:
+        setup = None
+        for line in server.stdout:
+            if line.startswith(READY_MARKER):
+                setup = json.loads(line[len(READY_MARKER):])
+                break
+        if setup is None:
+            return {'error': f"server exited with code {server.wait()}"}
+        # Keep draining the server's output so it never blocks on a full pipe
+        gevent.spawn(server.stdout.read)
+
+        result = {}
+        result['flash_crowd'], otps = flash_crowd(port, args.joins, args.concurrency)
+
+        # app_sqlite has no admin pages, so its mix is customers only
+        admin_cookie = login(port)
+        result['steady_mix'] = steady_mix(
+            port, otps, setup['cashier_ids'], args.duration, args.pollers, args.admins,
+            admin_cookie if app_name != 'app_sqlite' else None,
+            args.poll_interval, args.admin_interval
+        )
+        return result
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the queue app variants')
+    parser.add_argument('--apps', nargs='+', choices=APPS, default=list(APPS))
+    parser.add_argument('--cashiers', type=int, default=4)
+    parser.add_argument('--joins', type=int, default=500, help='Requests in the flash crowd')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent customers in the flash crowd')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of steady traffic')
+    parser.add_argument('--pollers', type=int, default=100, help='Customers polling check_status')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--admins', type=int, default=4, help='Admins refreshing get_cashier_queue')
+    parser.add_argument('--admin-interval', type=float, default=1.0)
+    parser.add_argument('--mongo-uri', help='Benchmark app_mongodb against this mongod instead of mongomock')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--serve', choices=APPS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--no-seed', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.cashiers, args.mongo_uri, seed=not args.no_seed)
+        return
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('serve', 'port', 'no_seed', 'output')},
+        'results': {app_name: run_app(app_name, args) for app_name in args.apps}
+    }
+
+    body = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# company_stats.py - Running per-company queue statistics
+# The manage page reads served/delayed counts and the average wait from
+# aggregates that are incremented whenever a history record is written,
+# instead of scanning the company's whole history on every view. Delayed
+# customers are counted when they are first delayed (record_delay), not
+# when they leave the queue; rebuilds count them from the history records
+# and, for customers still in a queue, from the customers themselves.
+#
+# The per-cashier hourly rollups are the durable record: raw history expires
+# after the retention window (see retention.py) but its rollups stay, so
+# totals and hourly figures can always be rebuilt.
+
+from collections import defaultdict
+
+STAT_FIELDS = ('total_served', 'total_delayed', 'total_wait_seconds')
+
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def history_increments(status, delays, wait_time_seconds, count_delays=True):
+    # How one history record moves the running totals. Live history writes
+    # pass count_delays=False: their delays were counted as they happened.
+    served = status == 'served'
+    return {
+        'total_served': 1 if served else 0,
+        'total_delayed': 1 if count_delays and (delays or 0) > 0 else 0,
+        'total_wait_seconds': (wait_time_seconds or 0) if served else 0
+    }
+
+
+def delay_moment(join_time, complete_from=None):
+    # Hour a rebuild files a queued customer's delay under: when it happened
+    # is not kept, so their join time, or the first hour the rebuild
+    # recomputes when they joined before it (earlier hours keep their rollups)
+    if complete_from is not None and join_time < complete_from:
+        return complete_from
+    return join_time
+
+
+def stats_summary(totals):
+    # Shape used by manage_company.html
+    total_served = totals.get('total_served', 0) if totals else 0
+    total_wait_seconds = totals.get('total_wait_seconds', 0) if totals else 0
+    return {
+        'total_served': total_served,
+        'total_delayed': totals.get('total_delayed', 0) if totals else 0,
+        'avg_wait_time': total_wait_seconds / total_served if total_served else 0
+    }
+
+
+class StatsAccumulator:
+    # Folds history records into per-company, per-company-hour and
+    # per-cashier-hour increments; used for rebuilds and batched history writes
+    def __init__(self):
+        self.totals = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+        self.hourly = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+        self.cashier_hourly = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+
+    def add(self, company_id, cashier_number, status, delays, wait_time_seconds, moment, count_delays=True):
+        self._add(company_id, cashier_number, moment,
+                  history_increments(status, delays, wait_time_seconds, count_delays))
+
+    def add_delay(self, company_id, cashier_number, moment):
+        # A customer delayed for the first time
+        self._add(company_id, cashier_number, moment, {'total_served': 0, 'total_delayed': 1, 'total_wait_seconds': 0})
+
+    def _add(self, company_id, cashier_number, moment, increments):
+        hour = hour_bucket(moment)
+        for bucket in (self.totals[company_id], self.hourly[(company_id, hour)],
+                       self.cashier_hourly[(company_id, cashier_number, hour)]):
+            for field, value in increments.items():
+                bucket[field] += value
+
+    def add_rollup(self, company_id, hour, increments):
+        # A stored per-cashier rollup whose raw records have expired: counts
+        # towards the company figures, the rollup itself is kept as it is
+        for bucket in (self.totals[company_id], self.hourly[(company_id, hour)]):
+            for field in STAT_FIELDS:
+                bucket[field] += increments[field] or 0
+
+    def __bool__(self):
+        return bool(self.totals)
@@ -0,0 +1,220 @@
+# history_archiver.py - Write-behind queue for history records
+# Requests hand finished customers' history records to a bounded in-process
+# queue and return straight away; a background worker writes them in batches
+# (every BATCH_SIZE records or FLUSH_INTERVAL_MS) and drains the rest on exit.
+#
+# When a batch fails, its records are written one at a time. If none of them
+# gets through, the database is taken to be down: the records stay queued
+# and writes back off. A record that keeps failing while others succeed is
+# quarantined to the dead letter after MAX_ATTEMPTS, so it cannot hold up
+# the records behind it. Past MAX_QUEUED, the oldest tenth goes to the dead
+# letter too. The dead letter is an NDJSON file when one is configured (one
+# record per line, to replay later), and the log otherwise.
+
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL_MS = 500
+MAX_PENDING = 10000  # Past this, the submitting request writes the backlog itself
+MAX_QUEUED = 50000   # Hard cap; past this the oldest tenth is dead-lettered
+MAX_ATTEMPTS = 5     # Failed writes of one record, while others succeed, before quarantine
+PROBE_RECORDS = 3    # Single-record writes before a failing batch counts as an outage
+MAX_BACKOFF_SECONDS = 60
+
+
+class HistoryArchiver:
+    def __init__(self, write_batch, batch_size=BATCH_SIZE, interval_ms=FLUSH_INTERVAL_MS,
+                 max_pending=MAX_PENDING, max_queued=MAX_QUEUED, dead_letter=None, logger=None):
+        # write_batch(records) must write every record or raise
+        # dead_letter: path of an NDJSON file for records that cannot be written
+        self._write_batch = write_batch
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000.0
+        self.max_pending = max_pending
+        self.max_queued = max(max_queued, max_pending)
+        self.dead_letter = dead_letter
+        self.logger = logger or logging.getLogger(__name__)
+        self._pending = deque()  # [record, failed attempts]
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # One batch write at a time
+        self._worker = None
+        self._closed = False
+        self._backoff = 0.0
+        self._retry_at = 0.0  # time.monotonic() before which writes are not retried
+
+        # Metrics
+        self.written = 0
+        self.batches = 0
+        self.failed_flushes = 0
+        self.quarantined = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def submit(self, record):
+        overflow = []
+        with self._cond:
+            if self._closed:
+                closed = True
+            else:
+                closed = False
+                self._pending.append([record, 0])
+                if len(self._pending) > self.max_queued:
+                    # Drop a tenth at a time, so an outage logs now and then, not per record
+                    while len(self._pending) > self.max_queued * 0.9:
+                        overflow.append(self._pending.popleft()[0])
+                self._start_worker()
+                if len(self._pending) >= self.batch_size:
+                    self._cond.notify()
+            # While writes are backing off, requests do not pay for another failure
+            backlogged = len(self._pending) >= self.max_pending and time.monotonic() >= self._retry_at
+        if overflow:
+            self.dropped += len(overflow)
+            self._to_dead_letter(overflow, f"the queue is over {self.max_queued} records")
+        if closed:
+            self._write([record])
+        elif backlogged:
+            # Backpressure: the request writes the backlog itself
+            self.flush()
+
+    def flush(self, force=False):
+        # Write everything pending, one batch at a time; returns the number
+        # written. Does nothing while backing off from a failure unless forced.
+        written = 0
+        while True:
+            with self._cond:
+                if not force and time.monotonic() < self._retry_at:
+                    return written
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                return written
+            try:
+                self._write([record for record, _ in batch])
+                written += len(batch)
+                self._backoff = 0.0
+                continue
+            except Exception as e:
+                error = e
+
+            isolated, retry, quarantine = self._write_each(batch)
+            written += isolated
+            with self._cond:
+                self._pending.extendleft(reversed(retry))
+            if quarantine:
+                self.quarantined += len(quarantine)
+                self._to_dead_letter([record for record, _ in quarantine],
+                                     f"they failed {MAX_ATTEMPTS} times: {error}")
+            if not isolated:
+                self._backoff = min(max(self._backoff * 2, self.interval), MAX_BACKOFF_SECONDS)
+                self._retry_at = time.monotonic() + self._backoff
+                self.logger.warning('History write failed, %d records kept, retrying in %.1f s: %s',
+                                    len(self._pending), self._backoff, error)
+                return written
+
+    def close(self, timeout=5):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            worker = self._worker
+        if worker is not None and worker is not threading.current_thread():
+            worker.join(timeout)
+        self.flush(force=True)
+        # Whatever could not be written is not lost with the process
+        with self._cond:
+            remaining = [record for record, _ in self._pending]
+            self._pending.clear()
+        if remaining:
+            self.dropped += len(remaining)
+            self._to_dead_letter(remaining, 'they were still unwritten at shutdown')
+
+    def stats(self):
+        return {
+            'depth': len(self._pending),
+            'max_pending': self.max_pending,
+            'max_queued': self.max_queued,
+            'written': self.written,
+            'batches': self.batches,
+            'failed_flushes': self.failed_flushes,
+            'quarantined': self.quarantined,
+            'dropped': self.dropped,
+            'retry_in_s': round(max(0.0, self._retry_at - time.monotonic()), 1),
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'avg_flush_ms': round(self._total_flush_ms / self.batches, 2) if self.batches else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 2)
+        }
+
+    def _write_each(self, batch):
+        # Find the records a failed batch write choked on. Returns (written,
+        # entries to retry, entries to quarantine).
+        written = 0
+        failed = []
+        for index, entry in enumerate(batch):
+            if not written and index >= PROBE_RECORDS:
+                # Nothing gets through: the database is down, not these records
+                return 0, batch, []
+            try:
+                self._write([entry[0]])
+                written += 1
+            except Exception:
+                failed.append(entry)
+        if not written:
+            return 0, batch, []
+        for entry in failed:
+            entry[1] += 1
+        return (written, [entry for entry in failed if entry[1] < MAX_ATTEMPTS],
+                [entry for entry in failed if entry[1] >= MAX_ATTEMPTS])
+
+    def _to_dead_letter(self, records, reason):
+        self.logger.error('Dead-lettering %d history records because %s', len(records), reason)
+        lines = [json.dumps(record, default=str) for record in records]
+        if self.dead_letter:
+            try:
+                with open(self.dead_letter, 'a', encoding='utf-8') as f:
+                    f.write('\n'.join(lines) + '\n')
+                return
+            except OSError as e:
+                self.logger.error('Could not write the dead letter file %s: %s', self.dead_letter, e)
+        for line in lines:
+            self.logger.error('Dead-lettered history record: %s', line)
+
+    def _write(self, batch):
+        with self._flush_lock:
+            started = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception:
+                self.failed_flushes += 1
+                raise
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.written += len(batch)
+            self.batches += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+    def _start_worker(self):
+        # Started on first use, so importing an app never spawns a thread
+        # (a greenlet under gevent's monkey patching) before the server forks
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='history-archiver', daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.interval
+                while len(self._pending) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            self.flush()
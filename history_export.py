@@ -0,0 +1,76 @@
+# history_export.py - Streaming queue history export shared by the app variants
+# The routes hand over a lazily fetched iterable of history rows (SQLAlchemy
+# yield_per, or a batched pymongo cursor) and this turns it into CSV or NDJSON
+# chunks for a generator response, so an export of any size is sent as it is
+# read, with the header going out before the first query returns.
+
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_FIELDS = ('join_time', 'served_time', 'cashier_number', 'otp', 'status', 'wait_time_seconds', 'delays')
+FETCH_ROWS = 1000  # Rows per database round trip
+CHUNK_ROWS = 500   # Rows per chunk written to the response
+
+
+def parse_range(start, end):
+    # ?from= and ?to= as ISO dates or datetimes; a date-only 'to' includes
+    # that whole day. Returns (start, end) with None for an open side, end
+    # exclusive. Raises ValueError for a malformed value.
+    def parse(value, inclusive_day=False):
+        if not value:
+            return None
+        moment = datetime.fromisoformat(value)
+        if inclusive_day and len(value) == 10:
+            moment += timedelta(days=1)
+        return moment.replace(tzinfo=None)
+    start, end = parse(start), parse(end, inclusive_day=True)
+    if start and end and end <= start:
+        raise ValueError('to must be after from')
+    return start, end
+
+
+def export_filename(company_code, fmt, start=None, end=None):
+    parts = ['queue-history', company_code]
+    if start:
+        parts.append(f"from-{start.date().isoformat()}")
+    if end:
+        parts.append(f"to-{(end - timedelta(microseconds=1)).date().isoformat()}")
+    return '-'.join(parts) + '.' + fmt
+
+
+def export_chunks(rows, fmt):
+    # rows: sequences of values in EXPORT_FIELDS order; yields text chunks
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        yield _drain(buffer)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(['' if value is None else value for value in _values(row)])
+            if count % CHUNK_ROWS == 0:
+                yield _drain(buffer)
+        yield _drain(buffer)
+    else:
+        # The first row goes out alone, so the response starts right away
+        lines = []
+        for count, row in enumerate(rows, 1):
+            lines.append(json.dumps(dict(zip(EXPORT_FIELDS, _values(row)))))
+            if count == 1 or len(lines) >= CHUNK_ROWS:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+
+def _values(row):
+    return [value.isoformat() if isinstance(value, datetime) else value for value in row]
+
+
+def _drain(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
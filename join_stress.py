@@ -0,0 +1,204 @@
+# join_stress.py - Concurrency stress test for join_queue
+# Starts several server processes of one variant on the same database, fires
+# thousands of simultaneous POST /api/join_queue at them, then checks what was
+# stored: every cashier's tickets must be unique and each non-empty queue has
+# exactly one customer at the counter, the one holding the lowest ticket. SQL
+# tickets must also be gap-free (1..n, with n the ticket counter). MongoDB
+# hands back the ticket of a rejected OTP unless another join has taken the
+# next one meanwhile, so its tickets may have gaps, but never past the counter:
+#
+#   python join_stress.py                            # app and app_sqlite
+#   python join_stress.py --apps app --joins 5000 --workers 8
+#   python join_stress.py --apps app_mongodb --mongo-uri mongodb://localhost:27017/join_stress
+#   python join_stress.py --collide                  # most joins retry after an OTP collision
+#
+# The workers share no message bus, so their queue engines are as stale as
+# they can get and only the database counters keep tickets apart. With
+# --collide every worker draws the same OTP sequence, so joins keep hitting
+# codes another worker holds; the retries that follow take the OtpInUse path
+# (rolled back tickets in SQL, spare tickets in MongoDB). Some joins run out of
+# attempts and count as errors.
+# mongomock cannot be shared between processes, so app_mongodb needs a real
+# mongod (and a scratch database, as it is seeded in place).
+# Exits 1 when a check fails.
+
+import argparse
+import importlib
+import json
+import os
+import secrets
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime
+
+from benchmark import APPS, READY_MARKER, flash_crowd, free_port, git_revision
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.py')
+
+
+def start_worker(app_name, args, env, workdir, seed):
+    port = free_port()
+    command = [sys.executable, BENCHMARK, '--serve', app_name,
+               '--port', str(port), '--cashiers', str(args.cashiers)]
+    if args.mongo_uri:
+        command += ['--mongo-uri', args.mongo_uri]
+    if not seed:
+        command.append('--no-seed')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               env=env, cwd=workdir, text=True)
+    for line in process.stdout:
+        if line.startswith(READY_MARKER):
+            return process, port, json.loads(line[len(READY_MARKER):])
+    raise RuntimeError(f"{app_name} worker exited with code {process.wait()}")
+
+
+def stored_queues(app_name, database, setup, mongo_uri):
+    # ({cashier_id: [(ticket, status), ...]}, {cashier_id: counter})
+    queues = {cashier_id: [] for cashier_id in setup['cashier_ids']}
+    if app_name == 'app_mongodb':
+        import pymongo
+        db = pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=5000).get_default_database()
+        for customer in db.customers.find({'cashier_id': {'$in': setup['cashier_ids']}},
+                                          {'cashier_id': 1, 'ticket': 1, 'status': 1}):
+            queues[customer['cashier_id']].append((customer.get('ticket'), customer['status']))
+        counters = {counter['_id']: counter['last_ticket']
+                    for counter in db.ticket_counters.find({'_id': {'$in': setup['cashier_ids']}})}
+        return queues, counters
+
+    connection = sqlite3.connect(database)
+    try:
+        for cashier_id, ticket, status in connection.execute('SELECT cashier_id, ticket, status FROM customer'):
+            queues[cashier_id].append((ticket, status))
+        counters = dict(connection.execute('SELECT id, last_ticket FROM cashier'))
+    finally:
+        connection.close()
+    return queues, counters
+
+
+def check(queues, counters, otps, gap_free=True):
+    failures = []
+    reissued = [otp for otp, count in Counter(otps).items() if count > 1]
+    if reissued:
+        failures.append(f"{len(reissued)} OTPs handed to more than one customer")
+    stored = sum(len(customers) for customers in queues.values())
+    if stored < len(otps):
+        failures.append(f"{len(otps)} joins accepted but only {stored} customers stored")
+
+    for cashier_id, customers in queues.items():
+        tickets = sorted(ticket for ticket, _ in customers)
+        duplicates = sum(count - 1 for count in Counter(tickets).values() if count > 1)
+        if duplicates:
+            failures.append(f"cashier {cashier_id}: {duplicates} duplicate tickets")
+        if gap_free and tickets != list(range(1, len(tickets) + 1)):
+            failures.append(f"cashier {cashier_id}: tickets are not 1..{len(tickets)} "
+                            f"(highest {tickets[-1] if tickets else None})")
+        counter = counters.get(cashier_id, 0)
+        if counter != len(tickets) if gap_free else tickets and counter < tickets[-1]:
+            failures.append(f"cashier {cashier_id}: counter is {counter}, "
+                            f"{len(tickets)} tickets stored, highest {tickets[-1] if tickets else None}")
+        serving = [ticket for ticket, status in customers if status == 'serving']
+        if customers and serving != tickets[:1]:
+            failures.append(f"cashier {cashier_id}: customers at the counter hold tickets {serving}, "
+                            f"expected {tickets[:1]}")
+    return failures
+
+
+def run_app(app_name, args):
+    import gevent
+    workdir = tempfile.mkdtemp(prefix=f"stress-{app_name}-")
+    database = os.path.join(workdir, 'stress.db')
+    env = dict(os.environ)
+    env['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{database}"
+    env['QR_CACHE_DIR'] = os.path.join(workdir, 'qr_cache')
+    env['MONGO_INDEXES'] = 'startup'
+    env.pop('MESSAGE_BUS_URL', None)
+    if args.collide:
+        env['BENCH_OTP_KEY'] = secrets.token_hex(16)
+    workers = []
+    try:
+        # The first worker creates and seeds the database; the rest join it
+        process, port, setup = start_worker(app_name, args, env, workdir, seed=True)
+        workers.append((process, port))
+        for _ in range(args.workers - 1):
+            process, port, _ = start_worker(app_name, args, env, workdir, seed=False)
+            workers.append((process, port))
+        for process, _ in workers:
+            gevent.spawn(process.stdout.read)
+
+        # The crowd is split evenly over the workers, all at once
+        share, extra = divmod(args.joins, len(workers))
+        crowds = [gevent.spawn(flash_crowd, port, share + (1 if index < extra else 0), args.concurrency)
+                  for index, (_, port) in enumerate(workers)]
+        gevent.joinall(crowds)
+        otps = [otp for crowd in crowds for otp in crowd.value[1]]
+        errors = sum(crowd.value[0]['total']['errors'] for crowd in crowds)
+
+        queues, counters = stored_queues(app_name, database, setup, args.mongo_uri)
+        return {
+            'accepted': len(otps),
+            'errors': errors,
+            'queue_lengths': sorted(len(customers) for customers in queues.values()),
+            'failures': check(queues, counters, otps, gap_free=app_name != 'app_mongodb')
+        }
+    except RuntimeError as e:
+        return {'failures': [str(e)]}
+    finally:
+        for process, _ in workers:
+            process.terminate()
+        for process, _ in workers:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress join_queue with simultaneous joins across workers')
+    parser.add_argument('--apps', nargs='+', choices=APPS)
+    parser.add_argument('--joins', type=int, default=2000, help='Joins fired in total')
+    parser.add_argument('--workers', type=int, default=4, help='Server processes sharing the database')
+    parser.add_argument('--concurrency', type=int, default=50, help='Simultaneous customers per worker')
+    parser.add_argument('--cashiers', type=int, default=4)
+    parser.add_argument('--mongo-uri', help='Scratch MongoDB database for app_mongodb')
+    parser.add_argument('--collide', action='store_true', help='Give every worker the same OTP sequence')
+    parser.add_argument('--json', action='store_true', help='Print the full report as JSON')
+    args = parser.parse_args()
+
+    apps = args.apps or [app_name for app_name in APPS if app_name != 'app_mongodb' or args.mongo_uri]
+    if 'app_mongodb' in apps:
+        if not args.mongo_uri:
+            parser.error('app_mongodb needs --mongo-uri; mongomock cannot be shared between workers')
+        # Imported before patching, as in benchmark.serve
+        importlib.import_module('pymongo')
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'parameters': {key: value for key, value in vars(args).items() if key != 'json'},
+        'results': {app_name: run_app(app_name, args) for app_name in apps}
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+    failed = False
+    for app_name, result in report['results'].items():
+        if result['failures']:
+            failed = True
+            for failure in result['failures']:
+                print(f"{app_name}: FAILED: {failure}")
+        else:
+            print(f"{app_name}: {result['accepted']} joins over {args.workers} workers, "
+                  f"{result['errors']} errors, tickets ok")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
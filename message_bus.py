@@ -0,0 +1,179 @@
+# message_bus.py - Cross-worker messaging shared by all app variants
+# With MESSAGE_BUS_URL set, Socket.IO emits and local-state invalidations are
+# published on a bus so every worker (and node) sees them:
+#   redis://host:6379/0  - Redis or any Redis-compatible broker (needs `redis`)
+#   local://name         - in-process stand-in; apps in one process share it
+# Without it the app runs as a single worker, exactly as before.
+#
+# Messages are JSON on the wire, so a broker shared with other clients can
+# never make a worker run code. If a subscription fails (the broker restarts
+# or the connection drops) it is logged and taken again with backoff; messages
+# published while it is down are lost, and the queue_changed and
+# cache_invalidated ones only cost a stale read until the next change.
+
+import json
+import logging
+import uuid
+
+import gevent
+from gevent.queue import Queue
+from socketio import PubSubManager
+
+SYNC_CHANNEL = 'virtual-queue'
+RECONNECT_MIN_SECONDS = 0.5
+RECONNECT_MAX_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+_local_buses = {}
+
+
+class LocalBus:
+    # Fan-out between subscribers in this process, for tests and development
+    def __init__(self):
+        self._subscribers = {}  # channel -> [Queue]
+
+    def publish(self, channel, message):
+        for subscriber in list(self._subscribers.get(channel, ())):
+            subscriber.put(message)
+
+    def listen(self, channel):
+        # Subscribes right away, so nothing published after this call is missed
+        subscriber = Queue()
+        self._subscribers.setdefault(channel, []).append(subscriber)
+        return self._drain(subscriber)
+
+    def _drain(self, subscriber):
+        while True:
+            yield subscriber.get()
+
+
+class RedisBus:
+    def __init__(self, url):
+        # Optional dependency, only needed when a Redis bus is configured
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, message):
+        self._redis.publish(channel, json.dumps(message))
+
+    def listen(self, channel):
+        # Subscribes right away like LocalBus; raises once the connection drops
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return self._drain(pubsub, channel)
+
+    def _drain(self, pubsub, channel):
+        try:
+            for message in pubsub.listen():
+                try:
+                    yield json.loads(message['data'])
+                except ValueError:
+                    logger.warning('Ignoring a message that is not JSON on %s', channel)
+        finally:
+            pubsub.close()
+
+
+def create_bus(url):
+    if not url:
+        return None
+    if url.startswith('local://'):
+        name = url[len('local://'):]
+        if name not in _local_buses:
+            _local_buses[name] = LocalBus()
+        return _local_buses[name]
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBus(url)
+    raise ValueError(f"Unsupported MESSAGE_BUS_URL: {url}")
+
+
+def subscribe(bus, channel):
+    # Messages on channel for as long as the worker runs: a subscription that
+    # fails is logged and taken again, backing off up to RECONNECT_MAX_SECONDS.
+    # The first subscription is taken before this returns.
+    return _resubscribing(bus, channel, bus.listen(channel))
+
+
+def _resubscribing(bus, channel, messages):
+    delay = RECONNECT_MIN_SECONDS
+    while True:
+        try:
+            if messages is None:
+                messages = bus.listen(channel)
+            for message in messages:
+                delay = RECONNECT_MIN_SECONDS
+                yield message
+            error = 'the subscription ended'
+        except Exception as e:
+            error = e
+        logger.error('Lost the message bus subscription to %s, retrying in %.1f s: %s', channel, delay, error)
+        messages = None
+        gevent.sleep(delay)
+        delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+
+class BusManager(PubSubManager):
+    # Socket.IO client manager that relays emits over the bus, so an emit in
+    # one worker reaches clients connected to any other
+    name = 'bus'
+
+    def __init__(self, bus, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.bus = bus
+        self._messages = None
+
+    def initialize(self):
+        # Subscribe before the listener task first runs; a second call (the
+        # Socket.IO test client makes one) must not start a second listener
+        if self._messages is not None:
+            return
+        self._messages = subscribe(self.bus, self.channel)
+        super().initialize()
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, data)
+
+    def _listen(self):
+        yield from self._messages
+
+
+class ClusterSync:
+    # Replays another worker's local-state changes (queue writes, cache
+    # invalidations) in this one. A no-op without a bus.
+    def __init__(self, bus):
+        self.bus = bus
+        self.origin = uuid.uuid4().hex
+        self._handlers = {}
+        self._started = False
+        self._app = None
+
+    def on(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def publish(self, kind, **payload):
+        if self.bus is not None:
+            self.bus.publish(SYNC_CHANNEL, {'kind': kind, 'origin': self.origin, 'payload': payload})
+
+    def start(self, socketio, app=None):
+        # With a Flask app, handlers run in its app context, since the
+        # background task has none of its own and they may use db.session
+        if self.bus is not None and not self._started:
+            self._started = True
+            self._app = app
+            socketio.start_background_task(self._run, subscribe(self.bus, SYNC_CHANNEL))
+
+    def _run(self, messages):
+        for message in messages:
+            if message.get('origin') == self.origin:
+                continue
+            handler = self._handlers.get(message.get('kind'))
+            if handler is None:
+                continue
+            try:
+                if self._app is None:
+                    handler(**message['payload'])
+                else:
+                    with self._app.app_context():
+                        handler(**message['payload'])
+            except Exception:
+                logger.exception('Could not apply %s from another worker', message.get('kind'))
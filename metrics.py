@@ -0,0 +1,276 @@
+# metrics.py - Prometheus text-format metrics shared by all app variants
+# Request latency and DB operations are recorded as requests finish; cache and
+# Socket.IO figures are read from their owners when /metrics is scraped.
+# Figures are per process, so scrape every worker.
+#
+# No locks: under the gevent worker every greenlet runs on one thread and
+# these updates never yield, so they cannot interleave.
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+from realtime import room_stats
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_OPS_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+RATE_WINDOW = 60  # Seconds averaged by the emitted-events-per-second gauge
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+
+
+class _RateWindow:
+    # Per-second counts for the last `seconds` seconds, in a ring
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.stamps = [0] * seconds
+        self.counts = [0] * seconds
+
+    def add(self, now, amount=1):
+        second = int(now)
+        slot = second % self.seconds
+        if self.stamps[slot] != second:
+            self.stamps[slot] = second
+            self.counts[slot] = 0
+        self.counts[slot] += amount
+
+    def rate(self, now):
+        # Completed seconds only, so a scrape early in a second reads no dip
+        second = int(now)
+        total = sum(count for stamp, count in zip(self.stamps, self.counts)
+                    if second - self.seconds <= stamp < second)
+        return total / self.seconds
+
+
+class AppMetrics:
+    def __init__(self, prefix='virtual_queue'):
+        self.prefix = prefix
+        self.in_flight = 0
+        self.requests = {}      # (method, route, status) -> count
+        self.latency = {}       # (method, route) -> _Histogram
+        self.db_per_request = {}  # (method, route) -> _Histogram
+        self.db_operations = {}   # (backend, operation) -> count
+        self.emitted = {}       # event -> count
+        self._emit_rate = _RateWindow(RATE_WINDOW)
+        self._socketio = None
+        self._cache = None
+        self._budgets = []  # Open query_budget() counters
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._end_request)
+
+    def watch_sqlalchemy(self, engine):
+        # Counts every statement the engine runs, by its leading keyword
+        from sqlalchemy import event
+
+        backend = engine.dialect.name
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            self.count_db_operation(backend, statement.lstrip().split(None, 1)[0].lower())
+
+    def watch_pymongo(self):
+        # Must run before the MongoClient is created; listeners registered
+        # later do not apply to existing clients
+        from pymongo import monitoring
+
+        metrics = self
+
+        class CommandCounter(monitoring.CommandListener):
+            def started(self, event):
+                metrics.count_db_operation('mongodb', event.command_name)
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        monitoring.register(CommandCounter())
+
+    def watch_socketio(self, socketio):
+        # Counts emits by event name; flask_socketio.emit() inside handlers
+        # goes through socketio.emit as well
+        self._socketio = socketio
+        emit = socketio.emit
+
+        def counted_emit(event, *args, **kwargs):
+            self.emitted[event] = self.emitted.get(event, 0) + 1
+            self._emit_rate.add(time.time())
+            return emit(event, *args, **kwargs)
+
+        socketio.emit = counted_emit
+
+    def watch_cache(self, cache):
+        self._cache = cache
+
+    def count_db_operation(self, backend, operation):
+        key = (backend, operation)
+        self.db_operations[key] = self.db_operations.get(key, 0) + 1
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_db_operations += 1
+        if self._budgets:
+            ident = threading.get_ident()
+            for budget in self._budgets:
+                if budget['thread'] == ident:
+                    budget['operations'].append(key)
+
+    @contextmanager
+    def query_budget(self, limit, label='block'):
+        # Counts the DB operations the block issues on this thread (or
+        # greenlet), so background history writes are left out, and raises
+        # QueryBudgetExceeded past the limit:
+        #
+        #   with app_metrics.query_budget(4, 'check_status') as used:
+        #       client.get('/api/check_status/123456')
+        #   used['operations']  # [(backend, operation), ...]
+        budget = {'thread': threading.get_ident(), 'limit': limit, 'operations': []}
+        self._budgets.append(budget)
+        try:
+            yield budget
+        finally:
+            self._budgets.remove(budget)
+        used = len(budget['operations'])
+        if used > limit:
+            issued = ', '.join(operation for backend, operation in budget['operations'])
+            raise QueryBudgetExceeded(f"{label} issued {used} database operations, budget is {limit}: {issued}")
+
+    def _start_request(self):
+        self.in_flight += 1
+        g.metrics_start = time.perf_counter()
+        g.metrics_db_operations = 0
+
+    def _finish_request(self, response):
+        if 'metrics_start' in g:
+            elapsed = time.perf_counter() - g.metrics_start
+            # The URL rule, not the path, keeps OTPs and ids out of the labels
+            route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+            key = (request.method, route)
+            status_key = key + (str(response.status_code),)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            if key not in self.latency:
+                self.latency[key] = _Histogram(LATENCY_BUCKETS)
+                self.db_per_request[key] = _Histogram(DB_OPS_BUCKETS)
+            self.latency[key].observe(elapsed)
+            self.db_per_request[key].observe(g.metrics_db_operations)
+        return response
+
+    def _end_request(self, exc):
+        if g.pop('metrics_start', None) is not None:
+            self.in_flight -= 1
+
+    def render(self):
+        lines = []
+        p = self.prefix
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+
+        def sample(name, labels, value):
+            lines.append(f"{p}_{name}{_labels(labels)} {_number(value)}")
+
+        def histogram(name, help_text, histograms):
+            family(name, 'histogram', help_text)
+            for (method, route), hist in list(histograms.items()):
+                labels = {'method': method, 'route': route}
+                cumulative = 0
+                for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                    cumulative += count
+                    sample(f"{name}_bucket", dict(labels, le=_number(bound)), cumulative)
+                sample(f"{name}_sum", labels, hist.sum)
+                sample(f"{name}_count", labels, cumulative)
+
+        family('http_requests_in_flight', 'gauge', 'Requests currently being handled.')
+        sample('http_requests_in_flight', {}, self.in_flight)
+
+        family('http_requests_total', 'counter', 'Finished requests by route and status.')
+        for (method, route, status), count in list(self.requests.items()):
+            sample('http_requests_total', {'method': method, 'route': route, 'status': status}, count)
+
+        histogram('http_request_duration_seconds', 'Request latency by route.', self.latency)
+        histogram('db_operations_per_request', 'Database operations issued per request.', self.db_per_request)
+
+        family('db_operations_total', 'counter', 'Database operations, including background writes.')
+        for (backend, operation), count in list(self.db_operations.items()):
+            sample('db_operations_total', {'backend': backend, 'operation': operation}, count)
+
+        if self._cache is not None:
+            stats = self._cache.stats()
+            family('cache_hits_total', 'counter', 'Lookup cache hits.')
+            for name, namespace in stats.items():
+                sample('cache_hits_total', {'namespace': name}, namespace['hits'])
+            family('cache_misses_total', 'counter', 'Lookup cache misses.')
+            for name, namespace in stats.items():
+                sample('cache_misses_total', {'namespace': name}, namespace['misses'])
+            family('cache_hit_ratio', 'gauge', 'Share of lookups served from the cache since start.')
+            for name, namespace in stats.items():
+                lookups = namespace['hits'] + namespace['misses']
+                sample('cache_hit_ratio', {'namespace': name}, namespace['hits'] / lookups if lookups else 0)
+            family('cache_entries', 'gauge', 'Entries held in the lookup cache.')
+            for name, namespace in stats.items():
+                sample('cache_entries', {'namespace': name}, namespace['size'])
+
+        if self._socketio is not None:
+            namespaces = list(self._socketio.server.manager.rooms) or ['/']
+            rooms = {namespace: room_stats(self._socketio, namespace) for namespace in namespaces}
+            family('socketio_clients', 'gauge', 'Connected Socket.IO clients by namespace.')
+            for namespace, stats in rooms.items():
+                sample('socketio_clients', {'namespace': namespace}, stats['connections'])
+            # Room names carry OTPs, so rooms are reported by kind
+            family('socketio_rooms', 'gauge', 'Open Socket.IO rooms by kind.')
+            for namespace, stats in rooms.items():
+                for kind, room in stats['rooms'].items():
+                    sample('socketio_rooms', {'namespace': namespace, 'kind': kind}, room['rooms'])
+            family('socketio_room_members', 'gauge', 'Clients in Socket.IO rooms by kind.')
+            for namespace, stats in rooms.items():
+                for kind, room in stats['rooms'].items():
+                    sample('socketio_room_members', {'namespace': namespace, 'kind': kind}, room['members'])
+
+            family('socketio_events_emitted_total', 'counter', 'Socket.IO events emitted by this worker.')
+            for event, count in list(self.emitted.items()):
+                sample('socketio_events_emitted_total', {'event': event}, count)
+            family('socketio_events_emitted_per_second', 'gauge',
+                   f"Events emitted per second over the last {RATE_WINDOW} seconds.")
+            sample('socketio_events_emitted_per_second', {}, self._emit_rate.rate(time.time()))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return value if isinstance(value, str) else repr(value)
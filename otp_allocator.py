@@ -0,0 +1,67 @@
+# otp_allocator.py - O(1) OTP allocation shared by all app variants
+# Fresh codes are drawn by walking a keyed pseudo-random permutation of the
+# whole code space, so no code repeats and nothing needs to be looked up.
+# Codes released by finished customers are recycled after a quarantine.
+# Uniqueness is still enforced by the database: callers insert and retry with
+# another code on a unique-constraint violation instead of checking first.
+
+import hashlib
+import secrets
+import threading
+from collections import deque
+
+OTP_DIGITS = 6
+FEISTEL_ROUNDS = 4
+RECYCLE_QUARANTINE = 1000  # Released codes wait behind this many others
+
+
+class OtpAllocator:
+    def __init__(self, digits=OTP_DIGITS, quarantine=RECYCLE_QUARANTINE):
+        self.digits = digits
+        self.space = 10 ** digits
+        self.quarantine = quarantine
+        self._lock = threading.Lock()
+        self._released = deque()
+        self._cursor = 0
+        # Smallest even bit width whose square covers the code space
+        self._half_bits = (max(self.space - 1, 1).bit_length() + 1) // 2
+        self._half_mask = (1 << self._half_bits) - 1
+        self._key = secrets.token_bytes(16)
+
+    def allocate(self):
+        with self._lock:
+            if self._released and (len(self._released) > self.quarantine or self._cursor >= self.space):
+                return self._released.popleft()
+            if self._cursor >= self.space:
+                # Every code has been handed out and none released yet; the
+                # database will reject any code that is still in use
+                self._cursor = 0
+            index = self._cursor
+            self._cursor += 1
+        return str(self._permute(index)).zfill(self.digits)
+
+    def release(self, otp):
+        # Return a finished customer's code to the pool
+        if otp:
+            with self._lock:
+                self._released.append(otp)
+
+    def _permute(self, index):
+        # Feistel network over 2 * half_bits, cycle-walking until the result
+        # lands inside the code space; a bijection on [0, space)
+        value = index
+        while True:
+            value = self._feistel(value)
+            if value < self.space:
+                return value
+
+    def _feistel(self, value):
+        left, right = value >> self._half_bits, value & self._half_mask
+        for round_number in range(FEISTEL_ROUNDS):
+            digest = hashlib.blake2b(
+                right.to_bytes(4, 'big') + bytes([round_number]),
+                key=self._key,
+                digest_size=4
+            ).digest()
+            left, right = right, left ^ (int.from_bytes(digest, 'big') & self._half_mask)
+        return (left << self._half_bits) | right
@@ -0,0 +1,150 @@
+# provisioning.py - Bulk company provisioning from CSV or NDJSON
+# Rows are read lazily and written in batches, so memory stays flat however
+# long the file is. Each batch costs one lookup for company code collisions
+# and one bulk insert each for companies, cashiers and stats; the app
+# variants supply those two operations. Shared by the provision-companies CLI
+# command and the /api/provision_companies route.
+#
+# Input, one company per row or line:
+#   CSV     name,service_type,cashiers
+#   NDJSON  {"name": "...", "service_type": "...", "cashiers": 4}
+#
+# Output is one dict per row, in input order: {'line', 'company_id',
+# 'company_code', 'cashiers'} or {'line', 'error'}, then a summary dict.
+
+import csv
+import json
+import secrets
+import string
+
+FORMATS = ('csv', 'ndjson')
+BATCH_SIZE = 500
+MAX_CASHIERS = 50      # Same limit as the create company form
+MAX_FIELD_LENGTH = 100  # Company.name and Company.service_type columns
+CODE_LENGTH = 6
+CODE_ATTEMPTS = 5      # Rounds of fresh codes for rows whose code was taken
+
+
+def detect_format(filename=None, content_type=None):
+    # 'csv' or 'ndjson' from a file name or content type; None when unknown
+    filename = (filename or '').lower()
+    content_type = (content_type or '').split(';', 1)[0].strip().lower()
+    if filename.endswith(('.ndjson', '.jsonl')) or content_type in ('application/x-ndjson', 'application/jsonl'):
+        return 'ndjson'
+    if filename.endswith('.csv') or content_type in ('text/csv', 'application/csv'):
+        return 'csv'
+    return None
+
+
+def generate_company_code():
+    letters = string.ascii_uppercase
+    return ''.join(secrets.choice(letters) for _ in range(CODE_LENGTH))
+
+
+def validate(row):
+    # Normalized company dict, or raises ValueError
+    if not isinstance(row, dict):
+        raise ValueError('expected an object with name, service_type and cashiers')
+    values = {}
+    for field in ('name', 'service_type'):
+        value = str(row.get(field) or '').strip()
+        if not value:
+            raise ValueError(f"{field} is required")
+        if len(value) > MAX_FIELD_LENGTH:
+            raise ValueError(f"{field} is longer than {MAX_FIELD_LENGTH} characters")
+        values[field] = value
+    cashiers = row.get('cashiers', row.get('num_cashiers'))
+    try:
+        cashiers = int(cashiers)
+    except (TypeError, ValueError):
+        raise ValueError('cashiers must be a whole number')
+    if not 1 <= cashiers <= MAX_CASHIERS:
+        raise ValueError(f"cashiers must be between 1 and {MAX_CASHIERS}")
+    values['cashiers'] = cashiers
+    return values
+
+
+def read_companies(stream, fmt):
+    # Yields (line, company dict) or (line, error message) for a text stream
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            try:
+                yield reader.line_num, validate(row)
+            except ValueError as e:
+                yield reader.line_num, str(e)
+    elif fmt == 'ndjson':
+        for line, text in enumerate(stream, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                yield line, f"invalid JSON: {e}"
+                continue
+            try:
+                yield line, validate(row)
+            except ValueError as e:
+                yield line, str(e)
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+
+
+def provision(stream, fmt, taken_codes, create_companies, batch_size=BATCH_SIZE):
+    # taken_codes(codes) -> the subset already in use
+    # create_companies(companies) -> a company id per company, in order, or
+    #     None where its company_code turned out to be taken; each company
+    #     dict carries name, service_type, cashiers and company_code
+    summary = {'companies': 0, 'cashiers': 0, 'errors': 0}
+    batch = []  # (line, company dict or error message)
+    for line, company in read_companies(stream, fmt):
+        batch.append((line, company))
+        if len(batch) >= batch_size:
+            yield from _write_batch(batch, taken_codes, create_companies, summary)
+            batch = []
+    if batch:
+        yield from _write_batch(batch, taken_codes, create_companies, summary)
+    yield {'summary': summary}
+
+
+def _write_batch(batch, taken_codes, create_companies, summary):
+    results = {line: {'line': line, 'error': company} for line, company in batch if isinstance(company, str)}
+    pending = [(line, company) for line, company in batch if line not in results]
+    for attempt in range(CODE_ATTEMPTS):
+        if not pending:
+            break
+        codes = _unique_codes(len(pending), taken_codes)
+        companies = [dict(company, company_code=code) for (_, company), code in zip(pending, codes)]
+        company_ids = create_companies(companies)
+        retry = []
+        for (line, company), created, company_id in zip(pending, companies, company_ids):
+            if company_id is None:
+                retry.append((line, company))
+            else:
+                results[line] = {'line': line, 'company_id': company_id,
+                                 'company_code': created['company_code'], 'cashiers': company['cashiers']}
+        pending = retry
+    for line, _ in pending:
+        results[line] = {'line': line, 'error': 'could not allocate a unique company code'}
+
+    for line, _ in batch:
+        result = results[line]
+        if 'error' in result:
+            summary['errors'] += 1
+        else:
+            summary['companies'] += 1
+            summary['cashiers'] += result['cashiers']
+        yield result
+
+
+def _unique_codes(count, taken_codes):
+    # count distinct codes, none of them in use; one lookup per round
+    codes = set()
+    while len(codes) < count:
+        candidates = set()
+        while len(codes) + len(candidates) < count:
+            code = generate_company_code()
+            if code not in codes:
+                candidates.add(code)
+        codes |= candidates - set(taken_codes(list(candidates)))
+    return list(codes)
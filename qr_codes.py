@@ -0,0 +1,175 @@
+# qr_codes.py - Cached QR code rendering shared by all app variants
+# A QR code only depends on the base URL and company code, so each image is
+# rendered once, kept in a bounded in-memory LRU backed by a content-addressed
+# directory on disk, and served with a strong ETag derived from its key.
+# The disk tier is bounded too: past max_files, the least recently read
+# files are deleted.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+QR_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml'
+}
+
+# Bump when the QR styling changes so cached files and ETags roll over
+RENDER_VERSION = 1
+DISK_MAX_FILES = 10000
+DISK_EVICT_TO = 0.9  # Evict down to this fraction of max_files
+
+
+def base_url(public_url, host_url):
+    # The configured PUBLIC_URL, or else the request's host URL. The Host
+    # header is client-controlled, so deployments should set PUBLIC_URL.
+    url = public_url or host_url
+    return url if url.endswith('/') else url + '/'
+
+
+def join_url(host_url, company_code):
+    return f"{host_url}join/{company_code}"
+
+
+def render_qr(data, fmt='png'):
+    # qrcode and PIL are heavy, so they are only imported when something is rendered
+    import qrcode
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    buffered = BytesIO()
+    if fmt == 'svg':
+        from qrcode.image.svg import SvgPathImage
+        qr.make_image(image_factory=SvgPathImage).save(buffered)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffered)
+    return buffered.getvalue()
+
+
+def _render_job(job):
+    # Module-level so it can be pickled into a process pool
+    host_url, company_code, fmt = job
+    return render_qr(join_url(host_url, company_code), fmt)
+
+
+class QRCodeCache:
+    def __init__(self, max_entries=512, cache_dir=None, max_files=DISK_MAX_FILES):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> image bytes, least recently used first
+        self._files = None  # Files in cache_dir, counted on the first write
+
+    def key(self, host_url, company_code, fmt):
+        # Content address: the same key always renders the same image
+        raw = f"{RENDER_VERSION}|{host_url}|{company_code}|{fmt}".encode('utf-8')
+        return hashlib.sha256(raw).hexdigest()
+
+    def contains(self, key, fmt):
+        return key in self._entries or (self.cache_dir is not None and os.path.exists(self._path(key, fmt)))
+
+    def get(self, host_url, company_code, fmt='png'):
+        key = self.key(host_url, company_code, fmt)
+
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                return body
+
+        body = self._read(key, fmt)
+        if body is None:
+            body = render_qr(join_url(host_url, company_code), fmt)
+            self._write(key, fmt, body)
+        self._remember(key, body)
+        return body
+
+    def prerender(self, host_url, company_codes, fmt='png', workers=None):
+        # Bulk mode: render every missing code in a process pool and store it
+        # on disk (and in memory) so first page views are served from cache.
+        # company_codes may be any iterable, e.g. a streaming database cursor.
+        rendered = 0
+        batch = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for company_code in company_codes:
+                if not self.contains(self.key(host_url, company_code, fmt), fmt):
+                    batch.append((host_url, company_code, fmt))
+                if len(batch) >= 256:
+                    rendered += self._store_batch(pool, batch)
+                    batch = []
+            if batch:
+                rendered += self._store_batch(pool, batch)
+        return rendered
+
+    def _store_batch(self, pool, batch):
+        for job, body in zip(batch, pool.map(_render_job, batch, chunksize=16)):
+            key = self.key(*job)
+            self._write(key, job[2], body)
+            self._remember(key, body)
+        return len(batch)
+
+    def _remember(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key, fmt):
+        return os.path.join(self.cache_dir, f"{key}.{fmt}")
+
+    def _read(self, key, fmt):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(key, fmt), 'rb') as f:
+                body = f.read()
+            # The modification time orders files for eviction
+            os.utime(self._path(key, fmt))
+            return body
+        except OSError:
+            return None
+
+    def _write(self, key, fmt, body):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{self._path(key, fmt)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, self._path(key, fmt))
+            with self._lock:
+                self._files = len(self._listing()) if self._files is None else self._files + 1
+                if self._files > self.max_files:
+                    self._evict()
+        except OSError:
+            # The disk tier is only an optimization
+            pass
+
+    def _listing(self):
+        return [entry for entry in os.scandir(self.cache_dir)
+                if entry.is_file() and not entry.name.endswith('.tmp')]
+
+    def _evict(self):
+        # Delete the least recently read files. Other processes share the
+        # directory, so the count is taken again from the listing.
+        entries = sorted(self._listing(), key=lambda entry: entry.stat().st_mtime)
+        keep = int(self.max_files * DISK_EVICT_TO)
+        for entry in entries[:max(0, len(entries) - keep)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self._files = min(len(entries), keep)
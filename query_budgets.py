@@ -0,0 +1,38 @@
+# query_budgets.py - Database operation budgets for the hot routes
+# Runs tests/test_query_budgets.py, which checks each hot route against its
+# pinned budget of SQL statements or MongoDB commands (see BUDGETS there):
+#
+#   python query_budgets.py                      # every variant, app_mongodb on mongomock
+#   python query_budgets.py --apps app app_sqlite
+#   python query_budgets.py --apps app_mongodb --mongo-uri mongodb://localhost:27017/budgets
+#
+# --mongo-uri runs app_mongodb against a real server (a scratch database, as it
+# is seeded in place) instead of mongomock. Extra arguments go to pytest.
+# Exits non-zero when a route is over budget or fails.
+
+import argparse
+import os
+import sys
+
+import pytest
+
+from benchmark import APPS
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'test_query_budgets.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the hot routes against their query budgets')
+    parser.add_argument('--apps', nargs='+', choices=APPS)
+    parser.add_argument('--mongo-uri', help='Scratch MongoDB database for app_mongodb')
+    args, pytest_args = parser.parse_known_args()
+
+    if args.mongo_uri:
+        os.environ['TEST_MONGODB_URI'] = args.mongo_uri
+    if args.apps:
+        pytest_args += ['-k', ' or '.join(f"{app_name}-" for app_name in args.apps)]
+    sys.exit(pytest.main([TESTS, '-q'] + pytest_args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# queue_engine.py - In-process queue engine shared by all app variants
+# Keeps every cashier's queue in memory so join_queue can pick a cashier
+# under the company's routing policy (routing.py) without counting rows; the
+# database is written through by the caller.
+#
+# Policies that rank by service time read estimates kept here. They are
+# fetched with service_time(), which may query the database, and never under
+# the lock: when a company loads or changes policy, on the first join of
+# each hour (profiles are per hour), and on refresh_estimates() after a serve.
+
+import heapq
+import threading
+import time
+import uuid
+from collections import deque
+
+from routing import DEFAULT_POLICY, ROUTING_POLICIES, SERVICE_TIME_POLICIES, validate_policy
+from wait_estimator import DEFAULT_SERVICE_SECONDS
+
+# Customers still holding a place (and an OTP) in a queue
+ACTIVE_STATUSES = ('waiting', 'serving', 'delayed')
+
+
+class CashierQueue:
+    def __init__(self, cashier_id, cashier_number, is_active=True):
+        self.cashier_id = cashier_id
+        self.cashier_number = cashier_number
+        self.is_active = is_active
+        self.waiting = deque()  # OTPs of waiting customers, in queue order
+        self.serving = None     # OTP of the customer at the counter
+        self.last_assigned = 0  # Join sequence of the last customer routed here
+        self.stamp = 0          # Bumped on every change; heap entries carry it
+
+    def __len__(self):
+        # The customer at the counter still occupies the queue
+        return len(self.waiting) + (1 if self.serving is not None else 0)
+
+
+class QueueEngine:
+    def __init__(self, service_time=None):
+        # service_time(cashier_id) -> expected seconds per customer, for the
+        # shortest-expected-completion policy
+        self._service_time = service_time or (lambda cashier_id: DEFAULT_SERVICE_SECONDS)
+        self._lock = threading.RLock()
+        self._queues = {}    # company_key -> {cashier_id: CashierQueue}
+        self._policies = {}  # company_key -> routing policy name
+        self._heaps = {}     # company_key -> [(rank, last_assigned, cashier_number, stamp, cashier_id)]
+        self._estimates = {}       # company_key -> {cashier_id: seconds} as service_time() gave them
+        self._service_times = {}   # company_key -> {cashier_id: seconds} with the gaps filled in
+        self._estimate_hours = {}  # company_key -> hour the estimates were fetched in
+        self._sequence = 0   # Joins routed so far, for round-robin and ties
+        # Per-company change counters; they survive invalidate(). Versions are
+        # "<epoch>-<count>" with a random epoch per engine, so two workers or
+        # restarts never hand out the same version for different snapshots.
+        self._versions = {}
+        self.epoch = uuid.uuid4().hex[:12]
+
+    def is_loaded(self, company_key):
+        return company_key in self._queues
+
+    def load(self, company_key, cashiers, customers, policy=DEFAULT_POLICY):
+        # cashiers: iterable of (cashier_id, cashier_number, is_active)
+        # customers: iterable of (cashier_id, otp, status) ordered by ticket
+        # policy: routing policy name; unknown names get the default
+        queues = {}
+        for cashier_id, cashier_number, is_active in cashiers:
+            queues[cashier_id] = CashierQueue(cashier_id, cashier_number, is_active)
+
+        for cashier_id, otp, status in customers:
+            queue = queues.get(cashier_id)
+            if queue is None:
+                continue
+            if status == 'serving':
+                queue.serving = otp
+            else:
+                queue.waiting.append(otp)
+
+        policy = policy if policy in ROUTING_POLICIES else DEFAULT_POLICY
+        estimates = self._fetch_estimates(queues, policy)
+        with self._lock:
+            self._queues[company_key] = queues
+            self._policies[company_key] = policy
+            self._set_estimates(company_key, estimates, replace=True)
+            self._rebuild_heap(company_key)
+
+    def invalidate(self, company_key=None):
+        # Drop cached state so the next access reloads it from the database
+        with self._lock:
+            for cached in (self._queues, self._policies, self._heaps, self._estimates,
+                           self._service_times, self._estimate_hours):
+                if company_key is None:
+                    cached.clear()
+                else:
+                    cached.pop(company_key, None)
+
+    def version(self, company_key):
+        return f"{self.epoch}-{self._versions.get(company_key, 0)}"
+
+    def bump(self, company_key):
+        # Call after a change to the company's queues has been written
+        with self._lock:
+            self._versions[company_key] = self._versions.get(company_key, 0) + 1
+            return self.version(company_key)
+
+    def get(self, company_key, cashier_id):
+        queues = self._queues.get(company_key)
+        return queues.get(cashier_id) if queues else None
+
+    def cashiers(self, company_key):
+        return list(self._queues.get(company_key, {}).values())
+
+    def policy(self, company_key):
+        return self._policies.get(company_key, DEFAULT_POLICY)
+
+    def set_policy(self, company_key, policy):
+        # Re-rank a loaded company's cashiers under another policy; an
+        # unloaded company picks it up from the database when it loads
+        validate_policy(policy)
+        queues = self._queues.get(company_key)
+        if queues is None:
+            return
+        estimates = self._fetch_estimates(queues, policy)
+        with self._lock:
+            if self._queues.get(company_key) is queues:
+                self._policies[company_key] = policy
+                self._set_estimates(company_key, estimates, replace=True)
+                self._rebuild_heap(company_key)
+
+    def refresh_estimates(self, company_key, cashier_ids=None):
+        # Re-read service times (all cashiers by default) and re-rank; call
+        # after recording a service time, without holding the lock
+        queues = self._queues.get(company_key)
+        if queues is None:
+            return
+        if cashier_ids is not None:
+            queues = {cashier_id: queues[cashier_id] for cashier_id in cashier_ids if cashier_id in queues}
+        estimates = self._fetch_estimates(queues, self.policy(company_key))
+        if not estimates:
+            return
+        with self._lock:
+            if company_key in self._queues:
+                self._set_estimates(company_key, estimates, replace=cashier_ids is None)
+                self._rebuild_heap(company_key)
+
+    def choose(self, company_key):
+        # Peek at the heap, discarding entries made stale by later pushes
+        with self._lock:
+            queues = self._queues.get(company_key)
+            heap = self._heaps.get(company_key)
+            if not queues or heap is None:
+                return None
+
+            while heap:
+                stamp, cashier_id = heap[0][-2:]
+                queue = queues.get(cashier_id)
+                if queue is not None and queue.is_active and queue.stamp == stamp:
+                    return queue
+                heapq.heappop(heap)
+            return None
+
+    def join(self, company_key, otp):
+        # Assign the customer to the cashier the company's policy ranks first.
+        # Returns (CashierQueue, position) or None when no cashier is active.
+        # Tickets come from the database's per-cashier counters, so they stay
+        # unique across workers.
+        if (self.policy(company_key) in SERVICE_TIME_POLICIES
+                and self._estimate_hours.get(company_key) != self._hour()):
+            self.refresh_estimates(company_key)
+        with self._lock:
+            queue = self.choose(company_key)
+            if queue is None:
+                return None
+
+            self._sequence += 1
+            queue.last_assigned = self._sequence
+            position = len(queue) + 1
+            if position == 1:
+                # First in line goes straight to the counter
+                queue.serving = otp
+            else:
+                queue.waiting.append(otp)
+            self._push(company_key, queue)
+            return queue, position
+
+    def remove(self, company_key, cashier_id, otp):
+        # Take a customer out of a queue (served, removed or rolled back)
+        with self._lock:
+            queue = self.get(company_key, cashier_id)
+            if queue is None:
+                return False
+            if queue.serving == otp:
+                queue.serving = None
+            else:
+                try:
+                    queue.waiting.remove(otp)
+                except ValueError:
+                    return False
+            self._push(company_key, queue)
+            return True
+
+    def advance(self, company_key, cashier_id, otp, next_otp=None, requeue=False):
+        # Mirror a serve/delay/remove: otp leaves the queue, or goes to the
+        # back of it when requeue is set, and next_otp (if any) has
+        # been called to the counter
+        with self._lock:
+            queue = self.get(company_key, cashier_id)
+            if queue is None:
+                return
+            if queue.serving == otp:
+                queue.serving = None
+            elif otp in queue.waiting:
+                queue.waiting.remove(otp)
+            if requeue:
+                queue.waiting.append(otp)
+            if next_otp is not None:
+                if queue.waiting and queue.waiting[0] == next_otp:
+                    queue.waiting.popleft()
+                elif next_otp in queue.waiting:
+                    queue.waiting.remove(next_otp)
+                queue.serving = next_otp
+            self._push(company_key, queue)
+
+    def set_active(self, company_key, cashier_id, is_active):
+        with self._lock:
+            queue = self.get(company_key, cashier_id)
+            if queue is None:
+                return
+            queue.is_active = is_active
+            if is_active:
+                self._push(company_key, queue)
+
+    def _fetch_estimates(self, queues, policy):
+        # Outside the lock: service_time may query the database
+        if policy not in SERVICE_TIME_POLICIES:
+            return {}
+        return {cashier_id: self._service_time(cashier_id) for cashier_id in queues}
+
+    def _set_estimates(self, company_key, estimates, replace=False):
+        # Caller holds the lock. Cashiers with no estimate, or one of 0 s, get
+        # the company's average, so none of them takes every customer.
+        if replace:
+            self._estimates[company_key] = dict(estimates)
+            self._estimate_hours[company_key] = self._hour()
+        else:
+            self._estimates.setdefault(company_key, {}).update(estimates)
+        known = [seconds for seconds in self._estimates[company_key].values() if seconds]
+        average = sum(known) / len(known) if known else DEFAULT_SERVICE_SECONDS
+        self._service_times[company_key] = {
+            cashier_id: seconds or average for cashier_id, seconds in self._estimates[company_key].items()
+        }
+
+    def _hour(self):
+        return int(time.time() // 3600)
+
+    def _entry(self, company_key, queue):
+        queue.stamp += 1
+        service_times = self._service_times.get(company_key, {})
+        rank = ROUTING_POLICIES[self._policies[company_key]](
+            queue, lambda cashier_id: service_times.get(cashier_id, DEFAULT_SERVICE_SECONDS))
+        return (rank, queue.last_assigned, queue.cashier_number, queue.stamp, queue.cashier_id)
+
+    def _push(self, company_key, queue):
+        heap = self._heaps[company_key]
+        heapq.heappush(heap, self._entry(company_key, queue))
+        # Stale entries are dropped lazily; compact if they pile up
+        if len(heap) > 4 * len(self._queues[company_key]) + 16:
+            self._rebuild_heap(company_key)
+
+    def _rebuild_heap(self, company_key):
+        heap = [
+            self._entry(company_key, queue)
+            for queue in self._queues[company_key].values()
+            if queue.is_active
+        ]
+        heapq.heapify(heap)
+        self._heaps[company_key] = heap
@@ -0,0 +1,831 @@
+# queue_store.py - Storage interface for the customer-facing queue operations
+# The routes call one QueueStore for the operations on their hot path, so a
+# query is tuned once per backend and every backend can be measured side by
+# side (see store_benchmark.py). Records are plain dicts with the keys in
+# CUSTOMER_FIELDS, plus 'id'.
+#
+#   SQLQueueStore    - Flask-SQLAlchemy models (app.py, app_sqlite.py)
+#   MongoQueueStore  - a pymongo database (app_mongodb.py)
+#   MemoryQueueStore - dicts in this process, for development and benchmarks
+#
+# The admin transitions (serve, delay, remove) are here too, with their status
+# and ownership checks; transitions.py mirrors them in the rest of the app.
+
+import time
+from datetime import datetime
+
+from company_stats import STAT_FIELDS, StatsAccumulator, delay_moment
+from queue_engine import ACTIVE_STATUSES
+
+CUSTOMER_FIELDS = ('cashier_id', 'otp', 'status', 'position', 'ticket', 'delays',
+                   'join_time', 'served_time', 'serving_start_time')
+
+
+class OtpInUse(Exception):
+    # The OTP still belongs to a queued customer. ticket is the ticket the
+    # rejected insert carried when the store kept it issued (MongoDB and
+    # memory), so the retry can reuse it; None when it was rolled back.
+    def __init__(self, otp, ticket=None):
+        super().__init__(otp)
+        self.ticket = ticket
+
+
+class QueueStore:
+    name = None
+
+    def issue_ticket(self, cashier_id):
+        # Atomically take the cashier's next ticket from its counter. Tickets
+        # are unique per cashier; contention is per cashier only.
+        raise NotImplementedError
+
+    def return_ticket(self, cashier_id, ticket):
+        # Hand back a ticket that OtpInUse.ticket kept issued and no retry
+        # used. The counter only moves back while it still stands at that
+        # ticket, so a ticket issued since is never handed out twice; returns
+        # whether it did. A ticket that cannot be returned leaves a gap.
+        raise NotImplementedError
+
+    def add_customer(self, customer):
+        # Insert a customer dict (CUSTOMER_FIELDS; status defaults to
+        # 'waiting'); returns its id or raises OtpInUse
+        raise NotImplementedError
+
+    def find_by_otp(self, otp):
+        # Latest customer holding the OTP, or None
+        raise NotImplementedError
+
+    def queue_position(self, customer):
+        # Live position: 1 + queued customers of the same cashier holding an
+        # earlier ticket. Finished customers keep their position at join time.
+        if customer['status'] not in ACTIVE_STATUSES or customer.get('ticket') is None:
+            return customer['position']
+        return self.count_ahead(customer['cashier_id'], customer['ticket']) + 1
+
+    def count_ahead(self, cashier_id, ticket):
+        raise NotImplementedError
+
+    def promote_next(self, cashier_id, now):
+        # Call the cashier's next waiting or delayed customer, in ticket
+        # order, to the counter; returns their OTP. Does nothing (None) while
+        # another customer is being served.
+        raise NotImplementedError
+
+    # owned_cashiers: ids of the cashiers the caller may act on, as a list
+    # (or, for the SQL store, a select of them). Each transition returns
+    # (customer after the change, OTP of the customer called next or None),
+    # or None when the customer is not in a state it applies to or belongs
+    # to another cashier.
+
+    def serve(self, customer_id, owned_cashiers, now):
+        # The customer at the counter is served and the next one called
+        raise NotImplementedError
+
+    def delay(self, customer_id, owned_cashiers, now):
+        # The customer at the counter goes to the back of the line with a
+        # fresh ticket and the next one is called
+        raise NotImplementedError
+
+    def remove(self, customer_id, owned_cashiers, now):
+        # A queued customer leaves; the next one is called if the counter was theirs
+        raise NotImplementedError
+
+    def record_history(self, entries):
+        # Write history records and fold them into the company stats and the
+        # per-cashier hourly rollups. Delays are not counted here; see record_delay.
+        raise NotImplementedError
+
+    def record_delay(self, company_id, cashier_number, now):
+        # Count a customer's first delay in the stats and rollups as it happens
+        raise NotImplementedError
+
+    def prune_history(self, before, batch_size):
+        # Delete history recorded before the given moment, batch_size rows per
+        # transaction; returns the number deleted. The rollups are kept.
+        raise NotImplementedError
+
+    def prune_customers(self, before, batch_size):
+        # Delete customers who left the queue before the given moment;
+        # returns the number deleted
+        raise NotImplementedError
+
+    def company_stats(self, company_id):
+        # Running totals (STAT_FIELDS) for a company, or None before its first rebuild
+        raise NotImplementedError
+
+
+def history_accumulator(entries):
+    # Also stamps each record with recorded_at, the moment it is counted at
+    # in the hourly stats and expires from
+    accumulator = StatsAccumulator()
+    for entry in entries:
+        entry.setdefault('recorded_at', entry.get('served_time') or entry['join_time'])
+        accumulator.add(entry['company_id'], entry['cashier_number'], entry['status'], entry.get('delays'),
+                        entry.get('wait_time_seconds'), entry['recorded_at'], count_delays=False)
+    return accumulator
+
+
+def delay_accumulator(company_id, cashier_number, now):
+    accumulator = StatsAccumulator()
+    accumulator.add_delay(company_id, cashier_number, now)
+    return accumulator
+
+
+class SQLQueueStore(QueueStore):
+    # Writes commit the session, together with anything the caller left
+    # pending in it (e.g. the status change a promotion follows)
+    name = 'sqlalchemy'
+
+    def __init__(self, db, cashier, customer, history, stats, hourly_stats, cashier_hourly_stats, profile=None):
+        self.db = db
+        self.Cashier = cashier
+        self.Customer = customer
+        self.QueueHistory = history
+        self.CompanyStats = stats
+        self.CompanyHourlyStats = hourly_stats
+        self.CashierHourlyStats = cashier_hourly_stats
+        self.CashierProfile = profile
+        self._columns = [customer.id] + [getattr(customer, field) for field in CUSTOMER_FIELDS]
+
+    def issue_ticket(self, cashier_id):
+        # UPDATE ... RETURNING on the cashier row, left uncommitted: the ticket
+        # commits or rolls back with the write that uses it, so a failed
+        # insert leaves no gap
+        return self.db.session.execute(
+            self.db.update(self.Cashier)
+            .where(self.Cashier.id == cashier_id)
+            .values(last_ticket=self.Cashier.last_ticket + 1)
+            .returning(self.Cashier.last_ticket)
+        ).scalar()
+
+    def return_ticket(self, cashier_id, ticket):
+        # A rejected insert rolls its ticket back, so there is none to return
+        return False
+
+    def add_customer(self, customer):
+        from sqlalchemy.exc import IntegrityError
+        try:
+            customer_id = self.db.session.execute(
+                self.db.insert(self.Customer).values(**customer)
+            ).inserted_primary_key[0]
+            self.db.session.commit()
+        except IntegrityError:
+            self.db.session.rollback()
+            raise OtpInUse(customer['otp'])
+        except Exception:
+            self.db.session.rollback()
+            raise
+        return customer_id
+
+    def find_by_otp(self, otp):
+        row = self.db.session.execute(
+            self.db.select(*self._columns)
+            .where(self.Customer.otp == otp)
+            .order_by(self.Customer.id.desc())
+            .limit(1)
+        ).first()
+        return dict(row._mapping) if row else None
+
+    def count_ahead(self, cashier_id, ticket):
+        # Counted on the (cashier_id, status, ticket) index
+        Customer = self.Customer
+        return self.db.session.execute(
+            self.db.select(self.db.func.count()).where(
+                Customer.cashier_id == cashier_id,
+                Customer.status.in_(ACTIVE_STATUSES),
+                Customer.ticket < ticket
+            )
+        ).scalar()
+
+    def promote_next(self, cashier_id, now):
+        # One UPDATE ... RETURNING; the free-counter check is in the WHERE clause
+        queued = self.db.aliased(self.Customer)
+        next_customer = self.db.select(queued.id).where(
+            queued.cashier_id == cashier_id,
+            queued.status.in_(['waiting', 'delayed'])
+        ).order_by(queued.ticket, queued.id).limit(1).scalar_subquery()
+        counter_busy = self.db.select(queued.id).where(
+            queued.cashier_id == cashier_id,
+            queued.status == 'serving'
+        ).exists()
+        try:
+            otp = self.db.session.execute(
+                self.db.update(self.Customer)
+                .where(self.Customer.id == next_customer, ~counter_busy)
+                .values(status='serving', serving_start_time=now)
+                .returning(self.Customer.otp)
+            ).scalar()
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+        return otp
+
+    def serve(self, customer_id, owned_cashiers, now):
+        return self._transition(customer_id, owned_cashiers, ['serving'], now, status='served', served_time=now)
+
+    def delay(self, customer_id, owned_cashiers, now):
+        return self._transition(customer_id, owned_cashiers, ['serving'], now, status='delayed',
+                                delays=self.Customer.delays + 1, serving_start_time=None)
+
+    def remove(self, customer_id, owned_cashiers, now):
+        return self._transition(customer_id, owned_cashiers, ACTIVE_STATUSES, now, status='removed')
+
+    def _transition(self, customer_id, owned_cashiers, from_statuses, now, **values):
+        # UPDATE ... RETURNING with the status and ownership checks in the
+        # WHERE clause, so a transition is not a read-modify-write round trip.
+        # It commits with the promotion of the next customer.
+        Customer = self.Customer
+        try:
+            row = self.db.session.execute(
+                self.db.update(Customer)
+                .where(
+                    Customer.id == customer_id,
+                    Customer.status.in_(from_statuses),
+                    Customer.cashier_id.in_(owned_cashiers)
+                )
+                .values(**values)
+                .returning(*self._columns)
+            ).first()
+            if row is None:
+                self.db.session.rollback()
+                return None
+            customer = dict(row._mapping)
+            if customer['status'] == 'delayed':
+                # Back of the line: a fresh ticket from the cashier's counter
+                customer['ticket'] = self.issue_ticket(customer['cashier_id'])
+                self.db.session.execute(
+                    self.db.update(Customer).where(Customer.id == customer_id).values(ticket=customer['ticket'])
+                )
+        except Exception:
+            self.db.session.rollback()
+            raise
+        return customer, self.promote_next(customer['cashier_id'], now)
+
+    def record_history(self, entries):
+        # One bulk insert, with the stats increments applied in the same transaction
+        accumulator = history_accumulator(entries)
+        with self.db.engine.begin() as connection:
+            connection.execute(self.QueueHistory.__table__.insert(), entries)
+            self.apply_stats(connection, accumulator)
+
+    def record_delay(self, company_id, cashier_number, now):
+        # A short transaction of its own, right after the delay it counts
+        self.apply_stats(self.db.session.connection(), delay_accumulator(company_id, cashier_number, now))
+        self.db.session.commit()
+
+    def apply_stats(self, connection, accumulator):
+        # Add accumulated increments on the given connection, so the stats commit
+        # or roll back together with the history rows that produced them
+        targets = (
+            (self.CompanyStats.__table__, ('company_id',), {(k,): v for k, v in accumulator.totals.items()}),
+            (self.CompanyHourlyStats.__table__, ('company_id', 'hour'), accumulator.hourly),
+            (self.CashierHourlyStats.__table__, ('company_id', 'cashier_number', 'hour'), accumulator.cashier_hourly)
+        )
+        for table, key_columns, buckets in targets:
+            for key, increments in buckets.items():
+                key_values = dict(zip(key_columns, key))
+                result = connection.execute(
+                    table.update()
+                    .where(*[table.c[column] == value for column, value in key_values.items()])
+                    .values({field: table.c[field] + value for field, value in increments.items()})
+                )
+                if result.rowcount == 0:
+                    connection.execute(table.insert().values(**key_values, **increments))
+
+    def rebuild_stats(self, company_id=None, complete_from=None):
+        # Recompute the materialized stats, streaming the rows: hours from
+        # complete_from on (all of them when it is None) from the raw history,
+        # older hours, whose records may have expired, from the per-cashier
+        # rollups, which are kept. Returns the number of companies rebuilt.
+        QueueHistory, CashierHourlyStats = self.QueueHistory, self.CashierHourlyStats
+        accumulator = StatsAccumulator()
+        history = QueueHistory.query.with_entities(
+            QueueHistory.company_id, QueueHistory.cashier_number, QueueHistory.status, QueueHistory.delays,
+            QueueHistory.wait_time_seconds, QueueHistory.recorded_at
+        )
+        rollups = CashierHourlyStats.query
+        stats_rows = self.CompanyStats.query
+        hourly_rows = self.CompanyHourlyStats.query
+        cashier_rows = CashierHourlyStats.query
+        if company_id is not None:
+            history = history.filter_by(company_id=company_id)
+            rollups = rollups.filter_by(company_id=company_id)
+            stats_rows = stats_rows.filter_by(company_id=company_id)
+            hourly_rows = hourly_rows.filter_by(company_id=company_id)
+            cashier_rows = cashier_rows.filter_by(company_id=company_id)
+            accumulator.totals[company_id]  # Keep a zero row for companies without history
+        if complete_from is not None:
+            history = history.filter(QueueHistory.recorded_at >= complete_from)
+            cashier_rows = cashier_rows.filter(CashierHourlyStats.hour >= complete_from)
+            for row in rollups.filter(CashierHourlyStats.hour < complete_from).yield_per(5000):
+                accumulator.add_rollup(row.company_id, row.hour, {field: getattr(row, field) for field in STAT_FIELDS})
+
+        for row in history.yield_per(5000):
+            accumulator.add(row.company_id, row.cashier_number, row.status, row.delays, row.wait_time_seconds,
+                            row.recorded_at)
+        # Customers still in a queue have no history record yet, but their
+        # delays were counted as they happened
+        Customer, Cashier = self.Customer, self.Cashier
+        delayed = self.db.session.query(Cashier.company_id, Cashier.cashier_number, Customer.join_time).join(
+            Cashier, Customer.cashier_id == Cashier.id
+        ).filter(Customer.status.in_(ACTIVE_STATUSES), Customer.delays > 0)
+        if company_id is not None:
+            delayed = delayed.filter(Cashier.company_id == company_id)
+        for row in delayed.yield_per(5000):
+            accumulator.add_delay(row.company_id, row.cashier_number, delay_moment(row.join_time, complete_from))
+
+        stats_rows.delete(synchronize_session=False)
+        hourly_rows.delete(synchronize_session=False)
+        cashier_rows.delete(synchronize_session=False)
+        self.apply_stats(self.db.session.connection(), accumulator)
+        self.db.session.commit()
+        return len(accumulator.totals)
+
+    def compute_service_profiles(self, since):
+        # Batch job: every cashier's time-of-day profile from the served
+        # records since then, computed with NumPy. The database joins each
+        # column of a range of ids into one string, so rows never cross into
+        # Python one by one; ids follow write order, so each range is a
+        # sequential read. Returns (cashiers, records).
+        from service_profiles import PROFILE_BATCH_IDS, compute_profiles, moment_slots, read_joined
+        QueueHistory = self.QueueHistory
+        first_id, last_id = self.db.session.execute(
+            self.db.select(self.db.func.min(QueueHistory.id), self.db.func.max(QueueHistory.id))
+            .where(QueueHistory.recorded_at >= since)
+        ).first()
+        def joined(column):
+            # string_agg, group_concat or listagg by dialect; SQLAlchemy 2.0.21+
+            return self.db.func.aggregate_strings(self.db.cast(column, self.db.String), ',')
+        # The four strings are aggregated over the same rows in one scan, so
+        # they list them in the same order. Aggregation skips NULLs, which
+        # would shift a column against the others, so no column may hold one.
+        batches = (
+            self.db.session.execute(
+                self.db.select(joined(QueueHistory.company_id), joined(QueueHistory.cashier_number),
+                               joined(QueueHistory.recorded_at), joined(QueueHistory.wait_time_seconds))
+                .where(QueueHistory.id >= start, QueueHistory.id < start + PROFILE_BATCH_IDS,
+                       QueueHistory.status == 'served', QueueHistory.wait_time_seconds.isnot(None),
+                       QueueHistory.recorded_at.isnot(None))
+            ).first()
+            for start in range(first_id or 0, (last_id or -1) + 1, PROFILE_BATCH_IDS)
+        )
+        columns = read_joined(batches, ('i8', 'i8', 'datetime64[us]', 'f8'))
+        if len({len(column) for column in columns}) > 1:
+            raise ValueError(f"History columns came back misaligned: {[len(column) for column in columns]} values")
+        # The id ranges may reach a little past the window at its start
+        company_ids, cashier_numbers, moments, seconds = [column[columns[2] >= since] for column in columns]
+        # One key per (company, cashier number)
+        profiles = compute_profiles((company_ids << 32) | cashier_numbers, moment_slots(moments), seconds)
+
+        cashier_ids = {(row.company_id, row.cashier_number): row.id for row in self.db.session.execute(
+            self.db.select(self.Cashier.id, self.Cashier.company_id, self.Cashier.cashier_number)
+        )}
+        now = datetime.utcnow()
+        rows = [
+            {'cashier_id': cashier_ids[(key >> 32, key & 0xFFFFFFFF)], 'records': records,
+             'quantiles': packed, 'computed_at': now}
+            for key, (records, packed) in profiles.items() if (key >> 32, key & 0xFFFFFFFF) in cashier_ids
+        ]
+        self.db.session.execute(self.CashierProfile.__table__.delete())
+        if rows:
+            self.db.session.execute(self.CashierProfile.__table__.insert(), rows)
+        self.db.session.commit()
+        return len(rows), len(seconds)
+
+    def last_history_id(self):
+        return self.db.session.execute(self.db.select(self.db.func.max(self.QueueHistory.id))).scalar() or 0
+
+    def backfill_stats(self, tables, last_id, page_rows=5000):
+        # Fold history up to last_id into statistics tables created after it
+        # was written; later records were counted as they were written. Reads
+        # in pages by id, each a short read transaction, and adds everything
+        # in one write at the end, so joins and serves carry on meanwhile.
+        # Returns the number of records read.
+        table = self.QueueHistory.__table__
+        accumulator = StatsAccumulator()
+        after, read = 0, 0
+        while after < last_id:
+            with self.db.engine.connect() as connection:
+                rows = connection.execute(
+                    self.db.select(table.c.id, table.c.company_id, table.c.cashier_number, table.c.status,
+                                   table.c.delays, table.c.wait_time_seconds, table.c.recorded_at)
+                    .where(table.c.id > after, table.c.id <= last_id).order_by(table.c.id).limit(page_rows)
+                ).all()
+            if not rows:
+                break
+            for row in rows:
+                accumulator.add(row.company_id, row.cashier_number, row.status, row.delays,
+                                row.wait_time_seconds, row.recorded_at)
+            after, read = rows[-1].id, read + len(rows)
+            time.sleep(0)
+        # Tables that already existed kept counting these records
+        for name, buckets in (('company_stats', accumulator.totals), ('company_hourly_stats', accumulator.hourly),
+                              ('cashier_hourly_stats', accumulator.cashier_hourly)):
+            if name not in tables:
+                buckets.clear()
+        with self.db.engine.begin() as connection:
+            self.apply_stats(connection, accumulator)
+        return read
+
+    def prune_expired(self, retention, now, keep_history=False):
+        # Expire raw history past the retention window (its rollups stay) and
+        # customers who left the queue before the customer window
+        history_cutoff, customer_cutoff = retention.history_cutoff(now), retention.customer_cutoff(now)
+        pruned = {'history': 0, 'customers': 0}
+        if history_cutoff is not None and not keep_history:
+            pruned['history'] = self.prune_history(history_cutoff, retention.batch_size)
+        if customer_cutoff is not None:
+            pruned['customers'] = self.prune_customers(customer_cutoff, retention.batch_size)
+        return pruned
+
+    def prune_history(self, before, batch_size):
+        # Range scan on the recorded_at index
+        table = self.QueueHistory.__table__
+        return self._delete_in_batches(table, table.c.recorded_at < before, batch_size)
+
+    def prune_customers(self, before, batch_size):
+        table = self.Customer.__table__
+        return self._delete_in_batches(table, self.db.and_(
+            table.c.status.in_(['served', 'removed']),
+            self.db.func.coalesce(table.c.served_time, table.c.join_time) < before
+        ), batch_size)
+
+    def history_pages(self, company_id, fields, start=None, end=None, page_rows=1000):
+        # The company's history rows (values of fields, in order), oldest
+        # first, optionally from start to end (exclusive) on the join time.
+        # Read a page at a time, keyed on (join_time, id), each page on a
+        # connection of its own: a slow download never holds a transaction
+        # open, which on SQLite without WAL would lock out every write.
+        table = self.QueueHistory.__table__
+        query = self.db.select(table.c.id, table.c.join_time, *[table.c[field] for field in fields]).where(
+            table.c.company_id == company_id
+        )
+        if start:
+            query = query.where(table.c.join_time >= start)
+        if end:
+            query = query.where(table.c.join_time < end)
+        query = query.order_by(table.c.join_time, table.c.id).limit(page_rows)
+        page = query
+        while True:
+            with self.db.engine.connect() as connection:
+                rows = connection.execute(page).all()
+            for row in rows:
+                yield tuple(row[2:])
+            if len(rows) < page_rows:
+                return
+            last_id, last_join = rows[-1][0], rows[-1][1]
+            page = query.where(self.db.or_(
+                table.c.join_time > last_join,
+                self.db.and_(table.c.join_time == last_join, table.c.id > last_id)
+            ))
+
+    def _delete_in_batches(self, table, condition, batch_size):
+        # Short transactions, so the SQLite write lock is never held for long
+        # and requests get in between batches
+        deleted = 0
+        while True:
+            batch = self.db.select(table.c.id).where(condition).limit(batch_size)
+            with self.db.engine.begin() as connection:
+                count = connection.execute(table.delete().where(table.c.id.in_(batch))).rowcount
+            deleted += count
+            if count < batch_size:
+                return deleted
+            time.sleep(0)
+
+    def company_stats(self, company_id):
+        row = self.db.session.execute(
+            self.db.select(*[getattr(self.CompanyStats, field) for field in STAT_FIELDS])
+            .where(self.CompanyStats.company_id == company_id)
+        ).first()
+        return dict(row._mapping) if row else None
+
+
+class MongoQueueStore(QueueStore):
+    # Queued customers carry an 'active' flag, which backs the partial unique
+    # index on OTPs, and finished ones a 'finished_at' date for their TTL
+    # index. Ticket counters live in ticket_counters, one document per
+    # cashier keyed by its id.
+    name = 'mongodb'
+
+    def __init__(self, db):
+        self.db = db
+        self._seeded = set()  # Cashiers whose ticket counters this process has seeded
+
+    def issue_ticket(self, cashier_id):
+        # $inc is atomic per document; the upsert starts a new cashier at 1.
+        # There is no transaction, so a ticket whose insert fails is handed
+        # back to the caller (OtpInUse.ticket) to reuse.
+        from pymongo import ReturnDocument
+        self.seed_tickets([cashier_id])
+        counter = self.db.ticket_counters.find_one_and_update(
+            {'_id': cashier_id},
+            {'$inc': {'last_ticket': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter['last_ticket']
+
+    def return_ticket(self, cashier_id, ticket):
+        # Compare-and-decrement in one update_one
+        return self.db.ticket_counters.update_one(
+            {'_id': cashier_id, 'last_ticket': ticket},
+            {'$inc': {'last_ticket': -1}}
+        ).modified_count == 1
+
+    def seed_tickets(self, cashier_ids):
+        # Counters created before any ticket was issued through them start
+        # from the highest ticket already in use; once per cashier per
+        # process, and $max never moves a counter back
+        from pymongo import UpdateOne
+        cashier_ids = [cashier_id for cashier_id in cashier_ids if cashier_id not in self._seeded]
+        if not cashier_ids:
+            return
+        updates = [
+            UpdateOne({'_id': row['_id']}, {'$max': {'last_ticket': row['last_ticket']}}, upsert=True)
+            for row in self.db.customers.aggregate([
+                {'$match': {'cashier_id': {'$in': cashier_ids}}},
+                {'$group': {'_id': '$cashier_id', 'last_ticket': {'$max': '$ticket'}}}
+            ]) if row['last_ticket']
+        ]
+        if updates:
+            self.db.ticket_counters.bulk_write(updates, ordered=False)
+        self._seeded.update(cashier_ids)
+
+    def add_customer(self, customer):
+        from pymongo.errors import DuplicateKeyError
+        document = dict(customer)
+        document.setdefault('status', 'waiting')
+        document.setdefault('delays', 0)
+        document['active'] = document['status'] in ACTIVE_STATUSES
+        try:
+            return str(self.db.customers.insert_one(document).inserted_id)
+        except DuplicateKeyError:
+            raise OtpInUse(customer['otp'], customer.get('ticket'))
+
+    def find_by_otp(self, otp):
+        return self._record(self.db.customers.find_one({'otp': otp}, sort=[('_id', -1)]))
+
+    def count_ahead(self, cashier_id, ticket):
+        return self.db.customers.count_documents({
+            'cashier_id': cashier_id,
+            'status': {'$in': list(ACTIVE_STATUSES)},
+            'ticket': {'$lt': ticket}
+        })
+
+    def promote_next(self, cashier_id, now):
+        # The check and the update are two commands, unlike the SQL store's
+        # single statement; a promotion racing another one on the same cashier
+        # is rejected by the unique index on serving customers
+        from pymongo.errors import DuplicateKeyError
+        if self.db.customers.find_one({'cashier_id': cashier_id, 'status': 'serving'}, {'_id': 1}):
+            return None
+        try:
+            promoted = self.db.customers.find_one_and_update(
+                {'cashier_id': cashier_id, 'status': {'$in': ['waiting', 'delayed']}},
+                {'$set': {'status': 'serving', 'serving_start_time': now}},
+                projection={'otp': 1},
+                sort=[('ticket', 1), ('_id', 1)]
+            )
+        except DuplicateKeyError:
+            return None
+        return promoted['otp'] if promoted else None
+
+    # One find_one_and_update each, with the status and ownership checks in
+    # the filter. The promotion (and a delay's new ticket) follow as separate
+    # commands; MongoDB has no transaction around them.
+
+    def serve(self, customer_id, owned_cashiers, now):
+        customer = self._update(customer_id, owned_cashiers, ['serving'], {
+            '$set': {'status': 'served', 'served_time': now, 'finished_at': now},
+            '$unset': {'active': ''}
+        })
+        if customer is None:
+            return None
+        return customer, self.promote_next(customer['cashier_id'], now)
+
+    def delay(self, customer_id, owned_cashiers, now):
+        customer = self._update(customer_id, owned_cashiers, ['serving'], {
+            '$set': {'status': 'delayed'},
+            '$inc': {'delays': 1},
+            '$unset': {'serving_start_time': ''}
+        })
+        if customer is None:
+            return None
+        customer['ticket'] = self.issue_ticket(customer['cashier_id'])
+        self.db.customers.update_one({'_id': customer['_id']}, {'$set': {'ticket': customer['ticket']}})
+        return customer, self.promote_next(customer['cashier_id'], now)
+
+    def remove(self, customer_id, owned_cashiers, now):
+        customer = self._update(customer_id, owned_cashiers, ACTIVE_STATUSES, {
+            '$set': {'status': 'removed', 'finished_at': now},
+            '$unset': {'active': ''}
+        }, before=True)
+        if customer is None:
+            return None
+        # Only a freed counter calls the next customer
+        was_serving = customer['status'] == 'serving'
+        customer.update(status='removed', finished_at=now)
+        customer.pop('active', None)
+        return customer, self.promote_next(customer['cashier_id'], now) if was_serving else None
+
+    def _update(self, customer_id, owned_cashiers, from_statuses, update, before=False):
+        # The customer after the update, or as it was before when before is set
+        from bson.objectid import ObjectId
+        from pymongo import ReturnDocument
+        return self._record(self.db.customers.find_one_and_update(
+            {
+                '_id': ObjectId(customer_id),
+                'status': {'$in': list(from_statuses)},
+                'cashier_id': {'$in': list(owned_cashiers)}
+            },
+            update,
+            return_document=ReturnDocument.BEFORE if before else ReturnDocument.AFTER
+        ))
+
+    def record_history(self, entries):
+        # Stats are applied right after the insert for every record that got in;
+        # rebuild-stats repairs any drift. Each entry keeps the _id it is given
+        # here, so when the archiver retries a failed batch one record at a time,
+        # a record the batch already wrote is recognised and not counted twice.
+        from bson.objectid import ObjectId
+        from pymongo.errors import BulkWriteError
+        accumulator = history_accumulator(entries)
+        for entry in entries:
+            entry.setdefault('_id', ObjectId())
+        try:
+            self.db.queue_history.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            rejected = {error['index'] for error in e.details.get('writeErrors', [])}
+            self.apply_stats(history_accumulator(
+                [entry for index, entry in enumerate(entries) if index not in rejected]
+            ))
+            # Rejected records already in the collection were written by an earlier attempt
+            stored = {entry['_id'] for entry in self.db.queue_history.find(
+                {'_id': {'$in': [entries[index]['_id'] for index in rejected]}}, {'_id': 1}
+            )}
+            if any(entries[index]['_id'] not in stored for index in rejected):
+                raise
+            return
+        self.apply_stats(accumulator)
+
+    def record_delay(self, company_id, cashier_number, now):
+        self.apply_stats(delay_accumulator(company_id, cashier_number, now))
+
+    def apply_stats(self, accumulator):
+        # $inc upserts, one bulk write per stats collection
+        from pymongo import UpdateOne
+        if accumulator.totals:
+            self.db.company_stats.bulk_write([
+                UpdateOne({'_id': company_id}, {'$inc': increments}, upsert=True)
+                for company_id, increments in accumulator.totals.items()
+            ], ordered=False)
+        if accumulator.hourly:
+            self.db.company_hourly_stats.bulk_write([
+                UpdateOne({'company_id': company_id, 'hour': hour}, {'$inc': increments}, upsert=True)
+                for (company_id, hour), increments in accumulator.hourly.items()
+            ], ordered=False)
+        if accumulator.cashier_hourly:
+            self.db.cashier_hourly_stats.bulk_write([
+                UpdateOne({'company_id': company_id, 'cashier_number': cashier_number, 'hour': hour},
+                          {'$inc': increments}, upsert=True)
+                for (company_id, cashier_number, hour), increments in accumulator.cashier_hourly.items()
+            ], ordered=False)
+
+    # The TTL indexes on recorded_at and finished_at normally get there first;
+    # these catch up when they are off or behind. One delete_many each.
+
+    def prune_history(self, before, batch_size):
+        return self.db.queue_history.delete_many({'recorded_at': {'$lt': before}}).deleted_count
+
+    def prune_customers(self, before, batch_size):
+        return self.db.customers.delete_many({'finished_at': {'$lt': before}}).deleted_count
+
+    def company_stats(self, company_id):
+        return self.db.company_stats.find_one({'_id': company_id})
+
+    def _record(self, document):
+        if document is not None:
+            document['id'] = str(document['_id'])
+        return document
+
+
+class MemoryQueueStore(QueueStore):
+    # Everything in dicts; for a single process only
+    name = 'memory'
+
+    def __init__(self):
+        self.customers = {}   # id -> record
+        self._by_otp = {}     # otp -> id of the latest customer holding it
+        self._queued = {}     # cashier_id -> {id: record} for queued customers
+        self._tickets = {}    # cashier_id -> last ticket issued
+        self._next_id = 1
+        self.history = []
+        self._stats = StatsAccumulator()
+
+    def issue_ticket(self, cashier_id):
+        ticket = self._tickets.get(cashier_id, 0) + 1
+        self._tickets[cashier_id] = ticket
+        return ticket
+
+    def return_ticket(self, cashier_id, ticket):
+        if self._tickets.get(cashier_id) != ticket:
+            return False
+        self._tickets[cashier_id] = ticket - 1
+        return True
+
+    def add_customer(self, customer):
+        latest = self.customers.get(self._by_otp.get(customer['otp']))
+        if latest is not None and latest['status'] in ACTIVE_STATUSES:
+            raise OtpInUse(customer['otp'], customer.get('ticket'))
+        record = dict.fromkeys(CUSTOMER_FIELDS)
+        record.update(status='waiting', delays=0)
+        record.update(customer)
+        record['id'] = customer_id = self._next_id
+        self._next_id += 1
+        self.customers[customer_id] = record
+        self._by_otp[record['otp']] = customer_id
+        if record['status'] in ACTIVE_STATUSES:
+            self._queued.setdefault(record['cashier_id'], {})[customer_id] = record
+        return customer_id
+
+    def find_by_otp(self, otp):
+        record = self.customers.get(self._by_otp.get(otp))
+        return dict(record) if record else None
+
+    def count_ahead(self, cashier_id, ticket):
+        return sum(1 for record in self._queued.get(cashier_id, {}).values() if record['ticket'] < ticket)
+
+    def promote_next(self, cashier_id, now):
+        queued = self._queued.get(cashier_id, {}).values()
+        if any(record['status'] == 'serving' for record in queued):
+            return None
+        waiting = [record for record in queued if record['status'] in ('waiting', 'delayed')]
+        if not waiting:
+            return None
+        record = min(waiting, key=lambda record: (record['ticket'], record['id']))
+        record.update(status='serving', serving_start_time=now)
+        return record['otp']
+
+    def serve(self, customer_id, owned_cashiers, now):
+        record = self._owned(customer_id, owned_cashiers, ['serving'])
+        if record is None:
+            return None
+        self._leave(record, status='served', served_time=now, finished_at=now)
+        return dict(record), self.promote_next(record['cashier_id'], now)
+
+    def delay(self, customer_id, owned_cashiers, now):
+        record = self._owned(customer_id, owned_cashiers, ['serving'])
+        if record is None:
+            return None
+        record.update(status='delayed', delays=(record['delays'] or 0) + 1, serving_start_time=None,
+                      ticket=self.issue_ticket(record['cashier_id']))
+        return dict(record), self.promote_next(record['cashier_id'], now)
+
+    def remove(self, customer_id, owned_cashiers, now):
+        record = self._owned(customer_id, owned_cashiers, ACTIVE_STATUSES)
+        if record is None:
+            return None
+        was_serving = record['status'] == 'serving'
+        self._leave(record, status='removed', finished_at=now)
+        return dict(record), self.promote_next(record['cashier_id'], now) if was_serving else None
+
+    def _owned(self, customer_id, owned_cashiers, from_statuses):
+        record = self.customers.get(customer_id)
+        if record is None or record['status'] not in from_statuses or record['cashier_id'] not in owned_cashiers:
+            return None
+        return record
+
+    def _leave(self, record, **values):
+        record.update(values)
+        self._queued.get(record['cashier_id'], {}).pop(record['id'], None)
+
+    def record_history(self, entries):
+        self.history.extend(entries)
+        self._apply(history_accumulator(entries))
+
+    def record_delay(self, company_id, cashier_number, now):
+        self._apply(delay_accumulator(company_id, cashier_number, now))
+
+    def _apply(self, accumulator):
+        for company_id, increments in accumulator.totals.items():
+            for field, value in increments.items():
+                self._stats.totals[company_id][field] += value
+
+    def prune_history(self, before, batch_size):
+        kept = [entry for entry in self.history if entry['recorded_at'] >= before]
+        deleted = len(self.history) - len(kept)
+        self.history = kept
+        return deleted
+
+    def prune_customers(self, before, batch_size):
+        expired = [customer_id for customer_id, record in self.customers.items()
+                   if record.get('finished_at') is not None and record['finished_at'] < before]
+        for customer_id in expired:
+            record = self.customers.pop(customer_id)
+            if self._by_otp.get(record['otp']) == customer_id:
+                del self._by_otp[record['otp']]
+        return len(expired)
+
+    def company_stats(self, company_id):
+        totals = self._stats.totals.get(company_id)
+        return dict(totals) if totals is not None else None
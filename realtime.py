@@ -0,0 +1,53 @@
+# realtime.py - Socket.IO rooms shared by all app variants
+# Customers join a room named after their OTP and admin/status pages join one
+# per company, so events are only written to the sockets that asked for them.
+
+from flask_socketio import join_room
+
+ROOM_KINDS = ('company', 'customer')
+
+
+def customer_room(otp):
+    return f"customer:{otp}"
+
+
+def company_room(company_code):
+    return f"company:{company_code}"
+
+
+def register_room_handlers(socketio):
+    @socketio.on('join_customer_room')
+    def join_customer_room(data):
+        otp = (data or {}).get('otp')
+        if otp:
+            join_room(customer_room(str(otp)))
+
+    @socketio.on('join_company_room')
+    def join_company_room(data):
+        company_code = (data or {}).get('company_code')
+        if company_code:
+            join_room(company_room(str(company_code)))
+
+
+def room_stats(socketio, namespace='/'):
+    # Connection counts per room kind, read straight from the room manager.
+    # Room names carry OTPs, so only aggregates are reported.
+    rooms = socketio.server.manager.rooms.get(namespace, {})
+    stats = {
+        'connections': len(rooms.get(None, {})),
+        'rooms': {kind: {'rooms': 0, 'members': 0, 'largest': 0} for kind in ROOM_KINDS}
+    }
+
+    for room, members in list(rooms.items()):
+        # Skip the namespace-wide room and each client's private sid room
+        if room is None or room in members:
+            continue
+        kind = room.split(':', 1)[0]
+        if kind not in stats['rooms']:
+            continue
+        size = len(members)
+        stats['rooms'][kind]['rooms'] += 1
+        stats['rooms'][kind]['members'] += size
+        stats['rooms'][kind]['largest'] = max(stats['rooms'][kind]['largest'], size)
+
+    return stats
@@ -0,0 +1,128 @@
+# retention.py - Bounded queue history and customer tables
+# Raw history records are kept for a retention window and then expire; by
+# then every record has long been folded into the per-cashier hourly rollups
+# (company_stats.py), which stay. Finished customers are pruned after a
+# shorter window. Tables then grow with the traffic rate, not with the age of
+# the deployment.
+#
+#   MongoDB  TTL indexes expire the records (see app_mongodb.apply_retention)
+#   SQL      a background job deletes them in small batches (HistoryPruner)
+#
+# Expiry only ever removes whole hours of raw history that are older than
+# complete_from(), so a stats rebuild takes hours from complete_from() on
+# from the raw records and everything before it from the rollups.
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from company_stats import hour_bucket
+
+HISTORY_RETENTION_DAYS = 90
+CUSTOMER_RETENTION_HOURS = 24
+PRUNE_INTERVAL_SECONDS = 3600
+PRUNE_BATCH_SIZE = 5000
+FIRST_PRUNE_DELAY_SECONDS = 60  # After the job starts, so startup stays quick
+
+
+class RetentionPolicy:
+    # A window of 0 (or None) keeps those records forever
+    def __init__(self, history_days=HISTORY_RETENTION_DAYS, customer_hours=CUSTOMER_RETENTION_HOURS,
+                 batch_size=PRUNE_BATCH_SIZE):
+        self.history_window = timedelta(days=history_days) if history_days else None
+        self.customer_window = timedelta(hours=customer_hours) if customer_hours else None
+        self.batch_size = batch_size
+
+    def history_cutoff(self, now):
+        # Raw history recorded before this may be deleted; whole hours only
+        if self.history_window is None:
+            return None
+        return hour_bucket(now - self.history_window)
+
+    def complete_from(self, now):
+        # First hour still fully held in raw history. One hour past the cutoff,
+        # as TTL expiry runs continuously rather than on hour boundaries.
+        cutoff = self.history_cutoff(now)
+        return cutoff + timedelta(hours=1) if cutoff is not None else None
+
+    def customer_cutoff(self, now):
+        # Customers who left the queue before this may be deleted
+        if self.customer_window is None:
+            return None
+        return now - self.customer_window
+
+    def ttl_seconds(self):
+        # expireAfterSeconds for the MongoDB TTL indexes: (history, customers)
+        return tuple(int(window.total_seconds()) if window else None
+                     for window in (self.history_window, self.customer_window))
+
+    def describe(self):
+        return {
+            'history_retention_days': self.history_window.days if self.history_window else None,
+            'customer_retention_hours': self.customer_window.total_seconds() / 3600 if self.customer_window else None
+        }
+
+
+class HistoryPruner:
+    # Runs prune() every interval on a daemon thread (a greenlet under
+    # gevent). Every worker may run one: the deletes are idempotent and each
+    # batch is its own short transaction, so they just share the work.
+    def __init__(self, prune, interval=PRUNE_INTERVAL_SECONDS, first_delay=FIRST_PRUNE_DELAY_SECONDS, logger=None):
+        # prune() -> {'history': deleted, 'customers': deleted}
+        self._prune = prune
+        self.logger = logger or logging.getLogger(__name__)
+        self.interval = interval
+        self.first_delay = first_delay
+        self._worker = None
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.runs = 0
+        self.failures = 0
+        self.pruned = {'history': 0, 'customers': 0}
+        self.last_run = None
+        self.last_run_ms = 0.0
+
+    def start(self):
+        # Started on first use, like the history archiver, so importing an app
+        # spawns nothing before the server forks. An interval of 0 leaves
+        # pruning to the prune-history command.
+        with self._lock:
+            if self._worker is None and self.interval:
+                self._worker = threading.Thread(target=self._run, name='history-pruner', daemon=True)
+                self._worker.start()
+
+    def run_once(self):
+        started = time.perf_counter()
+        try:
+            pruned = self._prune()
+        except Exception:
+            self.failures += 1
+            raise
+        self.runs += 1
+        self.last_run = datetime.utcnow()
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+        for name, count in pruned.items():
+            self.pruned[name] += count
+        return pruned
+
+    def stats(self):
+        return {
+            'scheduled': self._worker is not None,
+            'interval_seconds': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'pruned': dict(self.pruned),
+            'last_run': self.last_run.isoformat() + 'Z' if self.last_run else None,
+            'last_run_ms': round(self.last_run_ms, 2)
+        }
+
+    def _run(self):
+        time.sleep(self.first_delay)
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                self.logger.exception('History pruning failed')
+            time.sleep(self.interval)
@@ -0,0 +1,48 @@
+# routing.py - Policies for assigning joining customers to cashiers
+# QueueEngine keeps a heap of every company's active cashiers ordered by the
+# company's policy, so a join takes the top of the heap in O(log n). A policy
+# only ranks one cashier's queue; the lowest rank gets the customer.
+#
+#   shortest-queue                customers in line, counting the one at the counter
+#   shortest-expected-completion  when a customer joining now would be done:
+#                                 (customers in line + 1) x the cashier's service
+#                                 time, so fast counters take more customers
+#   round-robin                   the cashier assigned a customer longest ago
+#
+# Ties go to the cashier assigned a customer longest ago, then to the lowest
+# cashier number, so equal queues fill evenly instead of cashier 1 first.
+#
+# service_time(cashier_id) reads the estimates QueueEngine keeps in memory;
+# it never queries the database, since ranks are computed under the lock.
+
+DEFAULT_POLICY = 'shortest-queue'
+MIN_SERVICE_SECONDS = 1  # An estimate of 0 s would send every customer to that cashier
+
+
+def shortest_queue(queue, service_time):
+    return len(queue)
+
+
+def shortest_expected_completion(queue, service_time):
+    return (len(queue) + 1) * max(service_time(queue.cashier_id), MIN_SERVICE_SECONDS)
+
+
+def round_robin(queue, service_time):
+    return queue.last_assigned
+
+
+ROUTING_POLICIES = {
+    'shortest-queue': shortest_queue,
+    'shortest-expected-completion': shortest_expected_completion,
+    'round-robin': round_robin
+}
+
+# Policies whose ranks depend on service times
+SERVICE_TIME_POLICIES = ('shortest-expected-completion',)
+
+
+def validate_policy(name):
+    # The policy name, or raises ValueError
+    if name not in ROUTING_POLICIES:
+        raise ValueError(f"Unknown routing policy {name!r}, expected one of {', '.join(ROUTING_POLICIES)}")
+    return name
@@ -0,0 +1,173 @@
+# routing_replay.py - Replays a company's queue history under each routing policy
+# Reads a history export (CSV or NDJSON, as downloaded from Export History)
+# and feeds its served customers, in join order, through QueueEngine under
+# every routing policy. The report compares their waits as JSON:
+#
+#   python routing_replay.py queue-history-ABCDEF.csv
+#   python routing_replay.py history.ndjson --policies shortest-queue round-robin
+#   python routing_replay.py history.csv --estimate average
+#
+# Every cashier seen in the export is open for the whole replay and serves
+# its queue in order. A customer's recorded service time is scaled by the
+# speed of the cashier serving them in the replay: a customer who took 90 s
+# at a cashier averaging 60 s takes 1.5x the average of any other cashier.
+# The 'recorded' row keeps every customer at their recorded cashier under the
+# same model, as the baseline. Waits are from joining to reaching the counter,
+# in seconds.
+#
+# shortest-expected-completion needs each cashier's service time. By default
+# it gets the rolling estimate the apps fall back on (--estimate rolling);
+# --estimate average gives it every cashier's average over the whole export,
+# close to what a cashier with a service-time profile gets.
+
+import argparse
+import csv
+import heapq
+import json
+import platform
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from benchmark import git_revision, percentile
+from history_export import EXPORT_FORMATS
+from queue_engine import QueueEngine
+from routing import ROUTING_POLICIES
+from wait_estimator import ServiceTimeEstimator
+
+COMPANY = 'replay'
+ESTIMATES = ('rolling', 'average')
+
+
+def read_history(source, fmt):
+    # Served records as (join_time, cashier_number, service seconds), in join order
+    if fmt == 'csv':
+        rows = csv.DictReader(source)
+    else:
+        rows = (json.loads(line) for line in source if line.strip())
+    customers = []
+    for row in rows:
+        if row['status'] != 'served' or row['wait_time_seconds'] in (None, ''):
+            continue
+        customers.append((datetime.fromisoformat(row['join_time']), int(row['cashier_number']),
+                          float(row['wait_time_seconds'])))
+    customers.sort(key=lambda customer: customer[0])
+    return customers
+
+
+def replay(customers, policy, estimate='rolling'):
+    # Runs the arrivals through a QueueEngine routing by policy, or by the
+    # recorded cashier when policy is None. Returns per-customer waits and
+    # the longest queue any cashier had.
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    for _, cashier_number, seconds in customers:
+        totals[cashier_number] += seconds
+        counts[cashier_number] += 1
+    average = {number: totals[number] / counts[number] for number in totals}
+
+    # The rolling estimate is fed as customers are served
+    estimator = ServiceTimeEstimator()
+    engine = QueueEngine(service_time=estimator.estimate if estimate == 'rolling' else average.get)
+    engine.load(COMPANY, [(number, number, True) for number in sorted(average)], [], policy or 'shortest-queue')
+
+    arrivals = {}     # otp -> (arrival in seconds, recorded cashier, recorded seconds)
+    completions = []  # (time, cashier_number, otp, service seconds) of the customers at the counters
+    waits = []
+    longest = 0
+
+    def start(cashier_number, otp, now):
+        arrived, recorded_cashier, seconds = arrivals[otp]
+        waits.append(now - arrived)
+        service = seconds / average[recorded_cashier] * average[cashier_number]
+        heapq.heappush(completions, (now + service, cashier_number, otp, service))
+
+    def serve_until(moment):
+        # Finish every service due by moment, calling the next customer each time
+        while completions and completions[0][0] <= moment:
+            now, cashier_number, otp, service = heapq.heappop(completions)
+            estimator.record(cashier_number, service)
+            if estimate == 'rolling':
+                engine.refresh_estimates(COMPANY, [cashier_number])
+            queue = engine.get(COMPANY, cashier_number)
+            next_otp = queue.waiting[0] if queue.waiting else None
+            engine.advance(COMPANY, cashier_number, otp, next_otp)
+            if next_otp is not None:
+                start(cashier_number, next_otp, now)
+
+    origin = customers[0][0] if customers else None
+    for index, (joined, cashier_number, seconds) in enumerate(customers):
+        now = (joined - origin).total_seconds()
+        serve_until(now)
+        otp = str(index)
+        arrivals[otp] = (now, cashier_number, seconds)
+        if policy is None:
+            # Recorded cashier: queue there directly
+            queue = engine.get(COMPANY, cashier_number)
+            position = len(queue) + 1
+            if position == 1:
+                queue.serving = otp
+            else:
+                queue.waiting.append(otp)
+        else:
+            queue, position = engine.join(COMPANY, otp)
+        longest = max(longest, position)
+        if position == 1:
+            start(queue.cashier_number, otp, now)
+    serve_until(float('inf'))
+    return waits, longest
+
+
+def summarize(waits, longest):
+    ordered = sorted(waits)
+    return {
+        'customers': len(ordered),
+        'mean_wait_s': round(sum(ordered) / len(ordered), 1) if ordered else 0.0,
+        'p50_wait_s': round(percentile(ordered, 0.50), 1),
+        'p90_wait_s': round(percentile(ordered, 0.90), 1),
+        'p99_wait_s': round(percentile(ordered, 0.99), 1),
+        'max_wait_s': round(ordered[-1], 1) if ordered else 0.0,
+        'longest_queue': longest
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare routing policies on replayed queue history')
+    parser.add_argument('source', type=argparse.FileType('r', encoding='utf-8'), metavar='FILE',
+                        help='History export, CSV or NDJSON')
+    parser.add_argument('--format', dest='fmt', choices=list(EXPORT_FORMATS), help='Defaults to the file extension')
+    parser.add_argument('--policies', nargs='+', choices=list(ROUTING_POLICIES), default=list(ROUTING_POLICIES))
+    parser.add_argument('--estimate', choices=ESTIMATES, default='rolling',
+                        help='Service times given to shortest-expected-completion')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    fmt = args.fmt or ('ndjson' if args.source.name.endswith(('.ndjson', '.jsonl')) else 'csv')
+    customers = read_history(args.source, fmt)
+    if not customers:
+        sys.exit('No served customers with a service time in the export')
+
+    results = {'recorded': summarize(*replay(customers, None))}
+    for policy in args.policies:
+        results[policy] = summarize(*replay(customers, policy, args.estimate))
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'parameters': {'source': args.source.name, 'format': fmt, 'policies': args.policies,
+                       'estimate': args.estimate},
+        'cashiers': len({customer[1] for customer in customers}),
+        'policies': results
+    }
+
+    body = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# service_profiles.py - Time-of-day service-time profiles per cashier
+# A batch job (the compute-service-profiles command) loads the served
+# records of the last PROFILE_DAYS in columnar form, as column strings
+# joined by the database, and computes with NumPy service-time quantiles
+# for every cashier, weekday and hour (UTC) in one sort, instead of a Python
+# loop over the rows. Each cashier's profile is
+# stored as a compact float32 table (QUANTILES x SLOTS); request handlers
+# read the slot for the current hour in O(1) and fall back to the rolling
+# estimate (wait_estimator.py) where a slot has too few records.
+#
+# NumPy is only imported by the batch job; reading profiles needs the
+# standard library only.
+
+import math
+import sys
+from array import array
+
+QUANTILES = (0.5, 0.9)  # The estimate uses the first, the median
+SLOTS = 7 * 24          # Weekday (Monday first) x hour
+MIN_SAMPLES = 5         # Records a slot needs before its quantiles are used
+PROFILE_DAYS = 90       # History the job reads
+PROFILE_BATCH_IDS = 250000  # Range of history ids joined per query
+
+
+def slot_of(moment):
+    return moment.weekday() * 24 + moment.hour
+
+
+class ServiceProfile:
+    # One cashier's table, decoded from the stored bytes
+    __slots__ = ('values',)
+
+    def __init__(self, packed):
+        self.values = array('f')
+        self.values.frombytes(packed)
+        if sys.byteorder == 'big':
+            self.values.byteswap()  # Stored little-endian
+
+    def quantile(self, moment, index=0):
+        # Service time in seconds for the slot holding moment, or None
+        value = self.values[index * SLOTS + slot_of(moment)]
+        return None if math.isnan(value) else value
+
+
+def moment_slots(moments):
+    # slot_of() for a datetime64 array
+    import numpy as np
+    hours = moments.astype('datetime64[h]').astype(np.int64)
+    # 1970-01-01 was a Thursday, weekday 3 with Monday as 0
+    return ((hours // 24 + 3) % 7) * 24 + hours % 24
+
+
+def read_joined(batches, dtypes):
+    # Columns joined into comma-separated strings by the database
+    # (aggregate_strings), one tuple of strings per batch, into one NumPy
+    # array per column. The text is parsed in C, not row by row.
+    import numpy as np
+    columns = [[] for _ in dtypes]
+    for batch in batches:
+        if batch[0] is None:
+            continue  # No records in this batch
+        for column, text, dtype in zip(columns, batch, dtypes):
+            if np.dtype(dtype).kind == 'M':
+                column.append(np.array(text.split(','), dtype=dtype))
+            else:
+                column.append(np.fromstring(text, dtype=dtype, sep=','))
+    return [np.concatenate(column) if column else np.array([], dtype=dtype)
+            for column, dtype in zip(columns, dtypes)]
+
+
+def expand_groups(group_keys, group_slots, group_seconds):
+    # Records already grouped by cashier and slot (e.g. by a MongoDB $group
+    # with $push) back into flat (keys, slots, seconds) arrays
+    import numpy as np
+    counts = [len(seconds) for seconds in group_seconds]
+    seconds = np.concatenate([np.asarray(values, dtype=np.float64) for values in group_seconds] or [[]])
+    return (np.repeat(np.array(group_keys, dtype=object), counts),
+            np.repeat(np.array(group_slots, dtype=np.int64), counts), seconds)
+
+
+def compute_profiles(keys, slots, seconds, quantiles=QUANTILES, min_samples=MIN_SAMPLES):
+    # keys: cashier key per record (ints or strings), slots: weekday-hour
+    # slot per record (see moment_slots), seconds: service times. Returns
+    # {key: (records, packed table bytes)} with NaN in slots holding fewer
+    # than min_samples records.
+    import numpy as np
+    if len(keys) == 0:
+        return {}
+    unique_keys, key_index = np.unique(keys, return_inverse=True)
+    groups = key_index * SLOTS + slots
+
+    # Sort by group, then by service time, and find where each group starts
+    order = np.lexsort((seconds, groups))
+    groups = groups[order]
+    values = seconds[order].astype(np.float64)
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    counts = np.diff(np.r_[starts, len(groups)])
+    present = groups[starts]
+
+    # Linear interpolation between the closest ranks, as numpy.quantile does
+    tables = np.full((len(unique_keys), len(quantiles), SLOTS), np.nan, dtype='<f4')
+    for index, q in enumerate(quantiles):
+        rank = starts + q * (counts - 1)
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        quantile = values[lower] + (values[upper] - values[lower]) * (rank - lower)
+        quantile[counts < min_samples] = np.nan
+        tables[present // SLOTS, index, present % SLOTS] = quantile
+
+    records = np.bincount(key_index, minlength=len(unique_keys))
+    return {key.item() if hasattr(key, 'item') else key: (int(total), table.tobytes())
+            for key, total, table in zip(unique_keys, records, tables)}
@@ -0,0 +1,53 @@
+# sql_schema.py - Tables, columns and indexes for the SQL app variants
+# db.create_all() only adds missing tables, so columns and indexes added after
+# a database was first created are added here, in place, on every start.
+
+from sqlalchemy import inspect, text
+
+from routing import DEFAULT_POLICY
+
+# Running statistics tables, maintained as history is written
+STATS_TABLES = ('company_stats', 'company_hourly_stats', 'cashier_hourly_stats')
+
+
+def upgrade_schema(db):
+    # Create whatever is missing. Returns the statistics tables that were
+    # created next to an existing history, which need a backfill from it.
+    existing_tables = inspect(db.engine).get_table_names()
+    missing_stats = []
+    if 'queue_history' in existing_tables:
+        missing_stats = [table for table in STATS_TABLES if table not in existing_tables]
+    db.create_all()
+
+    columns = {table: [column['name'] for column in inspect(db.engine).get_columns(table)]
+               for table in ('customer', 'queue_history', 'cashier', 'company')}
+    if 'ticket' not in columns['customer']:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE customer ADD COLUMN ticket INTEGER'))
+            # Row ids follow join order, so existing queues keep their order
+            connection.execute(text('UPDATE customer SET ticket = id'))
+    if 'recorded_at' not in columns['queue_history']:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE queue_history ADD COLUMN recorded_at DATETIME'))
+            connection.execute(text('UPDATE queue_history SET recorded_at = COALESCE(served_time, join_time)'))
+    if 'last_ticket' not in columns['cashier']:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE cashier ADD COLUMN last_ticket INTEGER NOT NULL DEFAULT 0'))
+            # Counters continue from the highest ticket each cashier has issued
+            connection.execute(text(
+                'UPDATE cashier SET last_ticket = COALESCE('
+                '(SELECT MAX(ticket) FROM customer WHERE customer.cashier_id = cashier.id), 0)'
+            ))
+    if 'routing_policy' not in columns['company']:
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE company ADD COLUMN routing_policy VARCHAR(40) NOT NULL DEFAULT '{DEFAULT_POLICY}'"
+            ))
+
+    # Indexes added after a database was first created
+    for index in [index for table in db.metadata.sorted_tables for index in table.indexes]:
+        try:
+            index.create(db.engine, checkfirst=True)
+        except Exception as e:
+            print(f"Could not create index {index.name}: {str(e)}")
+    return missing_stats
@@ -0,0 +1,87 @@
+# status_board.py - Change versions for customer-facing queue status
+# Every cashier's queue carries a version that is bumped after a write that can
+# change a waiting customer's position, status or estimate. check_status uses it
+# to answer If-None-Match without a query and to park long-polls until a change.
+#
+# Versions are "<epoch>-<count>", where the epoch is a random id picked when the
+# worker starts. Counters of different workers (or of one worker before and
+# after a restart) can reach the same count, but never carry the same epoch, so
+# an ETag from another worker is simply not matched.
+#
+# ETags also carry an HMAC of the OTP and cashier key under a per-worker key,
+# so the board only answers for pairs this worker has looked up itself; a
+# made-up cashier key can neither get a 304 nor park a waiter.
+
+import hashlib
+import hmac
+import secrets
+import threading
+import uuid
+
+from gevent.event import Event
+
+MAX_LONG_POLL_SECONDS = 30
+
+
+class StatusBoard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}   # cashier_key -> changes seen by this worker
+        self._waiters = {}  # cashier_key -> [Event set on the next bump, greenlets waiting on it]
+        self.epoch = uuid.uuid4().hex[:12]
+        self._key = secrets.token_bytes(16)
+
+    def version(self, cashier_key):
+        return f"{self.epoch}-{self._counts.get(str(cashier_key), 0)}"
+
+    def bump(self, cashier_key):
+        cashier_key = str(cashier_key)
+        with self._lock:
+            self._counts[cashier_key] = self._counts.get(cashier_key, 0) + 1
+            waiter = self._waiters.pop(cashier_key, None)
+        if waiter is not None:
+            waiter[0].set()
+        return self.version(cashier_key)
+
+    def wait(self, cashier_key, since, timeout):
+        # Park the greenlet until the version moves past `since` or the timeout
+        # expires; returns the current version either way
+        cashier_key = str(cashier_key)
+        if timeout > 0 and self.version(cashier_key) == since:
+            with self._lock:
+                waiter = self._waiters.get(cashier_key)
+                if waiter is None:
+                    waiter = self._waiters[cashier_key] = [Event(), 0]
+                waiter[1] += 1
+            waiter[0].wait(min(timeout, MAX_LONG_POLL_SECONDS))
+            with self._lock:
+                waiter[1] -= 1
+                # Timed out with nobody else waiting: a key that is never
+                # bumped must not keep its Event
+                if not waiter[1] and self._waiters.get(cashier_key) is waiter:
+                    del self._waiters[cashier_key]
+        return self.version(cashier_key)
+
+    def waiting(self):
+        # Cashier keys with parked long-polls
+        return len(self._waiters)
+
+    def etag(self, otp, cashier_key):
+        return f"{otp}.{cashier_key}.{self.version(cashier_key)}.{self._sign(otp, cashier_key)}"
+
+    def match(self, if_none_match, otp):
+        # Parse an ETag we issued for this OTP: returns (cashier_key, version) or None
+        if not if_none_match:
+            return None
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            parts = tag.strip('"').split('.')
+            if (len(parts) == 4 and parts[0] == otp and parts[2].startswith(self.epoch + '-')
+                    and hmac.compare_digest(parts[3], self._sign(otp, parts[1]))):
+                return parts[1], parts[2]
+        return None
+
+    def _sign(self, otp, cashier_key):
+        return hmac.new(self._key, f"{otp}.{cashier_key}".encode(), hashlib.sha256).hexdigest()[:16]
@@ -0,0 +1,182 @@
+# store_benchmark.py - Micro-benchmarks for the queue stores
+# Times each QueueStore operation on every backend, so a store change is
+# measured side by side. The contract the stores meet is checked by
+# tests/test_queue_store.py.
+#
+#   python store_benchmark.py                      # memory, sqlalchemy, mongodb (mongomock)
+#   python store_benchmark.py --stores memory sqlalchemy --operations 5000
+#   python store_benchmark.py --mongo-uri mongodb://localhost:27017/store_bench
+#
+# --mongo-uri must name a scratch database: its queue collections are dropped.
+# Timings are per operation, in microseconds.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmark import git_revision, percentile
+from queue_store import MemoryQueueStore, MongoQueueStore
+
+STORES = ('memory', 'sqlalchemy', 'mongodb')
+HISTORY_BATCH = 100
+
+
+# Backends: each returns (store, cashier_ids, company_id, cleanup)
+
+def open_memory(cashiers):
+    return MemoryQueueStore(), list(range(1, cashiers + 1)), 1, None
+
+
+def open_sqlalchemy(cashiers):
+    # The SQL store needs the app's models, so import app against a scratch file
+    workdir = tempfile.mkdtemp(prefix='store-bench-')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(workdir, 'store.db')}"
+    os.environ['QR_CACHE_DIR'] = os.path.join(workdir, 'qr_cache')
+    os.environ.pop('MESSAGE_BUS_URL', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # Startup messages go to stderr, keeping stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as module
+    from benchmark import seed_sql
+
+    setup = seed_sql(module, cashiers)
+    context = module.app.app_context()
+    context.push()
+
+    def cleanup():
+        context.pop()
+        module.history_archiver.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return module.queue_store, setup['cashier_ids'], setup['company_id'], cleanup
+
+
+def open_mongodb(cashiers, mongo_uri=None):
+    if mongo_uri:
+        import pymongo
+        db = pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=5000).get_default_database()
+    else:
+        import mongomock
+        db = mongomock.MongoClient()['store_bench']
+    for name in ('customers', 'ticket_counters', 'queue_history', 'company_stats', 'company_hourly_stats',
+                 'cashier_hourly_stats'):
+        db.drop_collection(name)
+    # The indexes app_mongodb creates for these operations
+    db.customers.create_index([('otp', 1), ('active', 1)], unique=True,
+                              partialFilterExpression={'active': True})
+    db.customers.create_index([('cashier_id', 1), ('status', 1), ('ticket', 1)])
+    db.customers.create_index('otp')
+    db.customers.create_index('cashier_id', unique=True, name='one_serving_per_cashier',
+                              partialFilterExpression={'status': 'serving'})
+    return MongoQueueStore(db), [f"cashier-{i}" for i in range(1, cashiers + 1)], 'company-1', None
+
+
+# Micro-benchmarks
+
+def timed(samples, operation, *args):
+    started = time.perf_counter()
+    result = operation(*args)
+    samples.append(time.perf_counter() - started)
+    return result
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        'operations': len(ordered),
+        'ops_per_s': round(len(ordered) / total, 1) if total else 0.0,
+        'mean_us': round(total / len(ordered) * 1e6, 1) if ordered else 0.0,
+        'p50_us': round(percentile(ordered, 0.50) * 1e6, 1),
+        'p99_us': round(percentile(ordered, 0.99) * 1e6, 1)
+    }
+
+
+def run_benchmarks(store, cashier_ids, company_id, operations):
+    now = datetime.utcnow()
+    samples = {name: [] for name in ('issue_ticket', 'join', 'lookup_otp', 'position', 'advance', 'record_history', 'company_stats')}
+
+    # join: customers spread round-robin over the cashiers, each taking a
+    # ticket from their cashier's counter
+    customers = []
+    for i in range(operations):
+        cashier_id = cashier_ids[i % len(cashier_ids)]
+        ticket = timed(samples['issue_ticket'], store.issue_ticket, cashier_id)
+        otp = f"{i:06d}"
+        customer = {'cashier_id': cashier_id, 'otp': otp, 'position': ticket, 'ticket': ticket, 'join_time': now}
+        customer['id'] = timed(samples['join'], store.add_customer, customer)
+        customers.append(customer)
+
+    # lookup by OTP and live position
+    for customer in customers:
+        record = timed(samples['lookup_otp'], store.find_by_otp, customer['otp'])
+        timed(samples['position'], store.queue_position, record)
+
+    # advance: serve the customer at the counter, which calls the next one
+    by_otp = {customer['otp']: customer for customer in customers}
+    for cashier_id in cashier_ids:
+        otp = store.promote_next(cashier_id, now)
+        while otp is not None:
+            _, otp = timed(samples['advance'], store.serve, by_otp[otp]['id'], cashier_ids, now)
+
+    # stats: batched history writes, then reads of the running totals
+    for start in range(0, operations, HISTORY_BATCH):
+        batch = [{'company_id': company_id, 'cashier_number': 1, 'otp': f"{i:06d}", 'join_time': now,
+                  'served_time': now, 'wait_time_seconds': i % 300, 'status': 'served', 'delays': 0}
+                 for i in range(start, min(start + HISTORY_BATCH, operations))]
+        timed(samples['record_history'], store.record_history, batch)
+    for _ in range(operations):
+        timed(samples['company_stats'], store.company_stats, company_id)
+
+    return {name: summarize(values) for name, values in samples.items()}
+
+
+def run_store(name, args):
+    if name == 'memory':
+        opened = open_memory(args.cashiers)
+    elif name == 'sqlalchemy':
+        opened = open_sqlalchemy(args.cashiers)
+    else:
+        opened = open_mongodb(args.cashiers, args.mongo_uri)
+    store, cashier_ids, company_id, cleanup = opened
+    try:
+        return run_benchmarks(store, cashier_ids, company_id, args.operations)
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the queue store backends')
+    parser.add_argument('--stores', nargs='+', choices=STORES, default=list(STORES))
+    parser.add_argument('--cashiers', type=int, default=4)
+    parser.add_argument('--operations', type=int, default=1000, help='Operations per benchmark')
+    parser.add_argument('--mongo-uri', help='Scratch MongoDB database instead of mongomock')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'stores': {name: run_store(name, args) for name in args.stores}
+    }
+
+    body = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# conftest.py - Fixtures shared by the test suite
+# Each app variant is loaded from its file under a fresh module name, so a test
+# can run several workers of one variant side by side against one throwaway
+# database. app_mongodb runs on mongomock, or on the scratch database in
+# TEST_MONGODB_URI when it is set (it is seeded in place).
+
+import functools
+import importlib.util
+import itertools
+import os
+import sys
+import threading
+
+import pytest
+
+import benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# mongomock emits no command events, so its collection methods are counted
+# instead, as the command each one sends to a real server
+MONGOMOCK_COMMANDS = {
+    'find': 'find', 'find_one': 'find',
+    'insert_one': 'insert', 'insert_many': 'insert',
+    'update_one': 'update', 'update_many': 'update', 'replace_one': 'update',
+    'delete_one': 'delete', 'delete_many': 'delete',
+    'find_one_and_update': 'findAndModify', 'find_one_and_replace': 'findAndModify',
+    'find_one_and_delete': 'findAndModify',
+    'aggregate': 'aggregate', 'count_documents': 'aggregate',
+    'distinct': 'distinct', 'bulk_write': 'bulkWrite', 'create_index': 'createIndexes'
+}
+
+_instances = itertools.count()
+
+
+def count_mongomock_commands(monkeypatch, metrics):
+    # Report mongomock collection calls to every AppMetrics in metrics; calls
+    # mongomock makes to itself (find_one -> find) are not counted again
+    from mongomock.collection import Collection
+
+    nested = threading.local()
+
+    def counted(method, command):
+        @functools.wraps(method)
+        def call(self, *args, **kwargs):
+            depth = getattr(nested, 'depth', 0)
+            if not depth:
+                for app_metrics in metrics:
+                    app_metrics.count_db_operation('mongodb', command)
+            nested.depth = depth + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                nested.depth = depth
+        return call
+
+    for name, command in MONGOMOCK_COMMANDS.items():
+        monkeypatch.setattr(Collection, name, counted(getattr(Collection, name), command))
+
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    # load_app(app_name, bus=None) -> a new worker of the variant; bus is a
+    # MESSAGE_BUS_URL shared by the workers that should see each other
+    monkeypatch.setenv('SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'queue.db'}")
+    monkeypatch.setenv('QR_CACHE_DIR', str(tmp_path / 'qr_cache'))
+    mongo = []
+    mongo_metrics = []
+    loaded = []
+
+    def load(app_name, bus=None):
+        if bus:
+            monkeypatch.setenv('MESSAGE_BUS_URL', bus)
+        else:
+            monkeypatch.delenv('MESSAGE_BUS_URL', raising=False)
+        if app_name == 'app_mongodb' and os.getenv('TEST_MONGODB_URI'):
+            monkeypatch.setenv('MONGODB_URI', os.environ['TEST_MONGODB_URI'])
+        elif app_name == 'app_mongodb':
+            import flask_pymongo
+            import mongomock
+            if not mongo:
+                mongo.append(mongomock.MongoClient())
+                count_mongomock_commands(monkeypatch, mongo_metrics)
+
+            class MockPyMongo:
+                def __init__(self, app=None, **kwargs):
+                    self.cx = mongo[0]
+                    self.db = mongo[0]['virtual_queue_test']
+
+            monkeypatch.setattr(flask_pymongo, 'PyMongo', MockPyMongo)
+
+        name = f"{app_name}_worker_{next(_instances)}"
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, f"{app_name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, name, module)
+        spec.loader.exec_module(module)
+        loaded.append(module)
+        if mongo and app_name == 'app_mongodb':
+            mongo_metrics.append(module.app_metrics)
+        return module
+
+    yield load
+    for module in loaded:
+        module.history_archiver.close()
+
+
+@pytest.fixture
+def seed():
+    # seed(module, cashiers) -> {'company_id', 'cashier_ids'} of the benchmark
+    # company, whose admin logs in with benchmark.BENCH_USER/BENCH_PASSWORD
+    def seed(module, cashiers=3):
+        if hasattr(module, 'mongo'):
+            return benchmark.seed_mongo(module, cashiers)
+        return benchmark.seed_sql(module, cashiers)
+    return seed
+
+
+@pytest.fixture
+def query_budget():
+    # with query_budget(module, limit, label) as used: counts the database
+    # operations the block issues through the app on this thread and raises
+    # metrics.QueryBudgetExceeded past limit; used['operations'] lists them
+    def query_budget(module, limit, label='block'):
+        return module.app_metrics.query_budget(limit, label)
+    return query_budget
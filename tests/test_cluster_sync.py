@@ -0,0 +1,112 @@
+# test_cluster_sync.py - Workers sharing a message bus (message_bus.py)
+
+import flask_socketio.test_client
+import gevent
+import pytest
+
+import message_bus
+from benchmark import BENCH_COMPANY_CODE, BENCH_PASSWORD, BENCH_USER
+
+JOIN = f"/api/join_queue/{BENCH_COMPANY_CODE}"
+
+
+@pytest.fixture
+def workers(load_app, seed, tmp_path):
+    # Two workers of app.py on one database and one bus, with a single cashier
+    bus = f"local://{tmp_path.name}"
+    first, second = load_app('app', bus=bus), load_app('app', bus=bus)
+    seed(first, cashiers=1)
+    return first, second
+
+
+def test_customer_turn_reaches_a_customer_connected_to_another_worker(workers, monkeypatch):
+    # The test client refuses any PubSubManager; BusManager delivers to local
+    # clients like the in-process manager once a message is off the bus
+    monkeypatch.setattr(flask_socketio.test_client, 'PubSubManager', type('NoPubSubManager', (), {}))
+    worker_a, worker_b = workers
+    client = worker_a.app.test_client()
+    served, waiting = [client.post(JOIN).get_json() for _ in range(2)]
+
+    customer = worker_b.socketio.test_client(worker_b.app)
+    customer.emit('join_customer_room', {'otp': waiting['otp']})
+    gevent.sleep(0.05)
+
+    client.post('/login', data={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+    with worker_a.app.app_context():
+        customer_id = worker_a.Customer.query.filter_by(otp=served['otp']).one().id
+    assert client.post(f"/api/serve_customer/{customer_id}").get_json()['next_otp'] == waiting['otp']
+    gevent.sleep(0.1)
+
+    turns = [event['args'][0] for event in customer.get_received() if event['name'] == 'customer_turn']
+    assert turns == [{'otp': waiting['otp'], 'cashier_number': 1, 'company_code': BENCH_COMPANY_CODE}]
+
+
+def test_joins_on_two_workers_get_distinct_tickets(workers):
+    clients = [worker.app.test_client() for worker in workers]
+    otps = [clients[index % 2].post(JOIN).get_json()['otp'] for index in range(6)]
+    gevent.sleep(0.05)
+
+    worker_a = workers[0]
+    with worker_a.app.app_context():
+        tickets = [worker_a.Customer.query.filter_by(otp=otp).one().ticket for otp in otps]
+    assert tickets == [1, 2, 3, 4, 5, 6]
+    # Each worker's queue engine was refreshed with the other's joins
+    positions = [clients[1].get(f"/api/check_status/{otp}").get_json()['position'] for otp in otps]
+    assert positions == [1, 2, 3, 4, 5, 6]
+
+
+def test_status_etags_only_match_on_the_worker_that_issued_them(workers):
+    clients = [worker.app.test_client() for worker in workers]
+    otp = clients[0].post(JOIN).get_json()['otp']
+    gevent.sleep(0.05)
+
+    etag = clients[0].get(f"/api/check_status/{otp}").headers['ETag']
+    assert clients[0].get(f"/api/check_status/{otp}", headers={'If-None-Match': etag}).status_code == 304
+    # The other worker's counter may have reached the same count, but not the same epoch
+    assert clients[1].get(f"/api/check_status/{otp}", headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_subscription_is_taken_again_after_the_bus_fails(monkeypatch):
+    monkeypatch.setattr(message_bus, 'RECONNECT_MIN_SECONDS', 0.01)
+
+    class FlakyBus:
+        def __init__(self):
+            self.subscriptions = 0
+
+        def listen(self, channel):
+            self.subscriptions += 1
+            return self._messages(self.subscriptions)
+
+        def _messages(self, subscription):
+            yield {'subscription': subscription}
+            if subscription < 3:
+                raise ConnectionError('connection reset')
+
+    bus = FlakyBus()
+    messages = message_bus.subscribe(bus, 'test')
+    assert bus.subscriptions == 1
+    assert [next(messages) for _ in range(3)] == [{'subscription': 1}, {'subscription': 2}, {'subscription': 3}]
+
+
+@pytest.mark.parametrize('app_name', ['app', 'app_sqlite'])
+def test_service_times_from_another_worker_re_rank_its_cashiers(app_name, load_app, seed, tmp_path, caplog):
+    # The handler runs in the bus listener, outside any request; with a cold
+    # profile cache it reads the database
+    bus = f"local://{tmp_path.name}"
+    worker_a, worker_b = load_app(app_name, bus=bus), load_app(app_name, bus=bus)
+    setup = seed(worker_a, cashiers=2)
+    company_id, (first, _) = setup['company_id'], setup['cashier_ids']
+    with worker_a.app.app_context():
+        worker_a.set_routing_policy(worker_a.db.session.get(worker_a.Company, company_id),
+                                    'shortest-expected-completion')
+    gevent.sleep(0.05)
+
+    client = worker_b.app.test_client()
+    assert sorted(client.post(JOIN).get_json()['cashier_number'] for _ in range(4)) == [1, 1, 2, 2]
+    worker_b.lookup_cache.clear()
+    # What worker A publishes after serving a customer at cashier 1 in 10 s
+    worker_a.cluster.publish('service_time', cashier_key=first, seconds=10, company_id=company_id)
+    gevent.sleep(0.05)
+
+    assert not [record for record in caplog.records if record.levelname == 'ERROR']
+    assert [client.post(JOIN).get_json()['cashier_number'] for _ in range(3)] == [1, 1, 1]
@@ -0,0 +1,58 @@
+# test_history_export.py - Streaming history exports (history_export.py)
+
+import csv
+import io
+from datetime import datetime, timedelta
+
+import pytest
+
+from benchmark import BENCH_PASSWORD, BENCH_USER
+
+
+@pytest.fixture
+def exporting(load_app, seed, monkeypatch):
+    # app.py with 7 history records, five of them sharing a join time, read
+    # 3 at a time; yields (module, client, company_id, otps in export order)
+    module = load_app('app')
+    setup = seed(module, cashiers=1)
+    monkeypatch.setattr(module, 'FETCH_ROWS', 3)
+    joined = datetime(2026, 1, 5, 9)
+    otps = [f"{100000 + n}" for n in range(7)]
+    for n, otp in enumerate(otps):
+        module.history_archiver.submit({
+            'company_id': setup['company_id'], 'cashier_id': setup['cashier_ids'][0], 'cashier_number': 1,
+            'otp': otp, 'join_time': joined + timedelta(minutes=max(n - 4, 0)), 'served_time': None,
+            'wait_time_seconds': None, 'status': 'removed', 'delays': 0
+        })
+    module.history_archiver.flush()
+    client = module.app.test_client()
+    client.post('/login', data={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+    yield module, client, setup['company_id'], otps
+
+
+def test_pages_cover_every_record_once_in_join_order(exporting):
+    module, client, company_id, otps = exporting
+    rows = list(csv.DictReader(io.StringIO(client.get(f"/api/export/{company_id}").get_data(as_text=True))))
+    assert [row['otp'] for row in rows] == otps
+    rows = list(csv.DictReader(io.StringIO(
+        client.get(f"/api/export/{company_id}?from=2026-01-05T09:01:00").get_data(as_text=True))))
+    assert [row['otp'] for row in rows] == otps[5:]
+
+
+def test_a_slow_download_does_not_block_writes(exporting, monkeypatch):
+    module, client, company_id, otps = exporting
+    monkeypatch.setattr('history_export.CHUNK_ROWS', 1)
+    response = client.get(f"/api/export/{company_id}?format=ndjson", buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    next(chunks)
+
+    # Without WAL an open read transaction would hold off this write until
+    # the busy timeout, then fail with "database is locked"
+    with module.app.app_context():
+        with module.db.engine.connect() as connection:
+            connection.exec_driver_sql('PRAGMA busy_timeout = 100')
+            connection.execute(module.db.update(module.Cashier).values(last_ticket=module.Cashier.last_ticket + 1))
+            connection.commit()
+    assert len(list(chunks)) == 5
+    response.close()
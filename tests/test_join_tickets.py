@@ -0,0 +1,57 @@
+# test_join_tickets.py - Concurrent joins and OTP collisions keep tickets gap-free
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmark import APPS, BENCH_COMPANY_CODE
+from join_stress import check, stored_queues
+
+JOINS = 400
+THREADS = 16
+
+
+@pytest.mark.parametrize('app_name', APPS)
+def test_a_retry_at_another_cashier_leaves_no_gap(app_name, load_app, seed, monkeypatch):
+    # The active-OTP unique index is what rejects the collision
+    monkeypatch.setenv('MONGO_INDEXES', 'startup')
+    module = load_app(app_name)
+    seed(module, cashiers=2)
+    client = module.app.test_client()
+
+    def join():
+        return client.post(f"/api/join_queue/{BENCH_COMPANY_CODE}").get_json()['otp']
+
+    otps = [join(), join()]
+    # The next join draws an OTP still in the queue, at the cashier assigned
+    # longest ago; its retry goes to the other cashier
+    allocate = module.otp_allocator.allocate
+    codes = iter([otps[0]])
+    monkeypatch.setattr(module.otp_allocator, 'allocate', lambda: next(codes, None) or allocate())
+    otps += [join() for _ in range(4)]
+
+    tickets = {}
+    with module.app.app_context():
+        for otp in otps:
+            customer = module.queue_store.find_by_otp(otp)
+            tickets.setdefault(str(customer['cashier_id']), []).append(customer['ticket'])
+    assert [sorted(cashier_tickets) for cashier_tickets in tickets.values()] == [[1, 2, 3], [1, 2, 3]]
+
+
+@pytest.mark.parametrize('app_name', ['app', 'app_sqlite'])
+def test_concurrent_joins_on_two_workers_keep_tickets_gap_free(app_name, load_app, seed, tmp_path):
+    # Two workers on one SQLite file and no bus, so their queue engines go
+    # stale and only the ticket counters keep the joins apart
+    workers = [load_app(app_name), load_app(app_name)]
+    setup = seed(workers[0], cashiers=3)
+
+    def join(index):
+        response = workers[index % 2].app.test_client().post(f"/api/join_queue/{BENCH_COMPANY_CODE}")
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.get_json()['otp']
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        otps = list(pool.map(join, range(JOINS)))
+    queues, counters = stored_queues(app_name, str(tmp_path / 'queue.db'), setup, None)
+    assert check(queues, counters, otps) == []
+    assert sum(len(customers) for customers in queues.values()) == JOINS
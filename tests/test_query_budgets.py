@@ -0,0 +1,55 @@
+# test_query_budgets.py - Database operation budgets for the hot routes
+# Each hot route runs once through the Flask test client, with warm lookup
+# caches, against a company whose every queue holds QUEUE_LENGTH customers, so
+# a change that queries per customer or per cashier (N+1) goes over budget.
+
+import pytest
+
+from benchmark import APPS, BENCH_COMPANY_CODE, BENCH_PASSWORD, BENCH_USER
+
+CASHIERS = 3
+QUEUE_LENGTH = 10  # Customers per cashier before the routes are measured
+
+# Operations per request once the lookup caches are warm; the same for SQL
+# statements and MongoDB commands
+BUDGETS = {
+    'join_queue': 2,         # Ticket counter, insert; cashier choice comes from the queue engine
+    'check_status': 2,       # Customer, position count; cashier details are cached
+    'queue_status': 2,       # Customer, position count; cashier and company are cached
+    'get_cashier_queue': 3,  # Cashier, company, the whole queue in one query
+    'manage_company': 3      # Company, cashiers, materialized stats
+}
+
+ADMIN_ROUTES = ('get_cashier_queue', 'manage_company')
+
+
+def route(name, setup, otp):
+    return {
+        'join_queue': ('POST', f"/api/join_queue/{BENCH_COMPANY_CODE}"),
+        'check_status': ('GET', f"/api/check_status/{otp}"),
+        'queue_status': ('GET', f"/queue_status/{otp}"),
+        'get_cashier_queue': ('GET', f"/api/get_cashier_queue/{setup['cashier_ids'][0]}"),
+        'manage_company': ('GET', f"/manage_company/{setup['company_id']}")
+    }[name]
+
+
+@pytest.mark.parametrize('name', list(BUDGETS))
+@pytest.mark.parametrize('app_name', APPS)
+def test_route_is_within_its_budget(app_name, name, load_app, seed, query_budget):
+    module = load_app(app_name)
+    if name in ADMIN_ROUTES and name not in module.app.view_functions:
+        pytest.skip(f"{app_name} has no {name} route")
+    setup = seed(module, CASHIERS)
+
+    client = module.app.test_client()
+    otps = [client.post(f"/api/join_queue/{BENCH_COMPANY_CODE}").get_json()['otp']
+            for _ in range(CASHIERS * QUEUE_LENGTH)]
+    client.post('/login', data={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+    module.history_archiver.flush()
+
+    method, path = route(name, setup, otps[len(otps) // 2])
+    # Warm the lookup caches first; the budget is for steady state
+    client.open(path, method=method)
+    with query_budget(module, BUDGETS[name], name):
+        response = client.open(path, method=method)
+    assert response.status_code < 400
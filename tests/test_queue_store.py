@@ -0,0 +1,229 @@
+# test_queue_store.py - The contract every QueueStore backend meets
+# Runs against the memory store, the SQL store of app.py on a throwaway SQLite
+# file, and the MongoDB store on mongomock with app_mongodb's indexes.
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from company_stats import STAT_FIELDS
+from history_archiver import MAX_ATTEMPTS, HistoryArchiver
+from queue_store import MemoryQueueStore, OtpInUse
+from store_benchmark import STORES, open_mongodb
+
+CASHIERS = 2
+
+
+@pytest.fixture(params=STORES)
+def backend(request, load_app, seed):
+    # (store, cashier_ids, company_id)
+    if request.param == 'memory':
+        yield MemoryQueueStore(), list(range(1, CASHIERS + 1)), 1
+    elif request.param == 'sqlalchemy':
+        module = load_app('app')
+        setup = seed(module, CASHIERS)
+        with module.app.app_context():
+            yield module.queue_store, setup['cashier_ids'], setup['company_id']
+    else:
+        store, cashier_ids, company_id, _ = open_mongodb(CASHIERS)
+        yield store, cashier_ids, company_id
+
+
+@pytest.fixture
+def now():
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def join(store, cashier_id, otp, now, **fields):
+    # A customer with the next ticket from the cashier's counter; returns their id
+    ticket = store.issue_ticket(cashier_id)
+    return store.add_customer({'cashier_id': cashier_id, 'otp': otp, 'position': ticket, 'ticket': ticket,
+                               'join_time': now, **fields})
+
+
+def serving(store, cashier_id, otp, now):
+    return join(store, cashier_id, otp, now, status='serving', serving_start_time=now)
+
+
+def test_issue_ticket_counts_up_per_cashier(backend):
+    store, (first, second), _ = backend
+    ticket = store.issue_ticket(first)
+    assert store.issue_ticket(first) == ticket + 1
+    assert store.issue_ticket(second) == 1
+
+
+def test_return_ticket_only_takes_back_the_last_one(backend):
+    store, (cashier_id, _), _ = backend
+    ticket = store.issue_ticket(cashier_id)
+    if store.name == 'sqlalchemy':
+        # A rejected insert rolls its ticket back; there is nothing to return
+        assert store.return_ticket(cashier_id, ticket) is False
+        return
+    assert store.return_ticket(cashier_id, ticket)
+    assert store.issue_ticket(cashier_id) == ticket
+    store.issue_ticket(cashier_id)
+    assert not store.return_ticket(cashier_id, ticket)
+    assert store.issue_ticket(cashier_id) == ticket + 2
+
+
+def test_add_customer_stores_the_fields_with_defaults(backend, now):
+    store, (cashier_id, _), _ = backend
+    join(store, cashier_id, '900001', now)
+    record = store.find_by_otp('900001')
+    assert record['status'] == 'waiting' and record['delays'] == 0
+    assert record['cashier_id'] == cashier_id and record['ticket'] == 1
+    assert store.find_by_otp('999999') is None
+
+
+def test_a_queued_otp_cannot_be_issued_twice(backend, now):
+    store, (cashier_id, _), _ = backend
+    join(store, cashier_id, '900001', now)
+    with pytest.raises(OtpInUse):
+        join(store, cashier_id, '900001', now)
+
+
+def test_positions_count_earlier_tickets(backend, now):
+    store, (cashier_id, other), _ = backend
+    serving(store, cashier_id, '900001', now)
+    join(store, other, '900009', now)
+    join(store, cashier_id, '900002', now)
+    assert store.queue_position(store.find_by_otp('900001')) == 1
+    assert store.queue_position(store.find_by_otp('900002')) == 2
+
+
+def test_promote_next_needs_a_free_counter(backend, now):
+    store, (cashier_id, _), _ = backend
+    join(store, cashier_id, '900001', now)
+    join(store, cashier_id, '900002', now)
+    assert store.promote_next(cashier_id, now) == '900001'
+    assert store.promote_next(cashier_id, now) is None
+    assert store.find_by_otp('900001')['status'] == 'serving'
+
+
+def test_serve_calls_the_next_customer(backend, now):
+    store, cashier_ids, _ = backend
+    first_id = serving(store, cashier_ids[0], '900001', now)
+    join(store, cashier_ids[0], '900002', now)
+
+    customer, next_otp = store.serve(first_id, cashier_ids, now)
+    assert customer['status'] == 'served' and customer['otp'] == '900001'
+    assert customer['serving_start_time'] == now
+    assert next_otp == '900002'
+    promoted = store.find_by_otp('900002')
+    assert promoted['status'] == 'serving' and store.queue_position(promoted) == 1
+    # Finished customers keep their position at join time
+    assert store.queue_position(store.find_by_otp('900001')) == 1
+    assert store.serve(first_id, cashier_ids, now) is None
+
+
+def test_serve_needs_the_customer_at_the_counter(backend, now):
+    store, cashier_ids, _ = backend
+    serving(store, cashier_ids[0], '900001', now)
+    waiting_id = join(store, cashier_ids[0], '900002', now)
+    assert store.serve(waiting_id, cashier_ids, now) is None
+    assert store.find_by_otp('900002')['status'] == 'waiting'
+
+
+def test_transitions_check_ownership(backend, now):
+    store, (cashier_id, other), _ = backend
+    customer_id = serving(store, cashier_id, '900001', now)
+    assert store.serve(customer_id, [other], now) is None
+    assert store.delay(customer_id, [other], now) is None
+    assert store.remove(customer_id, [other], now) is None
+    assert store.find_by_otp('900001')['status'] == 'serving'
+
+
+def test_delay_sends_the_customer_to_the_back_of_the_line(backend, now):
+    store, cashier_ids, _ = backend
+    first_id = serving(store, cashier_ids[0], '900001', now)
+    join(store, cashier_ids[0], '900002', now)
+    join(store, cashier_ids[0], '900003', now)
+
+    customer, next_otp = store.delay(first_id, cashier_ids, now)
+    assert customer['status'] == 'delayed' and customer['delays'] == 1 and customer['ticket'] == 4
+    assert next_otp == '900002'
+    delayed = store.find_by_otp('900001')
+    assert delayed['ticket'] == 4 and delayed.get('serving_start_time') is None
+    assert store.queue_position(delayed) == 3
+    assert store.delay(first_id, cashier_ids, now) is None
+
+
+def test_remove_calls_the_next_customer_only_from_the_counter(backend, now):
+    store, cashier_ids, _ = backend
+    first_id = serving(store, cashier_ids[0], '900001', now)
+    second_id = join(store, cashier_ids[0], '900002', now)
+    join(store, cashier_ids[0], '900003', now)
+
+    customer, next_otp = store.remove(second_id, cashier_ids, now)
+    assert customer['status'] == 'removed' and next_otp is None
+    assert store.queue_position(store.find_by_otp('900003')) == 2
+
+    customer, next_otp = store.remove(first_id, cashier_ids, now)
+    assert customer['status'] == 'removed' and next_otp == '900003'
+    assert store.remove(first_id, cashier_ids, now) is None
+
+
+def test_finished_otps_can_be_reissued(backend, now):
+    store, cashier_ids, _ = backend
+    customer_id = serving(store, cashier_ids[0], '900001', now)
+    store.serve(customer_id, cashier_ids, now)
+    join(store, cashier_ids[0], '900001', now)
+    record = store.find_by_otp('900001')
+    assert record['status'] == 'waiting' and record['ticket'] == 2
+
+
+def test_history_and_delays_fold_into_the_stats(backend, now):
+    store, _, company_id = backend
+    assert store.company_stats('missing-company' if isinstance(company_id, str) else -1) is None
+    before = store.company_stats(company_id) or dict.fromkeys(STAT_FIELDS, 0)
+    store.record_history([
+        {'company_id': company_id, 'cashier_number': 1, 'otp': '900001', 'join_time': now,
+         'served_time': now, 'wait_time_seconds': 30, 'status': 'served', 'delays': 0},
+        {'company_id': company_id, 'cashier_number': 1, 'otp': '900003', 'join_time': now,
+         'served_time': None, 'wait_time_seconds': None, 'status': 'removed', 'delays': 1}
+    ])
+    after = store.company_stats(company_id)
+    # Delays are counted as they happen, not from the history
+    assert [after[field] - before[field] for field in STAT_FIELDS] == [1, 0, 30]
+    store.record_delay(company_id, 1, now)
+    delayed = store.company_stats(company_id)
+    assert [delayed[field] - after[field] for field in STAT_FIELDS] == [0, 1, 0]
+
+
+def test_pruning(backend, now):
+    store, cashier_ids, company_id = backend
+    store.record_history([
+        {'company_id': company_id, 'cashier_number': 1, 'otp': f"90000{i}", 'join_time': now,
+         'served_time': now, 'wait_time_seconds': 30, 'status': 'served', 'delays': 0}
+        for i in range(3)
+    ])
+    stats = store.company_stats(company_id)
+    assert store.prune_history(now - timedelta(hours=1), 1) == 0
+    assert store.prune_history(now + timedelta(seconds=1), 1) == 3
+    assert store.company_stats(company_id) == stats
+
+    served_id = serving(store, cashier_ids[0], '900001', now)
+    join(store, cashier_ids[0], '900002', now)
+    store.serve(served_id, cashier_ids, now)
+    assert store.prune_customers(now + timedelta(seconds=1), 1) == 1
+    assert store.find_by_otp('900001') is None
+    assert store.find_by_otp('900002')['status'] == 'serving'
+
+
+def test_a_partly_written_mongodb_batch_is_counted_once(now, tmp_path):
+    # One record of the batch is refused: the others are written and counted,
+    # and the one-at-a-time retries do not write or count them again
+    store, _, company_id, _ = open_mongodb(CASHIERS)
+    store.db.queue_history.create_index('otp', unique=True)
+    store.db.queue_history.insert_one({'otp': '900002'})
+    archiver = HistoryArchiver(store.record_history, dead_letter=str(tmp_path / 'dead_letter.ndjson'))
+    for i in range(1, 4):
+        archiver.submit({'company_id': company_id, 'cashier_number': 1, 'otp': f"90000{i}", 'join_time': now,
+                         'served_time': now, 'wait_time_seconds': 30, 'status': 'served', 'delays': 0})
+    for _ in range(MAX_ATTEMPTS):
+        archiver.flush(force=True)
+    assert archiver.stats()['depth'] == 1
+    assert store.db.queue_history.count_documents({'company_id': company_id}) == 2
+    stats = store.company_stats(company_id)
+    assert [stats[field] for field in STAT_FIELDS] == [2, 0, 60]
+    archiver.close()
@@ -0,0 +1,110 @@
+# test_routing.py - Routing policies and the service-time estimates behind them
+
+import pytest
+
+from queue_engine import QueueEngine
+from routing import ROUTING_POLICIES, shortest_expected_completion, validate_policy
+
+COMPANY = 'company'
+
+
+def engine_with(estimates, policy='shortest-expected-completion'):
+    # An engine over cashiers 1..n whose service times are read from
+    # estimates, a dict the test may change; records every lookup
+    lookups = []
+
+    def service_time(cashier_id):
+        lookups.append(cashier_id)
+        return estimates.get(cashier_id)
+
+    engine = QueueEngine(service_time=service_time)
+    engine.load(COMPANY, [(number, number, True) for number in sorted(estimates)], [], policy)
+    return engine, lookups
+
+
+def route(engine, joins):
+    return [engine.join(COMPANY, f"otp{n}")[0].cashier_number for n in range(joins)]
+
+
+def test_unknown_policies_are_rejected():
+    assert validate_policy('round-robin') == 'round-robin'
+    with pytest.raises(ValueError):
+        validate_policy('fastest')
+
+
+@pytest.mark.parametrize('policy', ROUTING_POLICIES)
+def test_equal_cashiers_fill_evenly(policy):
+    engine, _ = engine_with({1: 60, 2: 60, 3: 60}, policy)
+    assert route(engine, 6) == [1, 2, 3, 1, 2, 3]
+
+
+def test_faster_cashiers_take_more_customers():
+    engine, _ = engine_with({1: 30, 2: 90})
+    assert route(engine, 4) == [1, 1, 2, 1]
+
+
+def test_a_zero_estimate_is_not_free():
+    class Queue:
+        cashier_id = 1
+
+        def __len__(self):
+            return 4
+
+    assert shortest_expected_completion(Queue(), lambda cashier_id: 0) == 5
+
+    # In the engine it counts as the company's average, not as instant service
+    engine, _ = engine_with({1: 0, 2: 60, 3: None})
+    assert route(engine, 6) == [1, 2, 3, 1, 2, 3]
+
+
+def test_estimates_are_fetched_outside_the_lock():
+    owned = []
+    engine = QueueEngine(service_time=lambda cashier_id: owned.append(engine._lock._is_owned()) or 60)
+    engine.load(COMPANY, [(1, 1, True), (2, 2, True)], [], 'shortest-expected-completion')
+    engine._estimate_hours[COMPANY] = None  # The next join starts a new hour
+    route(engine, 3)
+    engine.refresh_estimates(COMPANY, [1])
+    engine.set_policy(COMPANY, 'shortest-expected-completion')
+    assert owned and not any(owned)
+
+
+def test_other_policies_never_fetch_estimates():
+    engine, lookups = engine_with({1: 60, 2: 60}, 'shortest-queue')
+    route(engine, 4)
+    engine.refresh_estimates(COMPANY)
+    assert lookups == []
+    engine.set_policy(COMPANY, 'shortest-expected-completion')
+    assert sorted(lookups) == [1, 2]
+
+
+def test_joins_read_the_estimates_kept_in_memory():
+    engine, lookups = engine_with({1: 60, 2: 60})
+    lookups.clear()
+    route(engine, 10)
+    assert lookups == []
+
+
+def test_ranks_follow_a_refreshed_estimate():
+    estimates = {1: 60, 2: 60}
+    engine, _ = engine_with(estimates)
+    route(engine, 2)
+    estimates[2] = 20
+    # Still ranked by the old estimate until the cashier is refreshed
+    assert route(engine, 2) == [1, 2]
+    engine.refresh_estimates(COMPANY, [2])
+    assert route(engine, 2) == [2, 2]
+
+
+def test_the_estimates_are_fetched_again_when_the_hour_changes(monkeypatch):
+    hour = [100]
+    monkeypatch.setattr(QueueEngine, '_hour', lambda self: hour[0])
+    estimates = {1: 60, 2: 60}
+    engine, lookups = engine_with(estimates)
+    route(engine, 2)
+    # Cashier 1 is quick in the next hour's profile
+    estimates[1] = 10
+    assert route(engine, 2) == [1, 2]
+    hour[0] += 1
+    lookups.clear()
+    assert route(engine, 3) == [1, 1, 1]
+    assert sorted(lookups) == [1, 2]
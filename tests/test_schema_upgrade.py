@@ -0,0 +1,48 @@
+# test_schema_upgrade.py - Databases created before the per-cashier rollups
+
+from datetime import datetime, timedelta
+
+import gevent
+import pytest
+from sqlalchemy import text
+
+
+def history(module, company_id, cashier_id, count, start):
+    for n in range(count):
+        module.history_archiver.submit({
+            'company_id': company_id, 'cashier_id': cashier_id, 'cashier_number': 1, 'otp': f"{200000 + n}",
+            'join_time': start + timedelta(minutes=10 * n), 'served_time': start + timedelta(minutes=10 * n + 5),
+            'wait_time_seconds': 60, 'status': 'served', 'delays': 0
+        })
+    module.history_archiver.flush()
+
+
+def rollups(module):
+    with module.app.app_context():
+        return module.db.session.execute(text(
+            'SELECT COUNT(*), SUM(total_served), SUM(total_wait_seconds) FROM cashier_hourly_stats'
+        )).one()
+
+
+@pytest.mark.parametrize('app_name', ['app', 'app_sqlite'])
+def test_rollups_are_backfilled_in_the_background(app_name, load_app, seed):
+    old = load_app(app_name)
+    setup = seed(old, cashiers=1)
+    history(old, setup['company_id'], setup['cashier_ids'][0], 12, datetime(2026, 1, 5, 9))
+    with old.app.app_context():
+        old.db.session.execute(text('DROP TABLE cashier_hourly_stats'))
+        old.db.session.commit()
+
+    # Startup returns before the backfill has run, and history is not pruned meanwhile
+    module = load_app(app_name)
+    assert module.stats_backfill_pending.is_set()
+    assert rollups(module) == (0, None, None)
+    assert module.prune_history()['history'] == 0
+    # A record written meanwhile is counted once, as it is written
+    history(module, setup['company_id'], setup['cashier_ids'][0], 1, datetime(2026, 1, 6, 9))
+    gevent.sleep(0.1)
+
+    assert not module.stats_backfill_pending.is_set()
+    assert rollups(module) == (3, 13, 13 * 60)
+    with module.app.app_context():
+        assert module.queue_store.company_stats(setup['company_id'])['total_served'] == 13
@@ -0,0 +1,54 @@
+# test_service_profiles.py - Recomputed profiles replace the cached ones
+
+from datetime import datetime
+
+import pytest
+
+from benchmark import APPS
+
+
+@pytest.mark.parametrize('app_name', APPS)
+def test_a_recompute_drops_the_cached_profiles(app_name, load_app, seed):
+    module = load_app(app_name)
+    setup = seed(module, cashiers=1)
+    cashier_id = setup['cashier_ids'][0]
+    now = datetime.utcnow()
+    for otp in range(100001, 100011):
+        module.history_archiver.submit({
+            'company_id': setup['company_id'], 'cashier_id': cashier_id, 'cashier_number': 1,
+            'otp': str(otp), 'join_time': now, 'served_time': now, 'wait_time_seconds': 90,
+            'status': 'served', 'delays': 0
+        })
+    module.history_archiver.flush()
+
+    with module.app.app_context():
+        # Cached as having no profile yet, for 15 minutes
+        assert module.service_profile(cashier_id) is None
+        assert module.compute_service_profiles()[0] == 1
+        assert module.service_profile(cashier_id).quantile(now) == 90
+
+
+@pytest.mark.parametrize('app_name', ['app', 'app_sqlite'])
+def test_the_joined_columns_stay_aligned(app_name, load_app, seed):
+    # The SQL job reads each column as one joined string; records of two
+    # cashiers alternate, and rows with a NULL must not shift any column
+    module = load_app(app_name)
+    setup = seed(module, cashiers=2)
+    now = datetime.utcnow()
+    for n in range(20):
+        number = n % 2 + 1
+        module.history_archiver.submit({
+            'company_id': setup['company_id'], 'cashier_id': setup['cashier_ids'][number - 1],
+            'cashier_number': number, 'otp': f"{100000 + n}", 'join_time': now, 'served_time': now,
+            'wait_time_seconds': 30 * number, 'status': 'served', 'delays': 0
+        })
+    module.history_archiver.flush()
+    with module.app.app_context():
+        for n in range(3):
+            module.db.session.add(module.QueueHistory(
+                company_id=setup['company_id'], cashier_number=1, otp=f"{300000 + n}", join_time=now,
+                served_time=now, wait_time_seconds=600, status='served', delays=0, recorded_at=None))
+        module.db.session.commit()
+
+        assert module.compute_service_profiles() == (2, 20)
+        assert [module.service_profile(cashier_id).quantile(now) for cashier_id in setup['cashier_ids']] == [30, 60]
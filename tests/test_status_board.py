@@ -0,0 +1,57 @@
+# test_status_board.py - Status ETags and long-polls (status_board.py)
+
+import gevent
+import pytest
+
+from benchmark import APPS, BENCH_COMPANY_CODE
+from status_board import StatusBoard
+
+
+def test_only_etags_this_worker_issued_match():
+    board = StatusBoard()
+    etag = board.etag('123456', '7')
+    assert board.match(f'"{etag}"', '123456') == ('7', f"{board.epoch}-0")
+    # The same version for another OTP or cashier, or unsigned
+    assert board.match(f'"123457.7.{board.epoch}-0.{etag.rsplit(".", 1)[1]}"', '123457') is None
+    assert board.match(f'"123456.8.{board.epoch}-0.{etag.rsplit(".", 1)[1]}"', '123456') is None
+    assert board.match(f'"123456.7.{board.epoch}-0"', '123456') is None
+
+
+def test_timed_out_waits_leave_no_waiters():
+    board = StatusBoard()
+    version = board.version('7')
+    waits = [gevent.spawn(board.wait, '7', version, 0.05) for _ in range(3)]
+    gevent.sleep(0.01)
+    assert board.waiting() == 1
+    gevent.joinall(waits)
+    assert [wait.value for wait in waits] == [version] * 3
+    assert board.waiting() == 0
+
+    # A bump wakes the waiters early and leaves nothing behind either
+    waits = [gevent.spawn(board.wait, '7', version, 5) for _ in range(2)]
+    gevent.sleep(0.01)
+    board.bump('7')
+    gevent.joinall(waits, timeout=1)
+    assert [wait.value for wait in waits] == [board.version('7')] * 2
+    assert board.waiting() == 0
+
+
+@pytest.mark.parametrize('app_name', APPS)
+def test_forged_etags_get_a_full_response(app_name, load_app, seed):
+    module = load_app(app_name)
+    seed(module, cashiers=1)
+    client = module.app.test_client()
+    otp = client.post(f"/api/join_queue/{BENCH_COMPANY_CODE}").get_json()['otp']
+    epoch = module.status_board.epoch
+
+    # Made-up cashier keys neither park a long-poll nor answer for unknown OTPs
+    for key in range(20):
+        response = client.get(f"/api/check_status/{otp}?wait=25",
+                              headers={'If-None-Match': f'"{otp}.fake{key}.{epoch}-0"'})
+        assert response.status_code == 200
+    response = client.get('/api/check_status/000000', headers={'If-None-Match': f'"000000.fake.{epoch}-0"'})
+    assert response.status_code == 404
+    assert module.status_board.waiting() == 0
+
+    etag = client.get(f"/api/check_status/{otp}").headers['ETag']
+    assert client.get(f"/api/check_status/{otp}", headers={'If-None-Match': etag}).status_code == 304
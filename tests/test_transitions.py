@@ -0,0 +1,88 @@
+# test_transitions.py - serve, delay and remove through the routes of every variant
+
+import pytest
+
+from benchmark import APPS, BENCH_COMPANY_CODE, BENCH_PASSWORD, BENCH_USER
+
+
+@pytest.fixture(params=APPS)
+def queue(request, load_app, seed):
+    # A variant with one cashier and three joined customers; the admin is
+    # logged in. Yields (module, client, [(customer id, otp)] in ticket order,
+    # company id).
+    module = load_app(request.param)
+    company_id = seed(module, cashiers=1)['company_id']
+    client = module.app.test_client()
+    otps = [client.post(f"/api/join_queue/{BENCH_COMPANY_CODE}").get_json()['otp'] for _ in range(3)]
+    client.post('/login', data={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+    customers = [(customer_id(module, otp), otp) for otp in otps]
+    yield module, client, customers, company_id
+
+
+def customer_id(module, otp):
+    with module.app.app_context():
+        return module.queue_store.find_by_otp(otp)['id']
+
+
+def positions(client, customers):
+    return [client.get(f"/api/check_status/{otp}").get_json()['position'] for _, otp in customers]
+
+
+def test_serve_calls_the_next_customer(queue):
+    module, client, customers, company_id = queue
+    (first_id, _), (_, second_otp), _ = customers
+    assert client.post(f"/api/serve_customer/{first_id}").get_json() == {'success': True, 'next_otp': second_otp}
+    assert client.post(f"/api/serve_customer/{first_id}").status_code == 404
+    assert positions(client, customers[1:]) == [1, 2]
+    assert module.queue_engine.cashiers(company_id)[0].serving == second_otp
+
+    module.history_archiver.flush()
+    with module.app.app_context():
+        assert module.queue_store.company_stats(company_id)['total_served'] == 1
+
+
+def test_delay_sends_the_customer_to_the_back(queue):
+    module, client, customers, company_id = queue
+    (first_id, first_otp), (_, second_otp), _ = customers
+    response = client.post(f"/api/delay_customer/{first_id}").get_json()
+    assert response == {'success': True, 'delays': 1, 'next_otp': second_otp}
+    assert positions(client, customers) == [3, 1, 2]
+    with module.app.app_context():
+        assert module.queue_store.company_stats(company_id)['total_delayed'] == 1
+
+
+def test_remove_a_waiting_customer(queue):
+    module, client, customers, company_id = queue
+    _, (second_id, _), _ = customers
+    assert client.post(f"/api/remove_customer/{second_id}").get_json() == {'success': True, 'next_otp': None}
+    assert client.post(f"/api/remove_customer/{second_id}").status_code == 404
+    assert positions(client, [customers[0], customers[2]]) == [1, 2]
+
+
+def test_other_admins_cannot_touch_the_queue(queue):
+    module, client, customers, company_id = queue
+    client.get('/logout')
+    client.post('/register', data={'username': 'other', 'password': 'other-password',
+                                        'confirm_password': 'other-password'})
+    client.post('/login', data={'username': 'other', 'password': 'other-password'})
+    first_id, _ = customers[0]
+    assert client.post(f"/api/serve_customer/{first_id}").status_code == 404
+    assert positions(client, customers) == [1, 2, 3]
+
+
+def test_a_rebuild_counts_customers_still_delayed(queue):
+    module, client, customers, company_id = queue
+    (first_id, _), (second_id, _), (third_id, _) = customers
+    client.post(f"/api/delay_customer/{first_id}")
+
+    def rebuilt_delays():
+        module.history_archiver.flush()
+        with module.app.app_context():
+            module.rebuild_company_stats(company_id)
+            return module.queue_store.company_stats(company_id)['total_delayed']
+
+    assert rebuilt_delays() == 1
+    # Once they leave the queue the delay is counted from their history record
+    for customer_id in (second_id, third_id, first_id):
+        assert client.post(f"/api/serve_customer/{customer_id}").status_code == 200
+    assert rebuilt_delays() == 1
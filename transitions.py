@@ -0,0 +1,108 @@
+# transitions.py - Admin queue transitions shared by all app variants
+# The QueueStore changes the database (serve, delay or remove, with the status
+# and ownership checks, and calls the next customer). QueueTransitions mirrors
+# the change in the queue engine, archives customers who leave the queue and
+# tells the customer and company rooms.
+
+from datetime import datetime
+
+from realtime import company_room, customer_room
+
+
+class QueueTransitions:
+    def __init__(self, store, queue_engine, history_archiver, otp_allocator, socketio,
+                 cashier_details, queue_changed):
+        # cashier_details(cashier_id) -> dict with company_id, cashier_number
+        # and company_code; queue_changed(company_id, cashier_id) is called
+        # after every transition
+        self.store = store
+        self.queue_engine = queue_engine
+        self.history_archiver = history_archiver
+        self.otp_allocator = otp_allocator
+        self.socketio = socketio
+        self.cashier_details = cashier_details
+        self.queue_changed = queue_changed
+
+    # Each returns (customer, next OTP) like the store, the customer merged
+    # with its cashier's details, or None when the store refused the change
+
+    def serve(self, customer_id, owned_cashiers, now=None):
+        # The customer also gets service_seconds: time at the counter, or None
+        now = now or datetime.utcnow()
+        result = self._apply(self.store.serve, customer_id, owned_cashiers, now)
+        if result is None:
+            return None
+        customer, next_otp = result
+        customer['service_seconds'] = None
+        if customer.get('serving_start_time'):
+            customer['service_seconds'] = int((now - customer['serving_start_time']).total_seconds())
+        self._settle(customer, now, next_otp)
+        return customer, next_otp
+
+    def delay(self, customer_id, owned_cashiers, now=None):
+        now = now or datetime.utcnow()
+        result = self._apply(self.store.delay, customer_id, owned_cashiers, now)
+        if result is None:
+            return None
+        customer, next_otp = result
+        if customer['delays'] == 1:
+            # Counted as it happens, so the manage page shows it right away
+            self.store.record_delay(customer['company_id'], customer['cashier_number'], now)
+        self._settle(customer, now, next_otp)
+        self.socketio.emit('customer_delayed', {
+            'otp': customer['otp'],
+            'delays': customer['delays'],
+            'company_code': customer['company_code']
+        }, to=[customer_room(customer['otp']), company_room(customer['company_code'])])
+        return customer, next_otp
+
+    def remove(self, customer_id, owned_cashiers, now=None):
+        now = now or datetime.utcnow()
+        result = self._apply(self.store.remove, customer_id, owned_cashiers, now)
+        if result is None:
+            return None
+        customer, next_otp = result
+        self._settle(customer, now, next_otp)
+        self.socketio.emit('customer_removed', {
+            'otp': customer['otp'],
+            'company_code': customer['company_code']
+        }, to=[customer_room(customer['otp']), company_room(customer['company_code'])])
+        return customer, next_otp
+
+    def _apply(self, transition, customer_id, owned_cashiers, now):
+        try:
+            result = transition(customer_id, owned_cashiers, now)
+        except Exception:
+            # MongoDB may have kept part of the change; reload from the database
+            self.queue_engine.invalidate()
+            raise
+        if result is None:
+            return None
+        customer, next_otp = result
+        return {**customer, **self.cashier_details(customer['cashier_id'])}, next_otp
+
+    def _settle(self, customer, now, next_otp):
+        status = customer['status']
+        self.queue_engine.advance(customer['company_id'], customer['cashier_id'], customer['otp'], next_otp,
+                                  requeue=status == 'delayed')
+        if status in ('served', 'removed'):
+            self.history_archiver.submit({
+                'company_id': customer['company_id'],
+                'cashier_id': customer['cashier_id'],
+                'cashier_number': customer['cashier_number'],
+                'otp': customer['otp'],
+                'join_time': customer['join_time'],
+                'served_time': now if status == 'served' else None,
+                'wait_time_seconds': customer.get('service_seconds'),
+                'status': status,
+                'delays': customer.get('delays') or 0
+            })
+            self.otp_allocator.release(customer['otp'])
+        self.queue_changed(customer['company_id'], customer['cashier_id'])
+
+        if next_otp:
+            self.socketio.emit('customer_turn', {
+                'otp': next_otp,
+                'cashier_number': customer['cashier_number'],
+                'company_code': customer['company_code']
+            }, to=[customer_room(next_otp), company_room(customer['company_code'])])
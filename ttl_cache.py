@@ -0,0 +1,135 @@
+# ttl_cache.py - Bounded lookup cache shared by all app variants
+# Entries live in named namespaces, each with its own TTL and size limit, and
+# are evicted least recently used first. Entries can carry tags such as
+# "company:<id>" so every entry derived from one record can be dropped at once.
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 300           # 5 minutes
+DEFAULT_MAX_ENTRIES = 1024
+
+_MISSING = object()
+
+
+class _Namespace:
+    def __init__(self, ttl, max_entries, negative_ttl):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl  # TTL for cached None results; 0 disables
+        self.entries = OrderedDict()      # key -> (expires_at, value, tags), LRU first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+
+class TTLCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._namespaces = {}
+        self._tags = {}  # tag -> {(namespace, key)}
+        # Called with (name, key, tag) after an explicit invalidation, e.g. to
+        # pass it on to other workers
+        self.on_invalidate = None
+
+    def namespace(self, name, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, negative_ttl=0):
+        self._namespaces[name] = _Namespace(ttl, max_entries, negative_ttl)
+
+    def get(self, name, key, default=None):
+        value = self._lookup(name, key)
+        return default if value is _MISSING else value
+
+    def get_or_fetch(self, name, key, fetch, tags=()):
+        # tags may be a callable taking the fetched value, for tags that
+        # depend on the record (e.g. its company id)
+        value = self._lookup(name, key)
+        if value is _MISSING:
+            value = fetch()
+            self.set(name, key, value, tags(value) if callable(tags) else tags)
+        return value
+
+    def set(self, name, key, value, tags=()):
+        namespace = self._namespaces[name]
+        ttl = namespace.ttl if value is not None else namespace.negative_ttl
+        with self._lock:
+            self._discard(name, key)
+            if ttl <= 0:
+                return
+            tags = tuple(tags or ())
+            namespace.entries[key] = (time.monotonic() + ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add((name, key))
+            while len(namespace.entries) > namespace.max_entries:
+                oldest = next(iter(namespace.entries))
+                self._discard(name, oldest)
+                namespace.evictions += 1
+
+    def invalidate(self, name, key, propagate=True):
+        with self._lock:
+            if self._discard(name, key):
+                self._namespaces[name].invalidations += 1
+        if propagate and self.on_invalidate is not None:
+            self.on_invalidate(name, key, None)
+
+    def invalidate_tag(self, tag, propagate=True):
+        # Drop every entry carrying the tag; returns how many were dropped
+        with self._lock:
+            members = self._tags.pop(tag, set())
+            for name, key in members:
+                if self._discard(name, key):
+                    self._namespaces[name].invalidations += 1
+        if propagate and self.on_invalidate is not None:
+            self.on_invalidate(None, None, tag)
+        return len(members)
+
+    def clear(self):
+        with self._lock:
+            for namespace in self._namespaces.values():
+                namespace.entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    'size': len(namespace.entries),
+                    'max_entries': namespace.max_entries,
+                    'hits': namespace.hits,
+                    'misses': namespace.misses,
+                    'evictions': namespace.evictions,
+                    'expirations': namespace.expirations,
+                    'invalidations': namespace.invalidations
+                }
+                for name, namespace in self._namespaces.items()
+            }
+
+    def _lookup(self, name, key):
+        namespace = self._namespaces[name]
+        with self._lock:
+            entry = namespace.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._discard(name, key)
+                namespace.expirations += 1
+                entry = None
+            if entry is None:
+                namespace.misses += 1
+                return _MISSING
+            namespace.entries.move_to_end(key)
+            namespace.hits += 1
+            return entry[1]
+
+    def _discard(self, name, key):
+        # Caller holds the lock
+        entry = self._namespaces[name].entries.pop(key, None)
+        if entry is None:
+            return False
+        for tag in entry[2]:
+            members = self._tags.get(tag)
+            if members is not None:
+                members.discard((name, key))
+                if not members:
+                    del self._tags[tag]
+        return True
@@ -0,0 +1,56 @@
+# wait_estimator.py - Rolling per-cashier service-time estimate
+# Keeps the last few service times per cashier in a ring buffer with a running
+# sum, so reading the estimate is O(1) instead of re-querying QueueHistory.
+
+import threading
+from collections import deque
+
+DEFAULT_SERVICE_SECONDS = 180  # 3 minutes until a cashier has history
+WINDOW_SIZE = 5                # Average over the last 5 customers
+
+
+class ServiceTimeEstimator:
+    def __init__(self, window=WINDOW_SIZE, default=DEFAULT_SERVICE_SECONDS):
+        self.window = window
+        self.default = default
+        self._lock = threading.Lock()
+        self._samples = {}  # cashier_key -> deque of recent service times
+        self._totals = {}   # cashier_key -> running sum of the deque
+
+    def is_loaded(self, cashier_key):
+        return cashier_key in self._samples
+
+    def seed(self, cashier_key, samples):
+        # samples: service times in seconds, oldest first
+        buffer = deque((s for s in samples if s is not None), maxlen=self.window)
+        with self._lock:
+            self._samples[cashier_key] = buffer
+            self._totals[cashier_key] = sum(buffer)
+
+    def record(self, cashier_key, seconds):
+        if seconds is None:
+            return
+        with self._lock:
+            buffer = self._samples.get(cashier_key)
+            if buffer is None:
+                buffer = self._samples[cashier_key] = deque(maxlen=self.window)
+                self._totals[cashier_key] = 0
+            if len(buffer) == self.window:
+                self._totals[cashier_key] -= buffer[0]
+            buffer.append(seconds)
+            self._totals[cashier_key] += seconds
+
+    def estimate(self, cashier_key):
+        buffer = self._samples.get(cashier_key)
+        if not buffer:
+            return self.default
+        return self._totals[cashier_key] / len(buffer)
+
+    def forget(self, cashier_key=None):
+        with self._lock:
+            if cashier_key is None:
+                self._samples.clear()
+                self._totals.clear()
+            else:
+                self._samples.pop(cashier_key, None)
+                self._totals.pop(cashier_key, None)